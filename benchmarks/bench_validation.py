@@ -0,0 +1,57 @@
+'''
+Compares request validation with jsonschema.validate, as json_validate used
+to do it, against the validator precompiled by json_validate.
+
+Run from the repository root with:
+    PYTHONPATH=.:email_service python benchmarks/bench_validation.py
+'''
+import timeit
+
+import jsonschema
+
+from email_service.schemas import email_api_schema, get_format_checker
+
+
+payload = {
+    'from_email': 'test@tapandita.com',
+    'from_name': 'Test client',
+    'to': ['tapan.pandita@gmail.com', 'tapan.pandita+1@gmail.com'],
+    'cc': ['tapan.pandita+2@gmail.com'],
+    'bcc': ['tapan.pandita+3@gmail.com'],
+    'subject': 'Full payload test',
+    'text': 'This is the text',
+    'html': 'This is <b>HTML</b>',
+}
+
+
+def validate_per_request():
+    '''Validation as it used to be done on every request'''
+    jsonschema.validate(
+        payload, email_api_schema, format_checker=jsonschema.FormatChecker(),
+    )
+
+
+validator = jsonschema.Draft4Validator(
+    email_api_schema, format_checker=get_format_checker(),
+)
+
+
+def validate_precompiled():
+    '''Validation with the validator compiled once at import'''
+    validator.validate(payload)
+
+
+def main(number=5000):
+    '''Prints the time per validation of both approaches'''
+    results = []
+
+    for fn in (validate_per_request, validate_precompiled):
+        best = min(timeit.repeat(fn, number=number, repeat=3))
+        results.append(best)
+        print '{0:<22} {1:8.1f} us'.format(fn.__name__, best / number * 1e6)
+
+    print 'speedup {0:.1f}x'.format(results[0] / results[1])
+
+
+if __name__ == '__main__':
+    main()
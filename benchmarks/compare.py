@@ -0,0 +1,52 @@
+'''
+Compares two saved benchmark results, printing the change of every
+percentile and of the requests per second.
+
+Run from the repository root with:
+    python benchmarks/compare.py benchmarks/results/micro-<old>.json \
+        benchmarks/results/micro-<new>.json
+'''
+import sys
+import json
+
+
+COLUMNS = ('rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def load(path):
+    '''Returns the {name: summary} results of a saved benchmark'''
+
+    with open(path) as results_file:
+        results = json.load(results_file)['results']
+
+    return dict(
+        (name, summary) for name, summary in results.items()
+        if isinstance(summary, dict) and 'count' in summary
+    )
+
+
+def change(old, new):
+    '''Formats the relative change between two values'''
+
+    if not old or new is None:
+        return '{0:>12}'.format('-')
+
+    return '{0:>+11.1f}%'.format((new - old) * 100.0 / old)
+
+
+def main(old_path, new_path):
+    '''Prints the changes between the results both files have in common'''
+    old, new = load(old_path), load(new_path)
+    print '{0:<28}'.format('') + ''.join(
+        '{0:>12}'.format(column) for column in COLUMNS
+    )
+
+    for name in sorted(set(old) & set(new)):
+        print '{0:<28}'.format(name) + ''.join(
+            change(old[name].get(column), new[name].get(column))
+            for column in COLUMNS
+        )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
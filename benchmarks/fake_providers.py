@@ -0,0 +1,109 @@
+'''
+Local stand-ins for the sendgrid and mailgun apis, with configurable
+latency, errors and hangs. One server answers both apis.
+
+Run from the repository root with:
+    python benchmarks/fake_providers.py --port 8025 --latency 50 \
+        --error-rate 0.01 --hang-rate 0.001
+'''
+import json
+import time
+import random
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class FakeProviderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers sendgrid and mailgun send requests'''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status_code, body):
+        payload = json.dumps(body)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        options = self.server.options
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+
+        if random.random() < options.hang_rate:
+            time.sleep(options.hang_time)
+        elif options.latency:
+            time.sleep(random.expovariate(1000.0 / options.latency))
+
+        if random.random() < options.error_rate:
+            return self.reply(500, {'message': 'error'})
+
+        if self.path.endswith('/mail.send.json'):
+            return self.reply(200, {'message': 'success'})
+
+        if self.path.endswith('/messages'):
+            return self.reply(200, {'id': '<fake@mailgun>', 'message': 'Queued'})
+
+        return self.reply(404, {'message': 'error'})
+
+
+class FakeProviderServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    '''Threaded http server holding the fake provider options'''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, options):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeProviderHandler)
+        self.options = options
+
+    def handle_error(self, request, client_address):
+        '''Clients dropping keep-alive connections are not errors'''
+        pass
+
+
+def parser():
+    '''Command line options of the fake providers'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('--host', default='127.0.0.1')
+    argument_parser.add_argument('--port', type=int, default=8025)
+    argument_parser.add_argument(
+        '--latency', type=float, default=0,
+        help='mean latency in milliseconds, exponentially distributed',
+    )
+    argument_parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='fraction of requests answered with a 500',
+    )
+    argument_parser.add_argument(
+        '--hang-rate', type=float, default=0,
+        help='fraction of requests that hang for --hang-time seconds',
+    )
+    argument_parser.add_argument('--hang-time', type=float, default=60)
+    return argument_parser
+
+
+def start(options):
+    '''Starts a fake provider server in a daemon thread and returns it'''
+    server = FakeProviderServer((options.host, options.port), options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    options = parser().parse_args()
+    FakeProviderServer((options.host, options.port), options).serve_forever()
@@ -0,0 +1,262 @@
+'''
+Load test of the app running under gunicorn with gevent workers, sending
+through a local fake provider. Reports the latency percentiles and requests
+per second of POST /api/v1/emails.
+
+Run from the repository root with:
+    PYTHONPATH=.:email_service python benchmarks/loadgen.py --duration 30 \
+        --concurrency 50 --latency 100 --error-rate 0.01
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+from benchmarks import stats
+from email_service.auth import ApiKeyStore
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SETTINGS = '''
+DEBUG = False
+SECRET_KEY = 'benchmark'
+DEFAULT_FROM_EMAIL = 'support@tapandita.com'
+DEFAULT_FROM_NAME = 'Tapan Pandita'
+EMAIL_DOMAIN = 'tapandita.com'
+SENDGRID_HOST = {host!r}
+SENDGRID_USER = 'user'
+SENDGRID_API_KEY = 'key'
+MAILGUN_HOST = {host!r}
+MAILGUN_USER = 'api'
+MAILGUN_API_KEY = 'key'
+EMAIL_ROUTING = {routing!r}
+OUTBOX_PATH = {directory!r} + '/outbox.db'
+TEMPLATE_STORE_PATH = {directory!r} + '/templates.db'
+IDEMPOTENCY_STORE_PATH = {directory!r} + '/idempotency.db'
+RATE_LIMIT_STORE_PATH = {directory!r} + '/ratelimit.db'
+API_KEY_STORE_PATH = {directory!r} + '/apikeys.db'
+SUPPRESSION_STORE_PATH = {directory!r} + '/suppressions.db'
+EVENT_STORE_PATH = {directory!r} + '/events.db'
+SEND_LOG_DIR = {directory!r} + '/sendlog'
+METRICS_DIR = {directory!r} + '/metrics'
+'''
+
+payload = json.dumps({
+    'from_email': 'test@tapandita.com',
+    'from_name': 'Test client',
+    'to': ['tapan.pandita@gmail.com'],
+    'subject': 'Load test',
+    'text': 'This is the text',
+    'html': 'This is <b>HTML</b>',
+})
+
+
+def executable(name):
+    '''Returns the named script installed next to the python interpreter'''
+    path = os.path.join(os.path.dirname(sys.executable), name)
+    return path if os.path.exists(path) else name
+
+
+def start_providers(options, directory):
+    '''Starts the fake providers in their own process'''
+    return subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_providers.py'),
+        '--port', str(options.provider_port),
+        '--latency', str(options.latency),
+        '--error-rate', str(options.error_rate),
+        '--hang-rate', str(options.hang_rate),
+    ], cwd=directory)
+
+
+def start_app(options, directory):
+    '''
+    Starts gunicorn, or serve.py with --server gevent, with settings pointing
+    at the fake providers
+    '''
+    settings_path = os.path.join(directory, 'settings.py')
+
+    with open(settings_path, 'w') as settings_file:
+        settings_file.write(SETTINGS.format(
+            host='http://127.0.0.1:{0}'.format(options.provider_port),
+            routing=options.routing,
+            directory=directory,
+        ))
+
+    environment = dict(
+        os.environ,
+        EMAIL_SERVICE_SETTINGS=settings_path,
+        GUNICORN_NUM_WORKERS=str(options.workers),
+        GUNICORN_WORKER_CLASS=options.worker_class,
+        GUNICORN_LOG_LEVEL='warning',
+        METRICS_DIR=os.path.join(directory, 'metrics'),
+        PORT=str(options.port),
+    )
+
+    if options.server == 'gevent':
+        environment['PYTHONPATH'] = os.pathsep.join(
+            [ROOT, os.path.join(ROOT, 'email_service')],
+        )
+        return subprocess.Popen([
+            sys.executable, os.path.join(ROOT, 'email_service', 'serve.py'),
+        ], cwd=ROOT, env=environment)
+
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.Popen([
+            executable('gunicorn'), 'app:app',
+            '-b', '127.0.0.1:{0}'.format(options.port),
+            '-c', os.path.join(ROOT, 'gunicorn_conf.py'),
+            '--pythonpath', os.path.join(ROOT, 'email_service'),
+            '--access-logfile', os.devnull,
+        ], cwd=ROOT, env=environment, stdout=devnull)
+
+
+def wait_until_up(url, server, timeout=30):
+    '''Waits for the app to answer its health check'''
+    started_at = time.time()
+
+    while time.time() - started_at < timeout:
+
+        if server.poll() is not None:
+            raise RuntimeError('The app exited with {0}'.format(
+                server.returncode,
+            ))
+
+        try:
+            response = requests.get(
+                url, headers={'Accept': 'application/json'}, timeout=1,
+            )
+
+            if response.status_code == 200:
+                return
+        except Exception:  # requests 2.4.0 lets urllib3 errors through
+            pass
+
+        time.sleep(0.2)
+
+    raise RuntimeError('The app did not start within {0}s'.format(timeout))
+
+
+def client(url, key, stop_at, latencies, status_codes, lock):
+    '''Sends emails one after the other until stop_at'''
+    session = requests.Session()
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'Authorization': 'Bearer ' + key,
+    }
+
+    while time.time() < stop_at:
+        start = time.time()
+
+        try:
+            status_code = session.post(
+                url, data=payload, headers=headers, timeout=60,
+            ).status_code
+        except Exception:  # requests 2.4.0 lets urllib3 errors through
+            status_code = 'error'
+
+        latency = time.time() - start
+
+        with lock:
+            latencies.append(latency)
+            status_codes[str(status_code)] = (
+                status_codes.get(str(status_code), 0) + 1
+            )
+
+
+def run(options, base_url, key):
+    '''Drives the app with concurrent clients, returns the results'''
+    url = base_url + '/api/v1/emails' + ('?async=1' if options.async else '')
+    latencies = []
+    status_codes = {}
+    lock = threading.Lock()
+    stop_at = time.time() + options.warmup
+
+    # warm up connections and caches without recording anything
+    client(url, key, stop_at, [], {}, lock)
+
+    started_at = time.time()
+    stop_at = started_at + options.duration
+    threads = [
+        threading.Thread(
+            target=client,
+            args=(url, key, stop_at, latencies, status_codes, lock),
+        )
+        for _ in range(options.concurrency)
+    ]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return latencies, status_codes, time.time() - started_at
+
+
+def parser():
+    '''Command line options of the load test'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('--duration', type=float, default=30)
+    argument_parser.add_argument('--warmup', type=float, default=2)
+    argument_parser.add_argument('--concurrency', type=int, default=50)
+    argument_parser.add_argument('--server', default='gunicorn',
+                                 choices=('gunicorn', 'gevent'),
+                                 help='gevent runs a single serve.py process')
+    argument_parser.add_argument('--workers', type=int, default=2)
+    argument_parser.add_argument('--worker-class', default='gevent')
+    argument_parser.add_argument('--routing', default='priority')
+    argument_parser.add_argument('--async', action='store_true',
+                                 help='queue the emails in the outbox')
+    argument_parser.add_argument('--port', type=int, default=8026)
+    argument_parser.add_argument('--provider-port', type=int, default=8025)
+    argument_parser.add_argument('--latency', type=float, default=50,
+                                 help='mean provider latency in milliseconds')
+    argument_parser.add_argument('--error-rate', type=float, default=0)
+    argument_parser.add_argument('--hang-rate', type=float, default=0)
+    argument_parser.add_argument('--no-save', action='store_true')
+    return argument_parser
+
+
+def main():
+    '''Runs the load test and saves its results'''
+    options = parser().parse_args()
+    directory = tempfile.mkdtemp(prefix='email-service-bench-')
+    base_url = 'http://127.0.0.1:{0}'.format(options.port)
+    _, key = ApiKeyStore(os.path.join(directory, 'apikeys.db')).create('bench')
+    providers = start_providers(options, directory)
+    server = start_app(options, directory)
+
+    try:
+        wait_until_up(base_url + '/api/v1/health', server)
+        latencies, status_codes, duration = run(options, base_url, key)
+    finally:
+        server.terminate()
+        providers.terminate()
+        server.wait()
+        providers.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results = {
+        'send': stats.summarize(latencies, duration),
+        'status_codes': status_codes,
+        'options': vars(options),
+    }
+    stats.print_table({'send': results['send']})
+    print 'status codes', json.dumps(status_codes, sort_keys=True)
+
+    if not options.no_save:
+        print 'Saved to', stats.save('load', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Microbenchmarks of the hot paths of a send request: json_validate, the
+_create_payload of every backend and EmailMessage.send against a local fake
+provider.
+
+Run from the repository root with:
+    PYTHONPATH=.:email_service python benchmarks/micro.py
+'''
+import os
+import json
+import argparse
+import timeit
+
+from flask import request
+
+os.environ.setdefault('EMAIL_SERVICE_SETTINGS', 'config/testing.py')
+
+from app import app
+from email_service.decorators import json_validate
+from email_service.schemas import email_api_schema, get_format_checker
+from mail import breaker, registry
+from mail.message import EmailMessage
+
+from benchmarks import fake_providers, stats
+
+
+payload = {
+    'from_email': 'test@tapandita.com',
+    'from_name': 'Test client',
+    'to': ['tapan.pandita@gmail.com', 'tapan.pandita+1@gmail.com'],
+    'cc': ['tapan.pandita+2@gmail.com'],
+    'bcc': ['tapan.pandita+3@gmail.com'],
+    'subject': 'Full payload test',
+    'text': 'This is the text',
+    'html': 'This is <b>HTML</b>',
+}
+
+
+def measure(fn, number):
+    '''Calls fn number times, returns the summary of the call latencies'''
+    timer = timeit.default_timer
+    latencies = []
+    started_at = timer()
+
+    for _ in xrange(number):
+        start = timer()
+        fn()
+        latencies.append(timer() - start)
+
+    return stats.summarize(latencies, timer() - started_at)
+
+
+def bench_json_validate(number):
+    '''Validation of a full payload, as done on every send request'''
+    view = json_validate(email_api_schema, get_format_checker)(lambda: None)
+    body = json.dumps(payload)
+
+    with app.test_request_context(
+            '/api/v1/emails', method='POST', data=body,
+            content_type='application/json'):
+        current_request = request._get_current_object()
+
+        def validate():
+            # get_json caches the parsed body, parse it on every call
+            current_request.__dict__.pop('_cached_json', None)
+            view()
+
+        return measure(validate, number)
+
+
+def bench_create_payload(name, number):
+    '''Conversion of a message to the payload of a backend'''
+    backend = registry.get_backend(name)
+    message = EmailMessage(**payload)
+
+    return measure(lambda: backend._create_payload(message), number)
+
+
+def bench_send(backend_name, number):
+    '''EmailMessage.send through a backend to the fake provider'''
+    app.config['EMAIL_BACKENDS'] = [backend_name]
+    registry.reset()
+    breaker.reset()
+
+    return measure(lambda: EmailMessage(**payload).send(), number)
+
+
+def main():
+    '''Runs the microbenchmarks and saves their results'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('--number', type=int, default=2000)
+    argument_parser.add_argument('--port', type=int, default=8025)
+    argument_parser.add_argument('--no-save', action='store_true')
+    options = argument_parser.parse_args()
+
+    provider_options = fake_providers.parser().parse_args(
+        ['--port', str(options.port)],
+    )
+    server = fake_providers.start(provider_options)
+    host = 'http://127.0.0.1:{0}'.format(options.port)
+    app.config.update(SENDGRID_HOST=host, MAILGUN_HOST=host)
+    results = {}
+
+    with app.app_context():
+        results['json_validate'] = bench_json_validate(options.number)
+
+        for name in ('sendgrid', 'mailgun'):
+            results['create_payload.' + name] = bench_create_payload(
+                name, options.number,
+            )
+            results['send.' + name] = bench_send(name, options.number)
+            registry.get_backend(name).requests_session.close()
+
+    server.shutdown()
+    server.server_close()
+    stats.print_table(results)
+
+    if not options.no_save:
+        print 'Saved to', stats.save('micro', results)
+
+
+if __name__ == '__main__':
+    main()
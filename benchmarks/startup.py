@@ -0,0 +1,189 @@
+'''
+Startup time of the app: importing it in a fresh interpreter, booting a
+forked worker up to its first request with and without the app preloaded in
+the parent, and gunicorn answering its first health check with and without
+preload_app. Every run is a new process, so nothing is cached between them.
+
+Run from the repository root with:
+    PYTHONPATH=.:email_service python benchmarks/startup.py --runs 20
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks import loadgen, stats
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUEST = '''
+app.test_client().post(
+    '/api/v1/emails?async=1',
+    data='{"to": ["tapan.pandita@gmail.com"], "subject": "Hi", "text": "Hi"}',
+    headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+)
+'''
+
+# prints the seconds spent importing the app, then up to its first response
+COLD_START = '''
+import time
+started_at = time.time()
+from app import app
+imported_at = time.time()
+''' + FIRST_REQUEST + '''
+print imported_at - started_at, time.time() - started_at
+'''
+
+# Forks workers one after the other, the way the gunicorn master does, and
+# prints the seconds each took from the fork up to its first response. With
+# preload, the parent does what gunicorn_conf.when_ready does beforehand.
+WORKER_BOOT = '''
+import os
+import sys
+import time
+
+if sys.argv[1] == '1':
+    from app import app
+    from email_service import decorators
+    from mail import backends
+    getattr(decorators, 'compile_validators', lambda: None)()
+
+for _ in range(int(sys.argv[2])):
+    read_fd, write_fd = os.pipe()
+    forked_at = time.time()
+    pid = os.fork()
+
+    if pid == 0:
+        from app import app
+''' + '\n'.join('        ' + line for line in FIRST_REQUEST.splitlines()) + '''
+        os.write(write_fd, repr(time.time() - forked_at))
+        os._exit(0)
+
+    os.close(write_fd)
+    print os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+'''
+
+
+def environment():
+    '''Environment of the app processes, with the testing settings'''
+    return dict(
+        os.environ,
+        EMAIL_SERVICE_SETTINGS='config/testing.py',
+        PYTHONPATH=os.pathsep.join(
+            [ROOT, os.path.join(ROOT, 'email_service')],
+        ),
+    )
+
+
+def run_script(script, *args):
+    '''Runs a python script in a new interpreter, returns its output lines'''
+    output = subprocess.check_output(
+        [sys.executable, '-c', script] + [str(arg) for arg in args],
+        cwd=os.path.join(ROOT, 'email_service'), env=environment(),
+    )
+
+    return output.strip().splitlines()
+
+
+def cold_start(runs):
+    '''Times the import and first response of the app in new interpreters'''
+    imports = []
+    first_responses = []
+
+    for _ in range(runs):
+        imported, responded = run_script(COLD_START)[-1].split()
+        imports.append(float(imported))
+        first_responses.append(float(responded))
+
+    return {
+        'cold_import': stats.summarize(imports),
+        'cold_first_response': stats.summarize(first_responses),
+    }
+
+
+def worker_boot(runs):
+    '''
+    Times forked workers up to their first response, with and without the
+    app preloaded in their parent
+    '''
+    return {
+        'worker_boot': stats.summarize(
+            [float(line) for line in run_script(WORKER_BOOT, 0, runs)],
+        ),
+        'worker_boot_preload': stats.summarize(
+            [float(line) for line in run_script(WORKER_BOOT, 1, runs)],
+        ),
+    }
+
+
+def gunicorn_boot(options, preload):
+    '''
+    Times gunicorn from its start up to its first health check, with the
+    fake providers running so the workers warm their connections
+    '''
+    os.environ['GUNICORN_PRELOAD'] = '1' if preload else '0'
+    base_url = 'http://127.0.0.1:{0}'.format(options.port)
+    latencies = []
+
+    for _ in range(options.gunicorn_runs):
+        directory = tempfile.mkdtemp(prefix='email-service-bench-')
+        providers = loadgen.start_providers(options, directory)
+        started_at = time.time()
+        server = loadgen.start_app(options, directory)
+
+        try:
+            loadgen.wait_until_up(base_url + '/api/v1/health', server)
+            latencies.append(time.time() - started_at)
+        finally:
+            server.terminate()
+            providers.terminate()
+            server.wait()
+            providers.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return stats.summarize(latencies)
+
+
+def parser():
+    '''Command line options of the startup benchmark'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('--runs', type=int, default=20)
+    argument_parser.add_argument('--gunicorn-runs', type=int, default=5)
+    argument_parser.add_argument('--workers', type=int, default=2)
+    argument_parser.add_argument('--worker-class', default='gevent')
+    argument_parser.add_argument('--routing', default='priority')
+    argument_parser.add_argument('--port', type=int, default=8026)
+    argument_parser.add_argument('--provider-port', type=int, default=8025)
+    argument_parser.add_argument('--no-gunicorn', action='store_true')
+    argument_parser.set_defaults(
+        server='gunicorn', latency=0, error_rate=0, hang_rate=0,
+    )
+    argument_parser.add_argument('--no-save', action='store_true')
+    return argument_parser
+
+
+def main():
+    '''Runs the startup benchmarks and saves their results'''
+    options = parser().parse_args()
+    results = {}
+    results.update(cold_start(options.runs))
+    results.update(worker_boot(options.runs))
+
+    if not options.no_gunicorn:
+        results['gunicorn_boot'] = gunicorn_boot(options, False)
+        results['gunicorn_boot_preload'] = gunicorn_boot(options, True)
+
+    stats.print_table(results)
+
+    if not options.no_save:
+        print 'Saved to', stats.save('startup', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''Latency statistics and result files shared by the benchmarks'''
+import os
+import json
+import time
+import platform
+import subprocess
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def percentile(sorted_values, fraction):
+    '''Returns the value below which the given fraction of values fall'''
+
+    if not sorted_values:
+        return None
+
+    index = min(int(round(fraction * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+
+    return sorted_values[index]
+
+
+def summarize(latencies, duration=None):
+    '''
+    Returns count, mean, p50, p95, p99 and max of latencies in milliseconds,
+    and requests per second if the duration in seconds is given.
+    '''
+    values = sorted(latency * 1000 for latency in latencies)
+    summary = {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values) if values else None,
+        'p50_ms': percentile(values, 0.50),
+        'p95_ms': percentile(values, 0.95),
+        'p99_ms': percentile(values, 0.99),
+        'max_ms': values[-1] if values else None,
+    }
+
+    if duration:
+        summary['rps'] = len(values) / duration
+
+    return summary
+
+
+def git_revision():
+    '''Returns the commit the benchmark runs against'''
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save(name, results, directory=RESULTS_DIR):
+    '''
+    Writes results to <directory>/<name>-<revision>-<timestamp>.json, so
+    runs against different commits can be compared. Returns the path.
+    '''
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    revision = git_revision()
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    path = os.path.join(
+        directory, '{0}-{1}-{2}.json'.format(name, revision, timestamp),
+    )
+    document = {
+        'benchmark': name,
+        'revision': revision,
+        'timestamp': timestamp,
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+    with open(path, 'w') as results_file:
+        json.dump(document, results_file, indent=2, sort_keys=True)
+
+    return path
+
+
+def print_table(results):
+    '''Prints the summaries of a {name: summary} dict'''
+    columns = ('count', 'rps', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms',
+               'max_ms')
+    print '{0:<28}'.format('') + ''.join(
+        '{0:>12}'.format(column) for column in columns
+    )
+
+    for name in sorted(results):
+        cells = []
+
+        for column in columns:
+            value = results[name].get(column)
+            cells.append(
+                '{0:>12}'.format('-') if value is None else
+                '{0:>12.3f}'.format(value) if isinstance(value, float) else
+                '{0:>12}'.format(value)
+            )
+
+        print '{0:<28}'.format(name) + ''.join(cells)
@@ -0,0 +1,79 @@
+'''
+Measures the suppression list at scale: how long a list of --entries
+addresses takes to load into an index, the memory of the index, and the
+latency of lookups of suppressed and of other addresses.
+
+Run from the repository root with:
+    PYTHONPATH=.:email_service python benchmarks/suppression.py
+'''
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from mail.suppression import SuppressionList
+
+from benchmarks import stats
+from benchmarks.micro import measure
+
+
+def fill(suppression_list, entries, chunk_size=100000):
+    '''Suppresses entries generated addresses'''
+
+    for start in xrange(0, entries, chunk_size):
+        suppression_list.add(
+            'user{0}@example.com'.format(number)
+            for number in xrange(start, min(start + chunk_size, entries))
+        )
+
+
+def main():
+    '''Runs the benchmark and saves its results'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('--entries', type=int, default=1000000)
+    argument_parser.add_argument('--number', type=int, default=100000)
+    argument_parser.add_argument('--no-save', action='store_true')
+    options = argument_parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'suppressions.db')
+    suppression_list = SuppressionList(path, synchronous='OFF')
+    fill(suppression_list, options.entries)
+
+    start = time.time()
+    suppression_list.reload()
+    load_seconds = time.time() - start
+    index = suppression_list.index
+
+    suppressed = iter([
+        'user{0}@example.com'.format(random.randrange(options.entries))
+        for _ in xrange(options.number)
+    ])
+    others = iter([
+        'other{0}@example.org'.format(number)
+        for number in xrange(options.number)
+    ])
+    results = {
+        'lookup.suppressed': measure(
+            lambda: next(suppressed) in index, options.number,
+        ),
+        'lookup.other': measure(lambda: next(others) in index, options.number),
+    }
+    results['load'] = {
+        'count': len(index),
+        'mean_ms': load_seconds * 1000,
+        'index_mb': index.keys.buffer_info()[1] * index.keys.itemsize / 1e6,
+    }
+    os.remove(path)
+
+    stats.print_table(results)
+    print 'index of {0} addresses: {1:.1f} MB, loaded in {2:.1f}s'.format(
+        len(index), results['load']['index_mb'], load_seconds,
+    )
+
+    if not options.no_save:
+        print 'Saved to', stats.save('suppression', results)
+
+
+if __name__ == '__main__':
+    main()
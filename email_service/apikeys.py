@@ -0,0 +1,37 @@
+'''
+Creates, lists and revokes the api keys of the tenants. Every worker picks
+changes up within API_KEY_REFRESH_INTERVAL.
+'''
+import argparse
+
+from app import app
+
+
+def main():
+    '''Runs the command given on the command line'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    commands = argument_parser.add_subparsers(dest='command')
+    create = commands.add_parser('create', help='creates a key for a tenant')
+    create.add_argument('tenant')
+    keys = commands.add_parser('list', help='lists the keys')
+    keys.add_argument('--tenant')
+    revoke = commands.add_parser('revoke', help='revokes a key by id')
+    revoke.add_argument('id', type=int)
+    options = argument_parser.parse_args()
+    store = app.api_key_store
+
+    if options.command == 'create':
+        key_id, key = store.create(options.tenant)
+        print key_id, key
+    elif options.command == 'list':
+
+        for key in store.list(options.tenant):
+            print key['id'], key['prefix'], key['tenant'], (
+                'revoked' if key['revoked_at'] else 'active'
+            )
+    elif not store.revoke(options.id):
+        argument_parser.exit(1, 'No active key {0}\n'.format(options.id))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,78 +1,132 @@
 '''The email service flask app'''
-import requests
-
-from flask import Flask, request, jsonify
-
-from email_service.decorators import consumes, produces, json_validate
-from email_service.schemas import email_api_schema
-from email_service.errors import ValidationError
-from mail.message import EmailMessage
-from mail.exceptions import ClientException
-
-
-app = Flask(__name__)
-app.config.from_object('config.base')
-app.config.from_envvar('EMAIL_SERVICE_SETTINGS')
-app.requests_session = requests.Session()
-
-
-@app.route('/api/v1/health', methods=['GET'])
-@produces('application/json')
-def health():
-    '''Check the status of the service.'''
-    return jsonify({'status': 'ok'})
-
-
-@app.route('/api/v1/emails', methods=['POST'])
-@consumes('application/json')
-@produces('application/json')
-@json_validate(email_api_schema)
-def send_email():
+from flask import Flask
+
+from email_service import decorators
+from email_service.auth import ApiKeyStore
+from email_service.idempotency import IdempotencyStore
+from email_service.metrics import Metrics
+from email_service.profiler import init_profiler
+from email_service.timing import RequestTimer
+from views import api
+from email_service.wrappers import EmailRequest
+from mail import breaker, registry
+from mail.coalesce import Coalescer
+from mail.events import EventBuffer, EventStore
+from mail.limiter import ConcurrencyLimiter
+from mail.outbox import Outbox
+from mail.ratelimit import RateLimiter
+from mail.sendlog import SendLog
+from mail.suppression import SuppressionList
+from mail.templates import TemplateStore
+
+
+def create_app(config=None):
     '''
-    Thin wrapper around sendgrid and mailgun apis. Sends emails to provided
-    email addresses.
+    Creates the email service app. The base configuration is overridden by
+    the file named by EMAIL_SERVICE_SETTINGS, then by the config dict. The
+    file may only be left out when a config dict is given.
     '''
-    request_payload = request.get_json()
-
-    message = EmailMessage(**request_payload)
-    is_sent, backend = message.send()
-
-    if not is_sent:
-        return jsonify({'message': 'error'}), 502
-
-    return jsonify({'message': 'success', 'backend': backend.name})
-
-
-@app.errorhandler(ValidationError)
-def handle_validation_error(error):
+    flask_app = Flask(__name__)
+    flask_app.request_class = EmailRequest
+    flask_app.config.from_object('config.base')
+    flask_app.config.from_envvar(
+        'EMAIL_SERVICE_SETTINGS', silent=config is not None,
+    )
+    flask_app.config.update(config or {})
+    flask_app.outbox = Outbox(
+        flask_app.config['OUTBOX_PATH'],
+        synchronous=flask_app.config['OUTBOX_SYNCHRONOUS'],
+        max_attempts=flask_app.config['OUTBOX_MAX_ATTEMPTS'],
+        backoff=flask_app.config['OUTBOX_RETRY_BACKOFF'],
+        max_backoff=flask_app.config['OUTBOX_MAX_RETRY_BACKOFF'],
+    )
+    flask_app.template_store = TemplateStore(
+        flask_app.config['TEMPLATE_STORE_PATH'],
+        cache_size=flask_app.config['TEMPLATE_CACHE_SIZE'],
+    )
+    Metrics(
+        flask_app.config['METRICS_DIR'],
+        flush_interval=flask_app.config['METRICS_FLUSH_INTERVAL'],
+    ).init_app(flask_app)
+    RequestTimer(
+        header=flask_app.config['SERVER_TIMING'],
+        log=flask_app.config['TIMING_LOG'],
+    ).init_app(flask_app)
+    flask_app.rate_limiter = RateLimiter(
+        flask_app.config['RATE_LIMIT_STORE_PATH'],
+    )
+    flask_app.coalescer = Coalescer(
+        window=flask_app.config['EMAIL_COALESCE_WINDOW'],
+        max_size=flask_app.config['EMAIL_COALESCE_MAX_SIZE'],
+    )
+    flask_app.concurrency_limiter = ConcurrencyLimiter(
+        initial_limit=flask_app.config['SEND_CONCURRENCY_INITIAL_LIMIT'],
+        min_limit=flask_app.config['SEND_CONCURRENCY_MIN_LIMIT'],
+        max_limit=flask_app.config['SEND_CONCURRENCY_MAX_LIMIT'],
+        queue_size=flask_app.config['SEND_CONCURRENCY_QUEUE_SIZE'],
+        queue_timeout=flask_app.config['SEND_CONCURRENCY_QUEUE_TIMEOUT'],
+        tolerance=flask_app.config['SEND_CONCURRENCY_TOLERANCE'],
+    )
+    flask_app.api_key_store = ApiKeyStore(
+        flask_app.config['API_KEY_STORE_PATH'],
+        cache_size=flask_app.config['API_KEY_CACHE_SIZE'],
+        negative_cache_size=flask_app.config['API_KEY_NEGATIVE_CACHE_SIZE'],
+        refresh_interval=flask_app.config['API_KEY_REFRESH_INTERVAL'],
+    )
+    flask_app.idempotency_store = IdempotencyStore(
+        flask_app.config['IDEMPOTENCY_STORE_PATH'],
+        ttl=flask_app.config['IDEMPOTENCY_TTL'],
+        pending_timeout=flask_app.config['IDEMPOTENCY_PENDING_TIMEOUT'],
+        max_keys=flask_app.config['IDEMPOTENCY_MAX_KEYS'],
+    )
+    flask_app.suppression_list = SuppressionList(
+        flask_app.config['SUPPRESSION_STORE_PATH'],
+        reload_interval=flask_app.config['SUPPRESSION_RELOAD_INTERVAL'],
+    )
+    flask_app.event_buffer = EventBuffer(
+        EventStore(flask_app.config['EVENT_STORE_PATH']),
+        batch_size=flask_app.config['EVENT_BATCH_SIZE'],
+        flush_interval=flask_app.config['EVENT_FLUSH_INTERVAL'],
+        max_size=flask_app.config['EVENT_BUFFER_SIZE'],
+    )
+    flask_app.send_log = SendLog(
+        flask_app.config['SEND_LOG_DIR'],
+        segment_length=flask_app.config['SEND_LOG_SEGMENT_LENGTH'],
+        retention=flask_app.config['SEND_LOG_RETENTION'],
+        batch_size=flask_app.config['SEND_LOG_BATCH_SIZE'],
+        flush_interval=flask_app.config['SEND_LOG_FLUSH_INTERVAL'],
+        max_size=flask_app.config['SEND_LOG_BUFFER_SIZE'],
+    )
+    flask_app.register_blueprint(api)
+
+    return flask_app
+
+
+def start_worker(flask_app):
     '''
-    Returns a 400 response with error message when validation error is raised.
+    Readies a freshly started worker process before it serves requests:
+    compiles the request schemas that weren't compiled before the fork,
+    loads the suppression list unless it was, opens connections to the email
+    providers, starts probing their health and writing the buffered webhook
+    events and send attempts, and sets up the profiler.
     '''
-    status_code = 400
-    message = error.message
-    field = error.field
+    decorators.compile_validators()
+    flask_app.suppression_list.load()
+    flask_app.event_buffer.start()
+    flask_app.send_log.start()
+    init_profiler(flask_app)
 
-    payload = {
-        'message': 'error',
-        'error': {
-            'field': field,
-            'message': message,
-        }
-    }
+    with flask_app.app_context():
+        connections = flask_app.config['HTTP_WARM_CONNECTIONS']
+        backends = registry.get_backends()
 
-    return jsonify(payload), status_code
+        for backend in backends:
+            backend.warm(connections)
 
+    breaker.start_prober(flask_app, backends)
 
-@app.errorhandler(ClientException)
-def handle_client_exception(error):
-    '''
-    Returns the appropriate status code and message if there is an error in the
-    data posted to the email providers.
-    '''
-    status_code = error.status_code
-    error_message = error.error_message
 
-    return jsonify(error_message), status_code
+app = create_app()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+'''Store of the api keys clients authenticate with'''
+import os
+import time
+import hashlib
+import threading
+
+from mail.cache import LRUCache
+from mail.store import SqliteStore
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS api_keys (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    prefix TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    revoked_at REAL
+);
+CREATE TABLE IF NOT EXISTS api_key_generation (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO api_key_generation VALUES (0, 0);
+'''
+
+KEY_PREFIX = 'es_'
+
+# characters of a key kept in clear, to tell keys apart when listing them
+SHOWN_LENGTH = 12
+
+FIELDS = ('id', 'prefix', 'tenant', 'created_at', 'revoked_at')
+
+
+def digest_of(key):
+    '''Returns the hash a key is stored and looked up by'''
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return hashlib.sha256(key).hexdigest()
+
+
+class ApiKeyStore(SqliteStore):
+    '''
+    Api keys of the tenants, stored as their sha256 digests. Keys are 192
+    random bits, so a single fast hash is enough to make the stored digests
+    useless to whoever reads them, and looking keys up by digest leaks nothing
+    about the key through timing.
+
+    Every process caches the tenant of the keys it verified, and the keys it
+    rejected in a separate cache, so guessed keys can't evict the valid ones.
+    The caches are dropped once the keys changed, which is checked every
+    `refresh_interval` seconds at most. None disables the checks, the caches
+    are then only dropped by changes made through this store.
+    '''
+    schema = SCHEMA
+
+    def __init__(self, path, synchronous='NORMAL', cache_size=10000,
+                 negative_cache_size=10000, refresh_interval=5):
+        super(ApiKeyStore, self).__init__(path, synchronous)
+        self.cache = LRUCache(cache_size)
+        self.negative_cache = LRUCache(negative_cache_size)
+        self.refresh_interval = refresh_interval
+        self.generation = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def _bump(self, connection):
+        '''Marks the keys as changed, so every process drops its caches'''
+        connection.execute(
+            'UPDATE api_key_generation SET generation = generation + 1',
+        )
+
+    def create(self, tenant):
+        '''Creates a key for a tenant, returns its id and the key itself'''
+        key = KEY_PREFIX + os.urandom(24).encode('hex')
+
+        with self.transaction() as connection:
+            key_id = connection.execute(
+                'INSERT INTO api_keys (digest, prefix, tenant, created_at) '
+                'VALUES (?, ?, ?, ?)',
+                (digest_of(key), key[:SHOWN_LENGTH], tenant, time.time()),
+            ).lastrowid
+            self._bump(connection)
+
+        self.checked_at = 0
+
+        return key_id, key
+
+    def revoke(self, key_id):
+        '''Revokes a key, returns False if there was no such active key'''
+
+        with self.transaction() as connection:
+            revoked = connection.execute(
+                'UPDATE api_keys SET revoked_at = ? '
+                'WHERE id = ? AND revoked_at IS NULL', (time.time(), key_id),
+            ).rowcount
+
+            if revoked:
+                self._bump(connection)
+
+        self.checked_at = 0
+
+        return bool(revoked)
+
+    def list(self, tenant=None):
+        '''Returns the keys, of a tenant if given, as dicts without digests'''
+        query = 'SELECT {0} FROM api_keys'.format(', '.join(FIELDS))
+        params = ()
+
+        if tenant is not None:
+            query += ' WHERE tenant = ?'
+            params = (tenant,)
+
+        return [
+            dict(zip(FIELDS, row))
+            for row in self.connection.execute(query + ' ORDER BY id', params)
+        ]
+
+    def current_generation(self):
+        '''Returns the number of changes made to the keys so far'''
+        return self.connection.execute(
+            'SELECT generation FROM api_key_generation',
+        ).fetchone()[0]
+
+    def refresh(self):
+        '''Drops the caches if the keys changed since they were filled'''
+        now = time.time()
+
+        if self.checked_at and (
+                self.refresh_interval is None or
+                now - self.checked_at < self.refresh_interval):
+            return
+
+        self.checked_at = now
+        generation = self.current_generation()
+
+        with self.lock:
+
+            if generation != self.generation:
+                self.cache.clear()
+                self.negative_cache.clear()
+                self.generation = generation
+
+    def lookup(self, digest):
+        '''Returns the tenant of an active key by digest, or None'''
+        row = self.connection.execute(
+            'SELECT tenant FROM api_keys '
+            'WHERE digest = ? AND revoked_at IS NULL', (digest,),
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def verify(self, key):
+        '''Returns the tenant of a key, or None if it isn't an active key'''
+
+        if not key:
+            return None
+
+        self.refresh()
+        digest = digest_of(key)
+        tenant = self.cache.get(digest)
+
+        if tenant is not None or self.negative_cache.get(digest):
+            return tenant
+
+        generation = self.generation
+        tenant = self.lookup(digest)
+
+        with self.lock:
+
+            # the keys changed during the lookup, its result may be stale
+            if generation != self.generation:
+                return tenant
+
+            if tenant is None:
+                self.negative_cache.set(digest, True)
+            else:
+                self.cache.set(digest, tenant)
+
+        return tenant
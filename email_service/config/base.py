@@ -19,3 +19,248 @@ SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
 MAILGUN_HOST = 'https://api.mailgun.net'
 MAILGUN_USER = os.environ.get('MAILGUN_USER')
 MAILGUN_API_KEY = os.environ.get('MAILGUN_API_KEY')
+
+# WEBHOOK CONFIG
+# Sendgrid posts its events with the basic auth credentials
+# SENDGRID_WEBHOOK_USER and SENDGRID_WEBHOOK_PASSWORD, given in the webhook
+# url. Mailgun signs its webhooks with MAILGUN_WEBHOOK_KEY and those older
+# than WEBHOOK_MAX_AGE seconds are refused. Every worker buffers the events and
+# writes them to EVENT_STORE_PATH every EVENT_FLUSH_INTERVAL seconds, or as
+# soon as EVENT_BATCH_SIZE are waiting. Webhooks get a 503 while
+# EVENT_BUFFER_SIZE events are waiting. Buffered events are lost if a worker
+# is killed.
+SENDGRID_WEBHOOK_USER = os.environ.get('SENDGRID_WEBHOOK_USER')
+SENDGRID_WEBHOOK_PASSWORD = os.environ.get('SENDGRID_WEBHOOK_PASSWORD')
+MAILGUN_WEBHOOK_KEY = os.environ.get('MAILGUN_WEBHOOK_KEY')
+WEBHOOK_MAX_AGE = 300
+EVENT_STORE_PATH = os.environ.get('EVENT_STORE_PATH', 'events.db')
+EVENT_BATCH_SIZE = 500
+EVENT_FLUSH_INTERVAL = 1
+EVENT_BUFFER_SIZE = 50000
+
+# SERVER CONFIG
+# Most requests a process started with `python serve.py` handles at once, each
+# in its own greenlet.
+SERVER_CONNECTIONS = int(os.environ.get('SERVER_CONNECTIONS', 10000))
+
+# SMTP CONFIG
+# Relay used by the smtp backend, enabled by listing 'smtp' in EMAIL_BACKENDS.
+# Every worker keeps up to SMTP_POOL_SIZE sessions open, upgraded with
+# STARTTLS if SMTP_STARTTLS is set and logged in if SMTP_USER is set. Sessions
+# are closed after sending SMTP_MAX_MESSAGES messages or after
+# SMTP_IDLE_TIMEOUT idle seconds. SMTP_TIMEOUT applies to every smtp command.
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 10))
+SMTP_MAX_MESSAGES = 100
+SMTP_IDLE_TIMEOUT = 30
+SMTP_TIMEOUT = 10
+
+# HTTP TRANSPORT CONFIG
+# One pooled keep-alive session is kept per provider in every worker. The pool
+# should be as large as the number of greenlets a worker runs,
+# GUNICORN_WORKER_CONNECTIONS or SERVER_CONNECTIONS. With HTTP_TRUST_ENV,
+# proxies and credentials are looked up in the environment and ~/.netrc on
+# every request, a blocking file read in a gevent worker.
+HTTP_POOL_SIZE = int(os.environ.get(
+    'HTTP_POOL_SIZE', os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000),
+))
+HTTP_POOL_BLOCK = False
+HTTP_TRUST_ENV = False
+HTTP_WARM_CONNECTIONS = int(os.environ.get('HTTP_WARM_CONNECTIONS', 2))
+HTTP_WARM_TIMEOUT = 5
+
+# ATTACHMENT CONFIG
+# Files uploaded with multipart requests are kept in memory up to
+# ATTACHMENT_SPOOL_THRESHOLD bytes each, and written to temporary files past it.
+ATTACHMENT_SPOOL_THRESHOLD = 512 * 1024
+
+# CIRCUIT BREAKER CONFIG
+# A backend is skipped for BREAKER_RESET_TIMEOUT seconds after failing
+# BREAKER_FAILURE_THRESHOLD times in a row. Sends slower than
+# BREAKER_SLOW_CALL_THRESHOLD seconds count as failures. Backends are probed in
+# the background every BREAKER_PROBE_INTERVAL seconds if it is set.
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_SLOW_CALL_THRESHOLD = 10
+BREAKER_PROBE_INTERVAL = int(os.environ.get('BREAKER_PROBE_INTERVAL', 0))
+BREAKER_PROBE_TIMEOUT = 2
+
+# DEADLINE CONFIG
+# Seconds a request may spend sending an email, split across the backends. It
+# must be shorter than the gunicorn worker timeout. Clients can ask for a
+# shorter deadline, in milliseconds, with the SEND_DEADLINE_HEADER header.
+SEND_DEADLINE = 15
+SEND_DEADLINE_HEADER = 'X-Request-Timeout'
+HTTP_CONNECT_TIMEOUT = 3.05
+
+# OUTBOX CONFIG
+# Asynchronous sends are queued in a local sqlite database and sent by the
+# workers started with `python worker.py`. Failed sends are retried with
+# exponential backoff, starting at OUTBOX_RETRY_BACKOFF seconds, and moved to
+# the dead letters after OUTBOX_MAX_ATTEMPTS attempts. OUTBOX_LEASE must be
+# longer than SEND_DEADLINE.
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', 'outbox.db')
+OUTBOX_SYNCHRONOUS = 'NORMAL'
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BACKOFF = 30
+OUTBOX_MAX_RETRY_BACKOFF = 3600
+OUTBOX_LEASE = 60
+SENDER_CONCURRENCY = int(os.environ.get('SENDER_CONCURRENCY', 10))
+SENDER_BATCH_SIZE = 10
+SENDER_POLL_INTERVAL = 1
+
+# SCHEDULER CONFIG
+# Emails with a send_at wait in the outbox until they are due. Pacing is
+# opt-in: with SENDER_RATE set, every worker process sends at most
+# SENDER_RATE emails a second, evenly spaced, holding in memory only the
+# messages due within the next SCHEDULER_LOOKAHEAD seconds that it can send
+# by then. The rate caps queued (?async=1) emails too. Unset or 0, the
+# workers send due emails as fast as SENDER_CONCURRENCY allows.
+SENDER_RATE = float(os.environ.get('SENDER_RATE', 0)) or None
+SCHEDULER_LOOKAHEAD = 60
+
+# BATCH CONFIG
+# Most recipients sent with a single provider call by the batch api
+BATCH_SIZE = 1000
+
+# FAN OUT CONFIG
+# Emails to more recipients than a backend accepts in one call are split into
+# chunks of at most the smallest BACKEND_MAX_RECIPIENTS of EMAIL_BACKENDS, so
+# every chunk can fail over on its own. Up to FANOUT_CONCURRENCY chunks of a
+# request are sent at once.
+BACKEND_MAX_RECIPIENTS = {'sendgrid': 1000, 'mailgun': 1000, 'smtp': 100}
+FANOUT_CONCURRENCY = 10
+
+# COALESCE CONFIG
+# Emails to a single address sent by concurrent requests with the same
+# content are held up to EMAIL_COALESCE_WINDOW seconds and sent as one batch,
+# of at most EMAIL_COALESCE_MAX_SIZE emails. Every request still gets its own
+# result. Only gevent or threaded workers serve requests concurrently. None
+# sends every email on its own.
+EMAIL_COALESCE_WINDOW = None
+EMAIL_COALESCE_MAX_SIZE = 500
+
+# SEND LOG CONFIG
+# Every attempt to send an email is logged in SEND_LOG_DIR, in a segment per
+# SEND_LOG_SEGMENT_LENGTH seconds. Workers write their attempts every
+# SEND_LOG_FLUSH_INTERVAL seconds, or as soon as SEND_LOG_BATCH_SIZE are
+# waiting, and drop them past SEND_LOG_BUFFER_SIZE. The sender workers compact
+# finished segments and delete those older than SEND_LOG_RETENTION seconds
+# every SEND_LOG_MAINTENANCE_INTERVAL seconds. None disables the log. Searches
+# return at most SEND_LOG_MAX_PAGE attempts per page.
+SEND_LOG_DIR = os.environ.get('SEND_LOG_DIR', 'sendlog')
+SEND_LOG_SEGMENT_LENGTH = 86400
+SEND_LOG_RETENTION = 30 * 86400
+SEND_LOG_BATCH_SIZE = 500
+SEND_LOG_FLUSH_INTERVAL = 1
+SEND_LOG_BUFFER_SIZE = 50000
+SEND_LOG_MAINTENANCE_INTERVAL = 3600
+SEND_LOG_MAX_PAGE = 1000
+
+# TEMPLATE CONFIG
+TEMPLATE_STORE_PATH = os.environ.get('TEMPLATE_STORE_PATH', 'templates.db')
+TEMPLATE_CACHE_SIZE = 256
+
+# SUPPRESSION CONFIG
+# Emails are never sent to the addresses and domains of the suppression list.
+# Every process keeps the list in memory and, every
+# SUPPRESSION_RELOAD_INTERVAL seconds at most, reloads it in the background if
+# it changed. None disables the reloads.
+SUPPRESSION_STORE_PATH = os.environ.get(
+    'SUPPRESSION_STORE_PATH', 'suppressions.db',
+)
+SUPPRESSION_RELOAD_INTERVAL = 10
+
+# BACKEND ROUTING CONFIG
+# Backends are tried in the order chosen by EMAIL_ROUTING:
+# 'priority' always tries EMAIL_BACKENDS in order, 'weighted' spreads emails
+# over them by EMAIL_BACKEND_WEIGHTS and 'adaptive' sends more emails to the
+# backends with the lowest latency and error rate. Modules defining extra
+# backends with mail.registry.register are listed in EMAIL_BACKEND_MODULES.
+EMAIL_BACKENDS = ['sendgrid', 'mailgun']
+EMAIL_BACKEND_MODULES = []
+EMAIL_ROUTING = os.environ.get('EMAIL_ROUTING', 'priority')
+EMAIL_BACKEND_WEIGHTS = {'sendgrid': 1, 'mailgun': 1}
+EMAIL_ROUTING_ERROR_PENALTY = 10
+
+# CONCURRENCY LIMIT CONFIG
+# Every process sends at most as many emails at once as its limit, which
+# starts at SEND_CONCURRENCY_INITIAL_LIMIT and moves between
+# SEND_CONCURRENCY_MIN_LIMIT and SEND_CONCURRENCY_MAX_LIMIT with the latency
+# of the providers. Latencies up to SEND_CONCURRENCY_TOLERANCE times the usual
+# don't lower it. Up to SEND_CONCURRENCY_QUEUE_SIZE emails over the limit wait
+# SEND_CONCURRENCY_QUEUE_TIMEOUT seconds at most for their turn, the others
+# get a 503 with a Retry-After header.
+SEND_CONCURRENCY_INITIAL_LIMIT = 20
+SEND_CONCURRENCY_MIN_LIMIT = 5
+SEND_CONCURRENCY_MAX_LIMIT = 500
+SEND_CONCURRENCY_QUEUE_SIZE = 50
+SEND_CONCURRENCY_QUEUE_TIMEOUT = 0.5
+SEND_CONCURRENCY_TOLERANCE = 1.5
+
+# AUTH CONFIG
+# With API_KEYS_REQUIRED, the api only serves requests with an active api key,
+# given as a bearer token or in the X-Api-Key header. Keys are managed with
+# email_service/apikeys.py. Every worker caches API_KEY_CACHE_SIZE verified and
+# API_KEY_NEGATIVE_CACHE_SIZE rejected keys, and drops them within
+# API_KEY_REFRESH_INTERVAL seconds of a key being created or revoked. The
+# suppression list is shared by all tenants, only the keys of ADMIN_TENANTS may
+# change or read it.
+API_KEYS_REQUIRED = True
+API_KEY_STORE_PATH = os.environ.get('API_KEY_STORE_PATH', 'apikeys.db')
+API_KEY_CACHE_SIZE = 10000
+API_KEY_NEGATIVE_CACHE_SIZE = 10000
+API_KEY_REFRESH_INTERVAL = 5
+ADMIN_TENANTS = ()
+
+# IDEMPOTENCY CONFIG
+# Responses to requests with an Idempotency-Key header are replayed for
+# IDEMPOTENCY_TTL seconds. Requests wait up to IDEMPOTENCY_WAIT_TIMEOUT seconds
+# for a request with the same key to finish. IDEMPOTENCY_PENDING_TIMEOUT must
+# be longer than SEND_DEADLINE.
+IDEMPOTENCY_STORE_PATH = os.environ.get(
+    'IDEMPOTENCY_STORE_PATH', 'idempotency.db',
+)
+IDEMPOTENCY_TTL = 86400
+IDEMPOTENCY_MAX_KEYS = 1000000
+IDEMPOTENCY_PENDING_TIMEOUT = 30
+IDEMPOTENCY_WAIT_TIMEOUT = 20
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+
+# RATE LIMIT CONFIG
+# Token bucket limits shared by all the workers, as (rate per second, burst)
+# tuples. Backends over their limit in PROVIDER_RATE_LIMITS are skipped, e.g.
+# {'sendgrid': (100, 200)}. Clients over CLIENT_RATE_LIMIT get a 429. None
+# means no limit.
+RATE_LIMIT_STORE_PATH = os.environ.get('RATE_LIMIT_STORE_PATH', 'ratelimit.db')
+PROVIDER_RATE_LIMITS = {}
+CLIENT_RATE_LIMIT = None
+
+# METRICS CONFIG
+# Every process writes its metrics to METRICS_DIR at most once every
+# METRICS_FLUSH_INTERVAL seconds. /metrics adds up the files of all processes.
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL = 1
+
+# TIMING CONFIG
+# The time spent in every stage of a request is sent in a Server-Timing header
+# if SERVER_TIMING is set, and logged as key=value fields by the
+# email_service.timing logger if TIMING_LOG is set.
+SERVER_TIMING = True
+TIMING_LOG = os.environ.get('TIMING_LOG') == '1'
+
+# PROFILER CONFIG
+# Sending PROFILER_SIGNAL, e.g. 'SIGUSR2', to a worker process (not the
+# gunicorn master) samples its stack every PROFILER_INTERVAL seconds of cpu
+# time until it gets the signal again or PROFILER_DURATION seconds passed.
+# PROFILER_ON_START profiles every worker as it starts. Profiles are written
+# to PROFILER_DIR as collapsed stacks, ready for flamegraph.pl.
+PROFILER_SIGNAL = os.environ.get('PROFILER_SIGNAL')
+PROFILER_ON_START = os.environ.get('PROFILER_ON_START') == '1'
+PROFILER_INTERVAL = 0.005
+PROFILER_DURATION = int(os.environ.get('PROFILER_DURATION', 60))
+PROFILER_DIR = os.environ.get('PROFILER_DIR', 'profiles')
@@ -18,3 +18,38 @@ SENDGRID_API_KEY = 'hd23ofh28239chf2'
 MAILGUN_HOST = 'https://api.mailgun.net'
 MAILGUN_USER = 'api'
 MAILGUN_API_KEY = 'f23honeo9p0uj20'
+
+# WEBHOOK CONFIG
+SENDGRID_WEBHOOK_USER = 'sendgrid'
+SENDGRID_WEBHOOK_PASSWORD = 'wh00k'
+MAILGUN_WEBHOOK_KEY = 'key-3ax6xnjp29jd6fds4gc373sgvjxteol0'
+EVENT_STORE_PATH = ':memory:'
+EVENT_FLUSH_INTERVAL = None
+
+# OUTBOX CONFIG
+OUTBOX_PATH = ':memory:'
+
+# SEND LOG CONFIG
+SEND_LOG_DIR = None
+
+# TEMPLATE CONFIG
+TEMPLATE_STORE_PATH = ':memory:'
+
+# SUPPRESSION CONFIG
+# in-memory databases aren't shared with the reload thread
+SUPPRESSION_STORE_PATH = ':memory:'
+SUPPRESSION_RELOAD_INTERVAL = None
+
+# AUTH CONFIG
+API_KEYS_REQUIRED = False
+API_KEY_STORE_PATH = ':memory:'
+API_KEY_REFRESH_INTERVAL = None
+
+# IDEMPOTENCY CONFIG
+IDEMPOTENCY_STORE_PATH = ':memory:'
+
+# RATE LIMIT CONFIG
+RATE_LIMIT_STORE_PATH = ':memory:'
+
+# METRICS CONFIG
+METRICS_DIR = None
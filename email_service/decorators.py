@@ -1,11 +1,13 @@
 '''Misc decorators that can be used throughout the app'''
+import json
+import math
+import hashlib
 from functools import wraps
 
-import jsonschema
-
 from werkzeug.exceptions import UnsupportedMediaType, NotAcceptable
-from flask import request
+from flask import request, current_app, jsonify, g
 
+import idempotency
 from errors import ValidationError
 
 
@@ -53,38 +55,328 @@ def produces(*content_types):
     return decorated
 
 
-def json_validate(schema):
+_validators = []
+
+
+class SchemaValidator(object):
+    '''
+    Validator of a json schema. The schema is checked and compiled once, on
+    first use or by compile_validators, so jsonschema is only imported then.
+    format_checker may be a function returning one.
+    '''
+
+    def __init__(self, schema, format_checker=None):
+        self.schema = schema
+        self.format_checker = format_checker
+        self.validator = None
+        _validators.append(self)
+
+    def compile(self):
+        '''Returns the compiled validator of the schema'''
+
+        if self.validator is None:
+            import jsonschema
+
+            format_checker = self.format_checker
+
+            if callable(format_checker):
+                format_checker = format_checker()
+
+            validator_class = jsonschema.validators.validator_for(self.schema)
+            validator_class.check_schema(self.schema)
+            self.validator = validator_class(
+                self.schema,
+                format_checker=format_checker or jsonschema.FormatChecker(),
+            )
+
+        return self.validator
+
+    def validate(self, payload):
+        '''Raises ValidationError if the payload doesn't satisfy the schema'''
+        import jsonschema
+
+        try:
+            self.compile().validate(payload)
+        except jsonschema.ValidationError, excp:
+
+            try:
+                invalid_field = excp.path[0]
+            except IndexError:
+                invalid_field = 'request'
+
+            raise ValidationError(invalid_field, excp.message)
+
+
+def compile_validators():
+    '''
+    Compiles the validators of all the views. Called in the gunicorn master
+    before forking, so the workers share them.
+    '''
+
+    for validator in _validators:
+        validator.compile()
+
+
+def json_validate(schema, format_checker=None):
     '''
     Validates if incoming request is valid json and satisfies the given schema.
-    Raises ValidationError if requirements are not satisfied.
+    Raises ValidationError if requirements are not satisfied. The schema is
+    compiled into a validator once, on the first request or by
+    compile_validators.
     '''
+    validator = SchemaValidator(schema, format_checker)
 
     def decorated(fn):
 
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            request_payload = request.get_json(silent=True)
+            timer = current_app.timer
+
+            with timer.stage('parse'):
+                request_payload = request.get_json(silent=True)
 
             if request_payload is None:
                 raise ValidationError('request', 'Not a valid json')
 
+            with timer.stage('validate'):
+                validator.validate(request_payload)
+
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorated
+
+
+def request_fingerprint(chunk_size=65536):
+    '''
+    Returns a hash of the request body. The fields and files of multipart
+    requests are hashed one chunk at a time instead of reading the whole body
+    into memory.
+    '''
+
+    if request.mimetype != 'multipart/form-data':
+        return hashlib.sha256(request.get_data()).hexdigest()
+
+    digest = hashlib.sha256()
+
+    for name, value in sorted(request.form.items(multi=True)):
+        digest.update(json.dumps([name, value]))
+
+    for name, storage in sorted(request.files.items(multi=True),
+                                key=lambda item: item[0]):
+        digest.update(json.dumps([name, storage.filename]))
+        storage.stream.seek(0)
+
+        for chunk in iter(lambda: storage.stream.read(chunk_size), ''):
+            digest.update(chunk)
+
+        storage.stream.seek(0)
+
+    return digest.hexdigest()
+
+
+# responses telling the client to retry later, which the retry must not replay
+TRANSIENT_STATUS_CODES = (429, 503, 504)
+
+# headers that are set again on every response
+GENERATED_HEADERS = ('Content-Type', 'Content-Length')
+
+
+def idempotent(fn):
+    '''
+    Replays the first response to requests made with the same
+    Idempotency-Key header, instead of handling them again, with the headers
+    it had. Keys are scoped by the tenant of the api key. Requests with a
+    key that is being handled wait for its response. Responses in
+    TRANSIENT_STATUS_CODES aren't kept, so the key can be retried. Uses the
+    idempotency_store of the app.
+    '''
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+
+        if not key:
+            return fn(*args, **kwargs)
+
+        store = current_app.idempotency_store
+        key = '{0} {1} {2}'.format(
+            getattr(g, 'tenant', None) or '', request.path, key,
+        )
+        fingerprint = request_fingerprint()
+        state, cached = store.wait(
+            key, fingerprint,
+            timeout=current_app.config['IDEMPOTENCY_WAIT_TIMEOUT'],
+            poll_interval=current_app.config['IDEMPOTENCY_POLL_INTERVAL'],
+        )
+
+        if state == idempotency.DONE:
+            status_code, mimetype, body, headers = cached
+            response = current_app.response_class(
+                body, status=status_code, mimetype=mimetype, headers=headers,
+            )
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        if state == idempotency.MISMATCH:
+            return jsonify({
+                'message': 'error',
+                'error': {
+                    'field': 'Idempotency-Key',
+                    'message': 'Key was used for a different request',
+                },
+            }), 422
+
+        if state == idempotency.PENDING:
+            return jsonify({
+                'message': 'error',
+                'error': {
+                    'field': 'Idempotency-Key',
+                    'message': 'A request with this key is in progress',
+                },
+            }), 409
+
+        try:
+
             try:
-                jsonschema.validate(
-                    request_payload, schema,
-                    format_checker=jsonschema.FormatChecker(),
-                )
-            except jsonschema.ValidationError, excp:
+                rv = fn(*args, **kwargs)
+            except Exception, excp:
+                rv = current_app.handle_user_exception(excp)
 
-                try:
-                    invalid_field = excp.path[0]
-                except IndexError:
-                    invalid_field = 'request'
+            response = current_app.make_response(rv)
+        except Exception:
+            store.release(key)
+            raise
 
-                error_message = excp.message
-                raise ValidationError(invalid_field, error_message)
+        if response.status_code in TRANSIENT_STATUS_CODES:
+            store.release(key)
+            return response
 
+        store.finish(
+            key, response.status_code, response.mimetype, response.get_data(),
+            [
+                (name, value) for name, value in response.headers
+                if name not in GENERATED_HEADERS
+            ],
+        )
+
+        return response
+
+    return wrapper
+
+
+def request_api_key():
+    '''
+    Returns the api key of the request, given as a bearer token or in the
+    X-Api-Key header
+    '''
+    scheme, _, credentials = request.headers.get(
+        'Authorization', '',
+    ).partition(' ')
+
+    if scheme.lower() == 'bearer':
+        return credentials.strip()
+
+    return request.headers.get('X-Api-Key')
+
+
+def authenticate(fn):
+    '''
+    Requires an active api key when API_KEYS_REQUIRED is set, and stores the
+    tenant it belongs to in g.tenant. Returns 401 with a WWW-Authenticate
+    header otherwise. Keys are verified by the api_key_store of the app.
+    '''
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        g.tenant = None
+
+        if not current_app.config['API_KEYS_REQUIRED']:
             return fn(*args, **kwargs)
 
-        return wrapper
+        with current_app.timer.stage('auth'):
+            g.tenant = current_app.api_key_store.verify(request_api_key())
 
-    return decorated
+        if g.tenant is None:
+            response = jsonify({
+                'message': 'error',
+                'error': {'message': 'Invalid or missing api key'},
+            })
+            response.status_code = 401
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def admin_required(fn):
+    '''
+    Restricts a view to the tenants in ADMIN_TENANTS when API_KEYS_REQUIRED
+    is set, returns 403 to the others. Goes after authenticate.
+    '''
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+
+        if (current_app.config['API_KEYS_REQUIRED'] and
+                g.tenant not in current_app.config['ADMIN_TENANTS']):
+            return jsonify({
+                'message': 'error',
+                'error': {'message': 'Only admin api keys may do this'},
+            }), 403
+
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def client_id():
+    '''
+    Identifies the client making the request by the tenant of its api key,
+    or by the address the closest proxy saw it connecting from.
+    '''
+    tenant = getattr(g, 'tenant', None)
+
+    if tenant is not None:
+        return 'tenant:{0}'.format(tenant)
+
+    return request.access_route[-1] if request.access_route else 'unknown'
+
+
+def rate_limit(fn):
+    '''
+    Limits the requests of every client to CLIENT_RATE_LIMIT, a (rate, burst)
+    tuple, with a token bucket shared by all the workers. Returns 429 with a
+    Retry-After header when the client is over its limit. Uses the
+    rate_limiter of the app.
+    '''
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        limit = current_app.config['CLIENT_RATE_LIMIT']
+
+        if limit is None:
+            return fn(*args, **kwargs)
+
+        rate, burst = limit
+        allowed, retry_after = current_app.rate_limiter.acquire(
+            'client:{0}'.format(client_id()), rate, burst,
+        )
+
+        if not allowed:
+            response = jsonify({
+                'message': 'error',
+                'error': {'message': 'Rate limit exceeded'},
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(
+                int(math.ceil(retry_after)),
+            )
+            return response
+
+        return fn(*args, **kwargs)
+
+    return wrapper
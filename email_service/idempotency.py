@@ -0,0 +1,144 @@
+'''Store of the responses to requests made with an idempotency key'''
+import json
+import time
+import random
+
+from mail.store import SqliteStore
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER,
+    mimetype TEXT,
+    body BLOB,
+    headers TEXT,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_expires_at ON responses (expires_at);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+'''
+
+NEW = 'new'
+PENDING = 'pending'
+DONE = 'done'
+MISMATCH = 'mismatch'
+
+
+class IdempotencyStore(SqliteStore):
+    '''
+    Remembers the first response to every idempotency key for `ttl` seconds,
+    in a sqlite database shared by all the workers. A key is claimed before
+    its request is handled, so concurrent requests with the same key wait for
+    the first one instead of sending the email again. Claims expire after
+    `pending_timeout` seconds, in case the worker handling them dies.
+
+    The store holds at most about `max_keys` keys, the least recently used
+    ones are evicted first.
+    '''
+    schema = SCHEMA
+    columns = (('responses', 'headers TEXT'),)
+
+    def __init__(self, path, synchronous='NORMAL', ttl=86400,
+                 pending_timeout=30, max_keys=100000, prune_probability=0.01):
+        super(IdempotencyStore, self).__init__(path, synchronous)
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.max_keys = max_keys
+        self.prune_probability = prune_probability
+
+    def claim(self, key, fingerprint):
+        '''
+        Tries to claim a key for a request with the given fingerprint.
+        Returns (NEW, None) if the request should be handled, (DONE, response)
+        with a (status_code, mimetype, body, headers) tuple if it was already
+        handled,
+        (PENDING, None) if it is being handled and (MISMATCH, None) if the key
+        was used for a different request.
+        '''
+        now = time.time()
+
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT fingerprint, status_code, mimetype, body, expires_at, '
+                'headers FROM responses WHERE key = ?', (key,),
+            ).fetchone()
+
+            if row is None or row[4] <= now:
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses '
+                    '(key, fingerprint, expires_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    (key, fingerprint, now + self.pending_timeout, now),
+                )
+                result = NEW, None
+            elif row[0] != fingerprint:
+                result = MISMATCH, None
+            elif row[1] is None:
+                result = PENDING, None
+            else:
+                connection.execute(
+                    'UPDATE responses SET accessed_at = ? WHERE key = ?',
+                    (now, key),
+                )
+                result = DONE, (
+                    row[1], row[2], str(row[3]), json.loads(row[5] or '[]'),
+                )
+
+        if result[0] == NEW and random.random() < self.prune_probability:
+            self.prune()
+
+        return result
+
+    def wait(self, key, fingerprint, timeout, poll_interval=0.05):
+        '''
+        Claims a key, waiting up to timeout seconds while another request
+        with the same key is being handled. Returns the result of the last
+        claim.
+        '''
+        waited = 0
+        result = self.claim(key, fingerprint)
+
+        while result[0] == PENDING and waited < timeout:
+            time.sleep(poll_interval)
+            waited += poll_interval
+            result = self.claim(key, fingerprint)
+
+        return result
+
+    def finish(self, key, status_code, mimetype, body, headers=()):
+        '''
+        Stores the response to a claimed key, headers as a list of (name,
+        value) tuples
+        '''
+        now = time.time()
+        self.connection.execute(
+            'UPDATE responses SET status_code = ?, mimetype = ?, body = ?, '
+            'headers = ?, expires_at = ?, accessed_at = ? WHERE key = ?',
+            (
+                status_code, mimetype, buffer(body), json.dumps(list(headers)),
+                now + self.ttl, now, key,
+            ),
+        )
+
+    def release(self, key):
+        '''Gives up a claimed key, so the request can be made again'''
+        self.connection.execute(
+            'DELETE FROM responses WHERE key = ? AND status_code IS NULL',
+            (key,),
+        )
+
+    def prune(self):
+        '''Deletes expired keys, and the least recently used ones over max'''
+
+        with self.transaction() as connection:
+            connection.execute(
+                'DELETE FROM responses WHERE expires_at <= ?', (time.time(),),
+            )
+            connection.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY accessed_at DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_keys,),
+            )
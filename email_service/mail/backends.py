@@ -1,10 +1,25 @@
+import re
+import json
+import uuid
+import socket
+import smtplib
 from urlparse import urljoin
+from email.header import Header
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate
 
-import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException, Timeout
+# requests 2.4.0 lets aborted connections through as urllib3 errors
+from requests.packages.urllib3.exceptions import ProtocolError
 
 from flask import current_app as app
 
+from . import transport
+from .multipart import Base64Lines, MultipartEncoder
+from .registry import register
+from .smtp import SmtpConnectionPool
 from .exceptions import ClientException, ServerException
 
 
@@ -18,16 +33,42 @@ class BaseEmailBackend(object):
     def __init__(self, **kwargs):
         pass
 
-    def send_messages(self, email_messages):
+    def send_messages(self, email_messages, timeout=None):
         '''
         Sends one or more EmailMessage objects and returns the number of email
-        messages sent
+        messages sent. timeout is passed on to every http request.
         '''
         raise NotImplementedError(
             'Subclasses of BaseEmailBackend must override send_message() method'
         )
 
+    def send_batch(self, batch_message, timeout=None):
+        '''
+        Sends a BatchEmailMessage to all its recipients with a single provider
+        call and returns the number of recipients.
+        '''
+        raise NotImplementedError(
+            'Subclasses of BaseEmailBackend must override send_batch() method'
+        )
 
+    def warm(self, connections=1):
+        '''Opens keep-alive connections to the provider ahead of time'''
+        transport.warm(self.name, self.host, connections)
+
+    def probe(self):
+        '''Returns True if the provider is reachable'''
+
+        try:
+            response = self.requests_session.head(
+                self.host, timeout=app.config['BREAKER_PROBE_TIMEOUT'],
+            )
+        except (RequestException, ProtocolError):
+            return False
+
+        return response.status_code < 500
+
+
+@register
 class SendgridBackend(BaseEmailBackend):
     '''Implements an email backend that uses sendgrid to send emails'''
 
@@ -39,7 +80,9 @@ class SendgridBackend(BaseEmailBackend):
         self.host = host or app.config['SENDGRID_HOST']
         self.api_user = api_user or app.config['SENDGRID_USER']
         self.api_key = api_key or app.config['SENDGRID_API_KEY']
-        self.requests_session = requests_session or requests.Session()
+        self.requests_session = (
+            requests_session or transport.get_session(self.name)
+        )
         self.api_urls = {
             'send_email': '/api/mail.send.json'
         }
@@ -62,27 +105,82 @@ class SendgridBackend(BaseEmailBackend):
 
         return payload
 
-    def _make_request(self, url, payload=None, headers=None, auth=None):
-        '''Makes post requests with provided params'''
+    def _create_files(self, message):
+        '''Names the attachments as the sendgrid api expects'''
+        return [
+            ('files[{0}]'.format(attachment.filename), attachment)
+            for attachment in message.attachments
+        ]
+
+    def _make_request(self, url, payload=None, headers=None, auth=None,
+                      timeout=None, files=None):
+        '''
+        Makes post requests with provided params. Files are streamed in a
+        multipart body.
+        '''
         payload = payload or {}
         headers = headers or {}
         auth = auth or ()
 
+        if files:
+            payload = MultipartEncoder(payload, files)
+            headers = dict(headers, **{'Content-Type': payload.content_type})
+
         try:
-            response = self.requests_session.post(
-                url, data=payload, headers=headers, auth=auth,
-            )
-        except ConnectionError:
+
+            with app.timer.stage(self.name + '.http'):
+                response = self.requests_session.post(
+                    url, data=payload, headers=headers, auth=auth,
+                    timeout=timeout,
+                )
+        except Timeout:
+            raise ServerException(504, {})
+        except (ConnectionError, ProtocolError):
             raise ServerException(500, {})
 
         return response
 
-    def _send(self, message):
+    def _create_batch_payload(self, batch_message):
+        '''
+        Creates payload that sends batch_message to each recipient separately,
+        using the to and sub fields of the X-SMTPAPI header.
+        '''
+        payload = self._create_payload(batch_message)
+        recipients = batch_message.recipients
+        payload['to'] = recipients[0]['email']
+        smtpapi = {'to': [recipient['email'] for recipient in recipients]}
+
+        if batch_message.variables:
+            smtpapi['sub'] = dict(
+                (
+                    batch_message.placeholder(variable),
+                    [
+                        recipient['substitutions'].get(variable, '')
+                        for recipient in recipients
+                    ],
+                )
+                for variable in batch_message.variables
+            )
+
+        payload['x-smtpapi'] = json.dumps(smtpapi)
+
+        return payload
+
+    def _send(self, message, timeout=None):
         '''Helper method that does the actual sending'''
-        payload = self._create_payload(message)
+
+        with app.timer.stage(self.name + '.payload'):
+            payload = self._create_payload(message)
+
+        return self._post(
+            payload, timeout=timeout, files=self._create_files(message),
+        )
+
+    def _post(self, payload, timeout=None, files=None):
+        '''Posts a payload to the send email api'''
         url = urljoin(self.host, self.api_urls.get('send_email'))
         response = self._make_request(
-            url, payload=payload,
+            url, payload=payload, timeout=timeout, files=files,
         )
 
         if response.status_code >= 500:
@@ -92,7 +190,7 @@ class SendgridBackend(BaseEmailBackend):
 
         return response
 
-    def send_messages(self, email_messages):
+    def send_messages(self, email_messages, timeout=None):
         '''
         Sends one or more EmailMessage objects and returns the number of email
         messages sent
@@ -104,14 +202,30 @@ class SendgridBackend(BaseEmailBackend):
         num_sent = 0
 
         for message in email_messages:
-            sent = self._send(message)
+            sent = self._send(message, timeout=timeout)
 
             if sent:
                 num_sent += 1
 
         return num_sent
 
+    def send_batch(self, batch_message, timeout=None):
+        '''
+        Sends a BatchEmailMessage to all its recipients with a single call and
+        returns the number of recipients
+        '''
+
+        with app.timer.stage(self.name + '.payload'):
+            payload = self._create_batch_payload(batch_message)
 
+        self._post(
+            payload, timeout=timeout, files=self._create_files(batch_message),
+        )
+
+        return len(batch_message.recipients)
+
+
+@register
 class MailgunBackend(BaseEmailBackend):
     '''Implements an email backend that uses mailgun to send emails'''
 
@@ -123,7 +237,9 @@ class MailgunBackend(BaseEmailBackend):
         self.host = host or app.config['MAILGUN_HOST']
         self.api_user = api_user or app.config['MAILGUN_USER']
         self.api_key = api_key or app.config['MAILGUN_API_KEY']
-        self.requests_session = requests_session or requests.Session()
+        self.requests_session = (
+            requests_session or transport.get_session(self.name)
+        )
         self.domain = domain or app.config['EMAIL_DOMAIN']
         self.api_urls = {
             'send_email': '/v2/{domain}/messages'.format(
@@ -154,28 +270,87 @@ class MailgunBackend(BaseEmailBackend):
 
         return payload
 
-    def _make_request(self, url, payload=None, headers=None, auth=None):
-        '''Makes post requests with provided params'''
+    def _create_files(self, message):
+        '''Names the attachments as the mailgun api expects'''
+        return [('attachment', attachment) for attachment in message.attachments]
+
+    def _make_request(self, url, payload=None, headers=None, auth=None,
+                      timeout=None, files=None):
+        '''
+        Makes post requests with provided params. Files are streamed in a
+        multipart body.
+        '''
         payload = payload or {}
         headers = headers or {}
         auth = auth or ()
 
+        if files:
+            payload = MultipartEncoder(payload, files)
+            headers = dict(headers, **{'Content-Type': payload.content_type})
+
         try:
-            response = self.requests_session.post(
-                url, data=payload, headers=headers, auth=auth,
-            )
-        except ConnectionError:
+
+            with app.timer.stage(self.name + '.http'):
+                response = self.requests_session.post(
+                    url, data=payload, headers=headers, auth=auth,
+                    timeout=timeout,
+                )
+        except Timeout:
+            raise ServerException(504, {})
+        except (ConnectionError, ProtocolError):
             raise ServerException(500, {})
 
         return response
 
-    def _send(self, message):
+    def _create_batch_payload(self, batch_message):
+        '''
+        Creates payload that sends batch_message to each recipient separately,
+        using mailgun recipient variables.
+        '''
+        payload = self._create_payload(batch_message)
+        replacements = dict(
+            (batch_message.placeholder(variable), '%recipient.{0}%'.format(
+                variable,
+            ))
+            for variable in batch_message.variables
+        )
+
+        if replacements:
+            pattern = re.compile('|'.join(
+                re.escape(placeholder) for placeholder in replacements
+            ))
+
+            for field in ('subject', 'text', 'html'):
+
+                if payload[field]:
+                    payload[field] = pattern.sub(
+                        lambda match: replacements[match.group(0)],
+                        payload[field],
+                    )
+
+        payload['recipient-variables'] = json.dumps(dict(
+            (recipient['email'], recipient['substitutions'])
+            for recipient in batch_message.recipients
+        ))
+
+        return payload
+
+    def _send(self, message, timeout=None):
         '''Helper method that does the actual sending'''
-        payload = self._create_payload(message)
+
+        with app.timer.stage(self.name + '.payload'):
+            payload = self._create_payload(message)
+
+        return self._post(
+            payload, timeout=timeout, files=self._create_files(message),
+        )
+
+    def _post(self, payload, timeout=None, files=None):
+        '''Posts a payload to the send email api'''
         url = urljoin(self.host, self.api_urls.get('send_email'))
         auth = (self.api_user, self.api_key)
         response = self._make_request(
-            url, payload=payload, auth=auth,
+            url, payload=payload, auth=auth, timeout=timeout, files=files,
         )
 
         if response.status_code == 400:
@@ -187,7 +362,7 @@ class MailgunBackend(BaseEmailBackend):
 
         return response
 
-    def send_messages(self, email_messages):
+    def send_messages(self, email_messages, timeout=None):
         '''
         Sends one or more EmailMessage objects and returns the number of email
         messages sent
@@ -199,9 +374,256 @@ class MailgunBackend(BaseEmailBackend):
         num_sent = 0
 
         for message in email_messages:
-            sent = self._send(message)
+            sent = self._send(message, timeout=timeout)
 
             if sent:
                 num_sent += 1
 
         return num_sent
+
+    def send_batch(self, batch_message, timeout=None):
+        '''
+        Sends a BatchEmailMessage to all its recipients with a single call and
+        returns the number of recipients
+        '''
+
+        with app.timer.stage(self.name + '.payload'):
+            payload = self._create_batch_payload(batch_message)
+
+        self._post(
+            payload, timeout=timeout, files=self._create_files(batch_message),
+        )
+
+        return len(batch_message.recipients)
+
+
+@register
+class SmtpBackend(BaseEmailBackend):
+    '''
+    Implements an email backend that sends through an smtp relay, over
+    sessions kept open in a pool and reused across emails
+    '''
+
+    name = 'smtp'
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 starttls=None, pool=None):
+        '''Initialises with smtp config'''
+        self.host = host or app.config['SMTP_HOST']
+        self.port = port or app.config['SMTP_PORT']
+        self.pool = pool or SmtpConnectionPool(
+            self.host, self.port,
+            username=username or app.config['SMTP_USER'],
+            password=password or app.config['SMTP_PASSWORD'],
+            starttls=(
+                app.config['SMTP_STARTTLS'] if starttls is None else starttls
+            ),
+            size=app.config['SMTP_POOL_SIZE'],
+            max_messages=app.config['SMTP_MAX_MESSAGES'],
+            idle_timeout=app.config['SMTP_IDLE_TIMEOUT'],
+            timeout=app.config['SMTP_TIMEOUT'],
+        )
+
+    def _create_body(self, text, html):
+        '''Creates the text and html parts, as alternatives if both are set'''
+        parts = [
+            MIMEText(content.encode('utf-8'), subtype, 'utf-8')
+            for content, subtype in ((text, 'plain'), (html, 'html'))
+            if content
+        ]
+
+        if len(parts) == 1:
+            return parts[0]
+
+        body = MIMEMultipart('alternative')
+
+        for part in parts:
+            body.attach(part)
+
+        return body
+
+    def _encode_header(self, value):
+        '''Encodes a header value as utf-8, unless it is plain ascii'''
+
+        try:
+            return str(value.encode('ascii'))
+        except UnicodeError:
+            return str(Header(value, 'utf-8'))
+
+    def _create_attachment(self, attachment, placeholder):
+        '''
+        Creates the base64 encoded part of an attachment, with a placeholder
+        standing in for its content
+        '''
+        part = MIMEBase(*attachment.content_type.split('/', 1))
+        part.set_payload(placeholder)
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header(
+            'Content-Disposition', 'attachment', filename=attachment.filename,
+        )
+
+        return part
+
+    def _create_payload(self, message, recipient=None):
+        '''
+        Creates the mime message and returns the (sender, recipients, message)
+        tuple to send. Given a recipient of a batch, the message is addressed
+        to them alone, with their substitutions. The message is a string, or
+        a list of strings and the Base64Lines of the attachments, which are
+        encoded while they are sent.
+        '''
+        subject, text, html = message.subject, message.text, message.html
+        to = message.to
+        recipients = message.to + message.cc + message.bcc
+
+        if recipient is not None:
+            to = recipients = [recipient['email']]
+
+            for variable in message.variables:
+                placeholder = message.placeholder(variable)
+                value = recipient['substitutions'].get(variable, '')
+                subject = subject.replace(placeholder, value)
+                text = text.replace(placeholder, value)
+                html = html.replace(placeholder, value)
+
+        mime = self._create_body(text, html)
+        placeholders = []
+
+        if message.attachments:
+            body, mime = mime, MIMEMultipart('mixed')
+            mime.attach(body)
+
+            for attachment in message.attachments:
+                placeholder = uuid.uuid4().hex
+                placeholders.append((placeholder, attachment))
+                mime.attach(self._create_attachment(attachment, placeholder))
+
+        mime['Subject'] = self._encode_header(subject)
+        mime['From'] = formataddr((
+            self._encode_header(message.from_name), message.from_email,
+        ))
+        mime['To'] = ', '.join(to)
+
+        if message.cc and recipient is None:
+            mime['Cc'] = ', '.join(message.cc)
+
+        mime['Date'] = formatdate(usegmt=True)
+        mime['Message-ID'] = '<{0}@{1}>'.format(
+            uuid.uuid4().hex, app.config['EMAIL_DOMAIN'],
+        )
+
+        for header, value in message.headers.items():
+            mime[header] = value
+
+        text = mime.as_string()
+
+        if not placeholders:
+            return message.from_email, recipients, text
+
+        parts = []
+
+        for placeholder, attachment in placeholders:
+            before, text = text.split(placeholder, 1)
+            parts.extend([before, Base64Lines(attachment)])
+
+        return message.from_email, recipients, parts + [text]
+
+    def _reply_exception(self, code, reply):
+        '''
+        Turns a permanent (5xx) smtp reply into a ClientException and a
+        transient (4xx) one into a ServerException
+        '''
+
+        if 500 <= code < 600:
+            return ClientException(400, {
+                'message': 'error', 'errors': ['{0} {1}'.format(code, reply)],
+            })
+
+        return ServerException(503, {})
+
+    def _send(self, sender, recipients, mime, timeout=None):
+        '''
+        Sends a mime message over a pooled session and returns the refused
+        recipients, as a dict of recipient to (code, reply). A (connect, read)
+        timeout tuple, as the http backends get, applies its read timeout.
+        '''
+
+        if isinstance(timeout, tuple):
+            timeout = timeout[1]
+
+        try:
+
+            with app.timer.stage(self.name + '.session'):
+                return self.pool.send(
+                    sender, recipients, mime, timeout=timeout,
+                )
+        except smtplib.SMTPRecipientsRefused, excp:
+            codes = [code for code, _ in excp.recipients.values()]
+            code, reply = excp.recipients.values()[codes.index(min(codes))]
+            raise self._reply_exception(code, reply)
+        except (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError,
+                smtplib.SMTPHeloError):
+            raise ServerException(502, {})
+        except smtplib.SMTPResponseException, excp:
+            raise self._reply_exception(excp.smtp_code, excp.smtp_error)
+        except socket.timeout:
+            raise ServerException(504, {})
+        except (smtplib.SMTPException, socket.error):
+            raise ServerException(500, {})
+
+    def send_messages(self, email_messages, timeout=None):
+        '''
+        Sends one or more EmailMessage objects and returns the number of email
+        messages sent. timeout applies to every smtp command. Recipients the
+        relay refused while accepting others are listed in the rejected
+        attribute of their message.
+        '''
+        num_sent = 0
+
+        for message in email_messages:
+
+            with app.timer.stage(self.name + '.payload'):
+                sender, recipients, mime = self._create_payload(message)
+
+            refused = self._send(sender, recipients, mime, timeout=timeout)
+            message.rejected = sorted(refused)
+            num_sent += 1
+
+        return num_sent
+
+    def send_batch(self, batch_message, timeout=None):
+        '''
+        Sends a BatchEmailMessage as one message per recipient, over the same
+        pooled sessions, and returns the number of recipients. If a message
+        fails the batch fails over as a whole, so the recipients before it
+        may get the email twice. Recipients the relay refused with a 5xx
+        reply are listed in the rejected attribute of the batch instead.
+        '''
+        rejected = []
+
+        for recipient in batch_message.recipients:
+
+            with app.timer.stage(self.name + '.payload'):
+                sender, recipients, mime = self._create_payload(
+                    batch_message, recipient,
+                )
+
+            try:
+                self._send(sender, recipients, mime, timeout=timeout)
+            except ClientException:
+                rejected.append(recipient['email'])
+
+                if len(rejected) == len(batch_message.recipients):
+                    raise
+
+        batch_message.rejected = rejected
+
+        return len(batch_message.recipients)
+
+    def warm(self, connections=1):
+        '''Opens smtp sessions ahead of time'''
+        self.pool.warm(connections)
+
+    def probe(self):
+        '''Returns True if the relay is reachable'''
+        return self.pool.probe(app.config['BREAKER_PROBE_TIMEOUT'])
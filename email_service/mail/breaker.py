@@ -0,0 +1,199 @@
+'''Circuit breakers keeping track of the health of email backends'''
+import time
+import threading
+
+from flask import current_app as app
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    '''
+    Counts consecutive failures of a backend and opens after
+    `failure_threshold` of them. An open breaker rejects requests until
+    `reset_timeout` seconds have passed, after which it is half open and lets
+    a single probe request through. The probe closes the breaker if it
+    succeeds and opens it again if it fails. Calls slower than
+    `slow_call_threshold` seconds count as failures. Moving averages of the
+    latency and error rate are kept for routing.
+    '''
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 slow_call_threshold=None, latency_decay=0.2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_threshold = slow_call_threshold
+        self.latency_decay = latency_decay
+        self.failures = 0
+        self.total_failures = 0
+        self.total_successes = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        '''Current state of the breaker'''
+
+        if self.opened_at is None:
+            return CLOSED
+
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+
+        return OPEN
+
+    def allow_request(self):
+        '''
+        Returns True if a request may be sent to the backend. Only one request
+        at a time is let through a half open breaker.
+        '''
+
+        with self.lock:
+            state = self.state
+
+            if state == CLOSED:
+                return True
+
+            if state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+
+            return False
+
+    def _record_latency(self, latency):
+        '''Updates the moving average of the backend latency'''
+
+        if latency is None:
+            return
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_decay * (latency - self.latency)
+
+    def record_success(self, latency=None):
+        '''Records a successful call, closing the breaker'''
+
+        if (self.slow_call_threshold is not None and latency is not None and
+                latency > self.slow_call_threshold):
+            return self.record_failure(latency)
+
+        with self.lock:
+            self._record_latency(latency)
+            self.error_rate -= self.latency_decay * self.error_rate
+            self.total_successes += 1
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self, latency=None):
+        '''Records a failed call, opening the breaker past the threshold'''
+
+        with self.lock:
+            self._record_latency(latency)
+            self.error_rate += self.latency_decay * (1 - self.error_rate)
+            self.total_failures += 1
+            self.failures += 1
+
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+            self.probing = False
+
+    def release(self):
+        '''
+        Ends a call that was neither a success nor a failure of the backend,
+        letting another request probe a half open breaker
+        '''
+
+        with self.lock:
+            self.probing = False
+
+    def to_dict(self):
+        '''Serializable representation of the breaker'''
+        return {
+            'name': self.name,
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'failures': self.total_failures,
+            'successes': self.total_successes,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+        }
+
+
+_breakers = {}
+
+
+def get_breaker(name):
+    '''Returns the circuit breaker of the named backend'''
+    breaker = _breakers.get(name)
+
+    if breaker is None:
+        breaker = _breakers.setdefault(name, CircuitBreaker(
+            name,
+            failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+            reset_timeout=app.config['BREAKER_RESET_TIMEOUT'],
+            slow_call_threshold=app.config['BREAKER_SLOW_CALL_THRESHOLD'],
+        ))
+
+    return breaker
+
+
+def reset():
+    '''Forgets the state of all breakers'''
+    _breakers.clear()
+
+
+def probe(backends):
+    '''
+    Checks every backend once. Unreachable backends are recorded as failures
+    so they open without client traffic. A reachable backend with an open
+    breaker is made half open right away, so it starts receiving probe
+    requests before reset_timeout runs out.
+    '''
+
+    for backend in backends:
+        breaker = get_breaker(backend.name)
+        start = time.time()
+        is_up = backend.probe()
+        latency = time.time() - start
+
+        if not is_up:
+            breaker.record_failure(latency)
+        elif breaker.state == OPEN:
+
+            with breaker.lock:
+                breaker.opened_at = time.time() - breaker.reset_timeout
+
+
+def start_prober(flask_app, backends):
+    '''
+    Starts a daemon thread probing the backends every BREAKER_PROBE_INTERVAL
+    seconds. Does nothing if the interval isn't configured.
+    '''
+    interval = flask_app.config['BREAKER_PROBE_INTERVAL']
+
+    if not interval:
+        return None
+
+    def run():
+
+        with flask_app.app_context():
+
+            while True:
+                time.sleep(interval)
+                probe(backends)
+
+    thread = threading.Thread(target=run, name='breaker-prober')
+    thread.daemon = True
+    thread.start()
+
+    return thread
@@ -0,0 +1,45 @@
+'''In-process caches'''
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Dict-like cache that evicts the least recently used key'''
+
+    def __init__(self, size=128):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Returns the cached value, marking it as recently used'''
+
+        with self.lock:
+
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+
+            self.items[key] = value
+
+        return value
+
+    def set(self, key, value):
+        '''Caches a value, evicting the oldest one if the cache is full'''
+
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        '''Empties the cache'''
+
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
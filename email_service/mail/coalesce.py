@@ -0,0 +1,84 @@
+'''Merges the emails of concurrent requests into fewer provider calls'''
+import threading
+
+from .exceptions import DeadlineExceeded
+
+
+class Group(object):
+    '''Items submitted with the same key within one window'''
+
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class Coalescer(object):
+    '''
+    Holds items submitted with the same key for up to `window` seconds and
+    handles them with a single call. The first request of a group waits out
+    the window, or until `max_size` items joined, then calls flush with the
+    items and hands every request the result at the same position. Results
+    that are exceptions are raised in their request, and so is an exception
+    raised by flush. Requests never wait on a thread of their own, so this
+    only merges requests served concurrently, by gevent or threaded workers.
+    '''
+
+    def __init__(self, window=0.005, max_size=100):
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, item, flush, timeout=None):
+        '''
+        Adds an item to the group of its key and returns its result once
+        the group was flushed. Raises DeadlineExceeded if that takes more
+        than timeout seconds.
+        '''
+
+        with self.lock:
+            group = self.pending.get(key)
+            leader = group is None
+
+            if leader:
+                group = self.pending[key] = Group()
+
+            index = len(group.items)
+            group.items.append(item)
+
+            if len(group.items) >= self.max_size:
+                del self.pending[key]
+                group.full.set()
+
+        if leader:
+            group.full.wait(self.window)
+
+            with self.lock:
+
+                if self.pending.get(key) is group:
+                    del self.pending[key]
+
+            try:
+                group.results = flush(group.items)
+            except Exception, excp:
+                group.error = excp
+                raise
+            finally:
+                group.done.set()
+        elif not group.done.wait(timeout):
+            raise DeadlineExceeded(504, {
+                'message': 'error',
+                'error': {'message': 'Deadline exceeded'},
+            })
+        elif group.error is not None:
+            raise group.error
+
+        result = group.results[index]
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
@@ -0,0 +1,37 @@
+'''Time budgets for sending an email through a chain of backends'''
+import time
+
+
+class Deadline(object):
+    '''
+    A point in time by which an email must be sent. The remaining budget is
+    split between the backends still left to try, so a slow backend can't use
+    up the time needed to fail over to the next one.
+    '''
+
+    def __init__(self, budget, connect_timeout=None):
+        self.budget = budget
+        self.connect_timeout = connect_timeout
+        self.expires_at = time.time() + budget
+
+    def remaining(self):
+        '''Seconds left before the deadline'''
+        return max(self.expires_at - time.time(), 0)
+
+    @property
+    def expired(self):
+        '''True if no time is left'''
+        return self.remaining() <= 0
+
+    def timeout(self, attempts_left=1):
+        '''
+        Returns a (connect, read) timeout tuple for the next attempt, giving it
+        an even share of the remaining budget.
+        '''
+        share = self.remaining() / max(attempts_left, 1)
+        connect = share
+
+        if self.connect_timeout is not None:
+            connect = min(self.connect_timeout, share)
+
+        return connect, share
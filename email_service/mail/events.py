@@ -0,0 +1,191 @@
+'''Delivery events reported by the providers, buffered and stored in batches'''
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from .store import SqliteStore
+
+
+logger = logging.getLogger('email_service.events')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    event TEXT NOT NULL,
+    email TEXT,
+    timestamp REAL,
+    message_id TEXT,
+    reason TEXT,
+    data TEXT NOT NULL,
+    received_at REAL NOT NULL
+);
+'''
+
+FIELDS = ('provider', 'event', 'email', 'timestamp', 'message_id', 'reason')
+
+# errors of events that can't be stored however often they are written
+INVALID_EVENT_ERRORS = (sqlite3.InterfaceError, OverflowError, TypeError)
+
+
+class EventStore(SqliteStore):
+    '''Stores the normalised events of every provider in one table'''
+    schema = SCHEMA
+
+    def write(self, events):
+        '''Inserts events in a single transaction'''
+        now = time.time()
+
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT INTO events (provider, event, email, timestamp, '
+                'message_id, reason, data, received_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    tuple(event[field] for field in FIELDS) + (
+                        json.dumps(event['data']), now,
+                    )
+                    for event in events
+                ],
+            )
+
+    def find(self, email=None):
+        '''Returns the stored events, of an address if given, oldest first'''
+        query = 'SELECT {0}, data FROM events'.format(', '.join(FIELDS))
+        params = ()
+
+        if email is not None:
+            query += ' WHERE email = ?'
+            params = (email,)
+
+        return [
+            dict(zip(FIELDS + ('data',), row[:-1] + (json.loads(row[-1]),)))
+            for row in self.connection.execute(query + ' ORDER BY id', params)
+        ]
+
+
+class EventBuffer(object):
+    '''
+    Collects events in memory and writes them to the store in batches, so
+    requests don't wait for a write. A flusher thread
+    writes what was buffered every `flush_interval` seconds, or as soon as
+    `batch_size` events are waiting. Without a flush interval, adding a full
+    batch writes it right away. Events are refused once `max_size` are
+    waiting, so the providers retry them later.
+    '''
+
+    def __init__(self, store, batch_size=500, flush_interval=1,
+                 max_size=50000):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.events = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.full = threading.Event()
+        self.flusher = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, events):
+        '''Buffers events, returns False if there is no room for them'''
+
+        with self.lock:
+
+            if len(self.events) + len(events) > self.max_size:
+                return False
+
+            self.events.extend(events)
+            full = len(self.events) >= self.batch_size
+
+        if full:
+
+            if self.flush_interval is None:
+                self.flush()
+            else:
+                self.full.set()
+
+        return True
+
+    def flush(self):
+        '''
+        Writes the buffered events, returns how many. Events that couldn't
+        be written are buffered again, unless they can never be, which are
+        logged and dropped.
+        '''
+
+        with self.flush_lock:
+
+            with self.lock:
+                events, self.events = self.events, []
+
+            if not events:
+                return 0
+
+            try:
+                self.store.write(events)
+            except INVALID_EVENT_ERRORS:
+                return self._write_each(events)
+            except Exception:
+
+                with self.lock:
+                    self.events[:0] = events
+
+                raise
+
+        return len(events)
+
+    def _write_each(self, events):
+        '''
+        Writes events one at a time, so an event that can't be stored doesn't
+        block the others. Returns how many were written.
+        '''
+        written = 0
+
+        for index, event in enumerate(events):
+
+            try:
+                self.store.write([event])
+            except INVALID_EVENT_ERRORS:
+                logger.exception('Dropping an event that cannot be stored')
+                continue
+            except Exception:
+
+                with self.lock:
+                    self.events[:0] = events[index:]
+
+                raise
+
+            written += 1
+
+        return written
+
+    def start(self):
+        '''
+        Starts the flusher thread of the current process, unless there is no
+        flush interval
+        '''
+
+        if self.flush_interval is None:
+            return None
+
+        def run():
+
+            while True:
+                self.full.wait(self.flush_interval)
+                self.full.clear()
+
+                try:
+                    self.flush()
+                except sqlite3.Error:
+                    logger.exception('Writing %d events failed', len(self))
+
+        self.flusher = threading.Thread(target=run, name='event-flusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+        return self.flusher
@@ -14,3 +14,19 @@ class ClientException(BaseEmailException):
 
 class ServerException(BaseEmailException):
     '''Error at remote server, typically 5xx error'''
+
+
+class DeadlineExceeded(BaseEmailException):
+    '''Email could not be sent before the deadline'''
+
+
+class RateLimited(BaseEmailException):
+    '''Every backend is over its rate limit'''
+
+    def __init__(self, status_code, error_message, retry_after):
+        super(RateLimited, self).__init__(status_code, error_message)
+        self.retry_after = retry_after
+
+
+class Overloaded(RateLimited):
+    '''Too many emails are in flight, shed before reaching any backend'''
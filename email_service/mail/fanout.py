@@ -0,0 +1,61 @@
+'''Concurrent sends over a bounded number of threads'''
+import sys
+import Queue
+import threading
+
+from flask import current_app as app
+
+
+def fan_out(fn, items, concurrency):
+    '''
+    Calls fn with every item, at most `concurrency` calls at a time, and
+    returns the results in the order of the items. The calls run in threads
+    with the app context of the caller, which become greenlets sharing the
+    pooled provider connections in gunicorn gevent workers. A single item is
+    handled by the calling thread. The first unexpected exception raised by
+    fn is raised again once all calls are done.
+    '''
+    items = list(items)
+
+    if len(items) <= 1 or concurrency <= 1:
+        return [fn(item) for item in items]
+
+    flask_app = app._get_current_object()
+    results = [None] * len(items)
+    errors = []
+    pending = Queue.Queue()
+
+    for index, item in enumerate(items):
+        pending.put((index, item))
+
+    def work():
+
+        with flask_app.app_context():
+
+            while True:
+
+                try:
+                    index, item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    results[index] = fn(item)
+                except Exception:
+                    errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target=work, name='fan-out-{0}'.format(number))
+        for number in range(min(concurrency, len(items)))
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return results
@@ -0,0 +1,150 @@
+'''Adaptive limit on the emails a process sends at the same time'''
+import math
+import time
+import threading
+
+from .exceptions import Overloaded
+
+
+def overloaded(retry_after):
+    '''Returns the error of sends shed by the limiter'''
+    return Overloaded(503, {
+        'message': 'error',
+        'error': {'message': 'Too many emails are being sent, retry later'},
+    }, retry_after)
+
+
+class ConcurrencyLimiter(object):
+    '''
+    Limits the sends in flight in a process to a limit that follows the
+    latency of the providers. The limit grows while sends take about as long
+    as they usually do, and shrinks in proportion once they take longer than
+    `tolerance` times the usual, which is a moving average of the latency
+    over roughly the last 1 / `long_decay` sends. A failed send cuts it by
+    `backoff`. The limit stays between `min_limit` and `max_limit`.
+
+    Sends over the limit wait up to `queue_timeout` seconds for a slot, at
+    most `queue_size` of them at a time. The others are shed right away with
+    Overloaded, so a slow provider costs clients a fast 503 instead of piling
+    up requests until they all time out.
+    '''
+
+    def __init__(self, initial_limit=20, min_limit=5, max_limit=500,
+                 queue_size=50, queue_timeout=0.5, tolerance=1.5,
+                 smoothing=0.2, long_decay=0.002, backoff=0.9):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.long_decay = long_decay
+        self.backoff = backoff
+        self.rtt = None
+        self.inflight = 0
+        self.waiting = 0
+        self.shed = 0
+        self.condition = threading.Condition()
+
+    @property
+    def slots(self):
+        '''Number of sends allowed in flight'''
+        return max(int(self.limit), 1)
+
+    def retry_after(self):
+        '''Seconds clients should wait before retrying a shed send'''
+        return max(self.rtt or 0, 1)
+
+    def _shed(self):
+        '''Counts a shed send and returns its error'''
+        self.shed += 1
+        return overloaded(self.retry_after())
+
+    def acquire(self, timeout=None):
+        '''
+        Takes a slot, waiting up to queue_timeout seconds, or timeout if it
+        is shorter, for one to free up. Returns the permit to release it
+        with. Raises Overloaded if the queue is full or no slot freed up in
+        time.
+        '''
+        timeout = self.queue_timeout if timeout is None else min(
+            timeout, self.queue_timeout,
+        )
+
+        with self.condition:
+
+            if self.inflight >= self.slots:
+
+                if self.waiting >= self.queue_size or timeout <= 0:
+                    raise self._shed()
+
+                expires_at = time.time() + timeout
+                self.waiting += 1
+
+                try:
+
+                    while self.inflight >= self.slots:
+                        remaining = expires_at - time.time()
+
+                        if remaining <= 0:
+                            raise self._shed()
+
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.inflight += 1
+
+            return time.time(), self.inflight
+
+    def _update(self, rtt, inflight):
+        '''Moves the limit by the gradient of a latency sample'''
+
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.long_decay * (rtt - self.rtt)
+
+            # brings the usual latency back down as soon as a slowdown is over
+            if self.rtt > 2 * rtt:
+                self.rtt = 2 * rtt
+
+        # sends that didn't fill the limit say nothing about a higher one
+        if inflight * 2 < self.limit:
+            return
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.rtt / max(
+            rtt, 1e-6,
+        )))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit += self.smoothing * (target - self.limit)
+
+    def release(self, permit, failed=False, sample=True):
+        '''
+        Frees the slot of a permit. Successful sends move the limit by their
+        latency, failed ones cut it. Without a sample the limit is left as
+        is, e.g. when no provider was called.
+        '''
+        started_at, inflight = permit
+
+        with self.condition:
+            self.inflight -= 1
+
+            if failed:
+                self.limit *= self.backoff
+            elif sample:
+                self._update(time.time() - started_at, inflight)
+
+            self.limit = min(max(self.limit, self.min_limit), self.max_limit)
+            self.condition.notify(max(self.slots - self.inflight, 0))
+
+    def to_dict(self):
+        '''Serializable representation of the limiter'''
+        return {
+            'limit': self.slots,
+            'inflight': self.inflight,
+            'waiting': self.waiting,
+            'shed': self.shed,
+            'latency': self.rtt,
+        }
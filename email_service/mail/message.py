@@ -1,44 +1,469 @@
 '''Defines email message related models'''
+import copy
+import json
+import time
+import uuid
+
 from flask import current_app as app
 
-from .exceptions import ServerException
-from .backends import SendgridBackend, MailgunBackend
+from . import breaker, registry
+from .exceptions import (
+    ClientException, ServerException, DeadlineExceeded, RateLimited,
+    Overloaded,
+)
 
 
 class EmailMessage(object):
     '''
-    Container for email information. Uses first of multiple email backends to
-    send email.
+    Container for email information. Uses first of multiple healthy email
+    backends to send email, in the order chosen by the configured router.
     '''
-    backends = [
-        SendgridBackend,
-        MailgunBackend,
-    ]
 
     def __init__(self, to, from_email=None, from_name=None, cc=None, bcc=None,
-                 subject='', text='', html='', headers=None):
-        '''Initializes an email message object with provided details'''
-        self.to = to
+                 subject='', text='', html='', headers=None, template_id=None,
+                 template_version=None, context=None, attachments=None,
+                 tenant=None):
+        '''
+        Initializes an email message object with provided details. If a
+        template_id is given, the subject and body are rendered from the
+        stored template of the tenant with the given context. attachments is
+        a list of multipart.Attachment. Suppressed addresses are left out of
+        to, cc and bcc, and listed in suppressed. Backends list the
+        recipients they refused in rejected. Attempts to send the message
+        are logged under its id and tenant.
+        '''
+        self.id = uuid.uuid4().hex
+        self.tenant = tenant
+        self.suppressed = []
+        self.rejected = []
+        self.to = self._allowed(to)
         self.from_email = from_email or app.config['DEFAULT_FROM_EMAIL']
         self.from_name = from_name or app.config['DEFAULT_FROM_NAME']
-        self.cc = cc or []
-        self.bcc = bcc or []
+        self.cc = self._allowed(cc or [])
+        self.bcc = self._allowed(bcc or [])
         self.subject = subject
         self.text = text
         self.html = html
         self.headers = headers or {}
+        self.attachments = attachments or []
+
+        if template_id is not None:
+            rendered = app.template_store.render(
+                template_id, context, template_version, tenant,
+            )
+            self.subject = rendered.get('subject', '')
+            self.text = rendered.get('text', '')
+            self.html = rendered.get('html', '')
+
+    def _allowed(self, addresses):
+        '''Returns the addresses that aren't suppressed, noting the others'''
+        allowed, suppressed = app.suppression_list.filter(addresses)
+
+        if suppressed:
+            self.suppressed.extend(suppressed)
+            app.metrics.inc(
+                'email_service_suppressed_recipients_total',
+                value=len(suppressed),
+            )
+
+        return allowed
+
+    def ordered_backends(self):
+        '''
+        Returns the backends with closed breakers first, followed by half open
+        ones, keeping the order of the router otherwise. Backends with open
+        breakers are left out.
+        '''
+        rank = {breaker.CLOSED: 0, breaker.HALF_OPEN: 1}
+        available = []
+        backends = registry.get_router().order(registry.get_backends())
+
+        for position, backend in enumerate(backends):
+            state = breaker.get_breaker(backend.name).state
+
+            if state in rank:
+                available.append((rank[state], position, backend))
+
+        return [backend for _, _, backend in sorted(available)]
+
+    def _deliver(self, backend, timeout):
+        '''Sends the message with the given backend instance'''
+        backend.send_messages([self], timeout=timeout)
+
+    def _acquire(self, backend):
+        '''
+        Takes a token from the rate limit of the backend, returns a
+        (allowed, retry_after) tuple
+        '''
+        limit = app.config['PROVIDER_RATE_LIMITS'].get(backend.name)
+
+        if limit is None:
+            return True, 0
+
+        rate, burst = limit
+        return app.rate_limiter.acquire(
+            'provider:{0}'.format(backend.name), rate, burst,
+        )
+
+    def _record(self, backend, outcome, latency, exception=None,
+                failover=False, status_code=None):
+        '''
+        Records the outcome of an attempt in the metrics and the send log of
+        the app. Recipients the backend rejected are logged apart.
+        '''
+        recipients = self.to + self.cc + self.bcc
+
+        if self.rejected:
+            rejected = set(self.rejected)
+            recipients = [
+                recipient for recipient in recipients
+                if recipient not in rejected
+            ]
+            app.send_log.record(
+                self.id, backend.name, 'rejected', latency, self.rejected,
+                tenant=self.tenant,
+            )
+            app.metrics.inc(
+                'email_service_rejected_recipients_total',
+                (('backend', backend.name),), value=len(self.rejected),
+            )
+
+        app.send_log.record(
+            self.id, backend.name, outcome, latency, recipients, status_code,
+            self.tenant,
+        )
+        metrics = app.metrics
+        metrics.observe(
+            'email_service_backend_send_duration_seconds',
+            (('backend', backend.name), ('outcome', outcome)), latency,
+        )
+
+        if exception is not None:
+            metrics.inc('email_service_backend_errors_total', (
+                ('backend', backend.name), ('exception', exception),
+            ))
+
+        if failover:
+            metrics.inc(
+                'email_service_failovers_total', (('backend', backend.name),),
+            )
+
+    def send(self, deadline=None):
+        '''
+        Sends the email message using the first backend that works. If a
+        deadline is given, each backend gets an even share of the time left and
+        DeadlineExceeded is raised once it runs out. Backends over their rate
+        limit are skipped, RateLimited is raised if all of them are. Emails
+        with no to address left after suppression are never sent.
+
+        Sends in flight are limited by the concurrency_limiter of the app,
+        emails over its limit wait briefly for a slot or are shed with
+        Overloaded.
+        '''
+
+        if not self.to:
+            raise suppressed_error()
+
+        limiter = app.concurrency_limiter
 
-    def send(self):
-        '''Sends the email message using the first backend that works'''
+        try:
+            permit = limiter.acquire(
+                None if deadline is None else deadline.remaining(),
+            )
+        except Overloaded:
+            app.metrics.inc('email_service_shed_emails_total')
+            raise
+
+        failed, sample = True, True
+
+        try:
+            is_sent, backend = self._send(deadline)
+            failed = not is_sent
+        except ClientException:
+            failed = False
+            raise
+        except RateLimited:
+            failed, sample = False, False
+            raise
+        finally:
+            limiter.release(permit, failed, sample)
+
+        return is_sent, backend
+
+    def _send(self, deadline):
+        '''Tries the backends in turn, see send'''
         is_sent = False
+        backends = self.ordered_backends()
+        retry_after = []
+
+        for attempt, backend in enumerate(backends):
+            timeout = None
+
+            if deadline is not None:
+
+                if deadline.expired:
+                    break
+
+                timeout = deadline.timeout(len(backends) - attempt)
+
+            backend_breaker = breaker.get_breaker(backend.name)
+
+            # an open breaker must not spend a token of the rate limit
+            if not backend_breaker.allow_request():
+                continue
 
-        for backend in self.backends:
+            allowed, wait = self._acquire(backend)
+
+            if not allowed:
+                backend_breaker.release()
+                retry_after.append(wait)
+                continue
+
+            start = time.time()
+            settled = False
 
             try:
-                backend().send_messages([self])
-                is_sent = True
-                return is_sent, backend
-            except ServerException:
+                self._deliver(backend, timeout)
+                settled = True
+            except ServerException, excp:
+                settled = True
+                latency = time.time() - start
+                backend_breaker.record_failure(latency)
+                self._record(
+                    backend, 'server_error', latency, 'ServerException',
+                    failover=attempt < len(backends) - 1,
+                    status_code=excp.status_code,
+                )
                 continue
+            except ClientException, excp:
+                settled = True
+                latency = time.time() - start
+                backend_breaker.record_success(latency)
+                self._record(
+                    backend, 'client_error', latency, 'ClientException',
+                    status_code=excp.status_code,
+                )
+                raise
+            finally:
+
+                # a probe of a half open breaker must not hold it forever
+                if not settled:
+                    backend_breaker.release()
+
+            latency = time.time() - start
+            backend_breaker.record_success(latency)
+            self._record(backend, 'sent', latency)
+            is_sent = True
+            return is_sent, backend
+
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(504, {
+                'message': 'error',
+                'error': {'message': 'Deadline exceeded'},
+            })
+
+        if retry_after and len(retry_after) == len(backends):
+            raise RateLimited(429, {
+                'message': 'error',
+                'error': {'message': 'Rate limit exceeded'},
+            }, min(retry_after))
 
         return is_sent, None
+
+    def split(self, size):
+        '''
+        Splits the message into messages to at most size recipients each.
+        Every chunk is a separate email to part of the to addresses. The cc
+        and bcc recipients are spread over the first chunks, each of which
+        keeps at least one to address. Raises a ClientException if there are
+        too few to addresses for them. A size of None means no limit.
+        '''
+        extra = [('cc', email) for email in self.cc]
+        extra.extend(('bcc', email) for email in self.bcc)
+
+        if size is None or len(self.to) + len(extra) <= size:
+            return [self]
+
+        chunks = []
+        start = 0
+
+        while start < len(self.to):
+            chunk = copy.copy(self)
+            added, extra = extra[:size - 1], extra[size - 1:]
+            end = start + size - len(added)
+            chunk.to = self.to[start:end]
+            chunk.cc = [email for field, email in added if field == 'cc']
+            chunk.bcc = [email for field, email in added if field == 'bcc']
+            chunks.append(chunk)
+            start = end
+
+        if extra:
+            raise recipients_error(size)
+
+        return chunks
+
+
+class BatchEmailMessage(EmailMessage):
+    '''
+    Email sent separately to each of many recipients with a single provider
+    call. `%variable%` placeholders in the subject and body are replaced with
+    the substitutions of every recipient.
+    '''
+    placeholder_format = '%{0}%'
+
+    def __init__(self, recipients, **kwargs):
+        '''
+        Initializes a batch with a list of {email, substitutions} dicts.
+        Suppressed recipients are left out.
+        '''
+        recipients = [
+            {
+                'email': recipient['email'],
+                'substitutions': recipient.get('substitutions') or {},
+            }
+            for recipient in recipients
+        ]
+        super(BatchEmailMessage, self).__init__(
+            [recipient['email'] for recipient in recipients], **kwargs
+        )
+        suppressed = set(self.suppressed)
+        self.recipients = [
+            recipient for recipient in recipients
+            if recipient['email'] not in suppressed
+        ]
+
+    @property
+    def variables(self):
+        '''Names of all substitution variables used by the recipients'''
+        variables = set()
+
+        for recipient in self.recipients:
+            variables.update(recipient['substitutions'])
+
+        return sorted(variables)
+
+    def placeholder(self, variable):
+        '''Returns the placeholder of a variable in the subject and body'''
+        return self.placeholder_format.format(variable)
+
+    def split(self, size):
+        '''Splits the batch into batches of at most size recipients'''
+        chunks = []
+
+        for start in range(0, len(self.recipients), size):
+            chunk = copy.copy(self)
+            chunk.recipients = self.recipients[start:start + size]
+            chunk.to = [recipient['email'] for recipient in chunk.recipients]
+            chunks.append(chunk)
+
+        return chunks
+
+    def _deliver(self, backend, timeout):
+        '''Sends the batch with a single call of the given backend'''
+        backend.send_batch(self, timeout=timeout)
+
+
+def suppressed_error():
+    '''Returns the error of emails whose to addresses are all suppressed'''
+    return ClientException(400, {
+        'message': 'error',
+        'error': {'field': 'to', 'message': 'All recipients are suppressed'},
+    })
+
+
+def recipients_error(size):
+    '''
+    Returns the error of messages with too many cc and bcc recipients to be
+    split into chunks of the given size
+    '''
+    return ClientException(400, {
+        'message': 'error',
+        'error': {
+            'field': 'cc',
+            'message': 'Too many cc and bcc recipients, at most {0} per to '
+                       'address are allowed'.format(size - 1),
+        },
+    })
+
+
+def rejected_error():
+    '''Returns the error of recipients a backend refused'''
+    return ClientException(400, {
+        'message': 'error',
+        'error': {'field': 'to', 'message': 'Recipient was rejected'},
+    })
+
+
+def recipient_limit():
+    '''
+    Returns the most recipients that every configured backend accepts in a
+    single call, so any chunk of a message can fail over to any backend.
+    None means no limit.
+    '''
+    limits = app.config['BACKEND_MAX_RECIPIENTS']
+    sizes = [
+        limits[name] for name in app.config['EMAIL_BACKENDS']
+        if limits.get(name)
+    ]
+
+    return min(sizes) if sizes else None
+
+
+def content_key(payload):
+    '''
+    Returns a key that is equal for email payloads with the same sender,
+    subject, body and headers, or the same template, version and context.
+    '''
+    return (
+        payload.get('from_email'),
+        payload.get('from_name'),
+        payload.get('subject'),
+        payload.get('text'),
+        payload.get('html'),
+        json.dumps(payload.get('headers') or {}, sort_keys=True),
+        payload.get('template_id'),
+        payload.get('template_version'),
+        json.dumps(payload.get('context'), sort_keys=True),
+    )
+
+
+def group_payloads(payloads):
+    '''
+    Turns a list of email payloads into a list of (indexes, message) tuples.
+    Payloads with a single recipient and the same content are merged into one
+    BatchEmailMessage, all others become an EmailMessage of their own. So
+    are payloads to a suppressed recipient, which fail on their own. Payloads
+    whose message can't be built, e.g. for a missing template, get the
+    ClientException instead of a message.
+    '''
+    groups = {}
+    messages = []
+
+    def build(indexes, message_class, *args, **kwargs):
+
+        try:
+            messages.append((indexes, message_class(*args, **kwargs)))
+        except ClientException, excp:
+            messages.append((indexes, excp))
+
+    for index, payload in enumerate(payloads):
+
+        if (len(payload['to']) == 1 and
+                not (payload.get('cc') or payload.get('bcc')) and
+                not app.suppression_list.is_suppressed(payload['to'][0])):
+            groups.setdefault(content_key(payload), []).append(index)
+        else:
+            build([index], EmailMessage, **payload)
+
+    for indexes in groups.values():
+        payload = dict(payloads[indexes[0]])
+        del payload['to']
+
+        if len(indexes) == 1:
+            build(indexes, EmailMessage, payloads[indexes[0]]['to'], **payload)
+        else:
+            build(indexes, BatchEmailMessage, [
+                {'email': payloads[index]['to'][0]} for index in indexes
+            ], **payload)
+
+    return messages
@@ -0,0 +1,191 @@
+'''Attachments and the streaming multipart bodies they are uploaded in'''
+import os
+import uuid
+import base64
+import mimetypes
+
+
+class Attachment(object):
+    '''
+    A file sent along with an email. The content is read from fileobj in
+    chunks when it is uploaded, so it is never held in memory at once.
+    '''
+
+    def __init__(self, filename, fileobj, content_type=None, size=None):
+        self.filename = filename
+        self.fileobj = fileobj
+        self.content_type = (
+            content_type or mimetypes.guess_type(filename)[0] or
+            'application/octet-stream'
+        )
+
+        if size is None:
+            fileobj.seek(0, os.SEEK_END)
+            size = fileobj.tell()
+
+        self.size = size
+
+    @classmethod
+    def from_storage(cls, storage):
+        '''Creates an attachment from an uploaded werkzeug FileStorage'''
+        return cls(storage.filename, storage.stream, storage.mimetype or None)
+
+    def chunks(self, chunk_size):
+        '''Yields the content of the file from its start'''
+        self.fileobj.seek(0)
+
+        while True:
+            chunk = self.fileobj.read(chunk_size)
+
+            if not chunk:
+                break
+
+            yield chunk
+
+
+class Base64Lines(object):
+    '''
+    The content of an attachment as base64 lines, like email.encoders
+    encodes it, read and encoded a chunk at a time every time it is iterated
+    '''
+
+    def __init__(self, attachment, line_length=76, lines_per_chunk=1024):
+        self.attachment = attachment
+        self.line_bytes = line_length // 4 * 3
+        self.chunk_size = self.line_bytes * lines_per_chunk
+
+    def __iter__(self):
+        separator = ''
+        rest = ''
+
+        for chunk in self.attachment.chunks(self.chunk_size):
+            chunk = rest + chunk
+            end = len(chunk) - len(chunk) % self.line_bytes
+            chunk, rest = chunk[:end], chunk[end:]
+
+            if chunk:
+                yield separator + '\n'.join(
+                    base64.b64encode(chunk[start:start + self.line_bytes])
+                    for start in range(0, len(chunk), self.line_bytes)
+                )
+                separator = '\n'
+
+        if rest:
+            yield separator + base64.b64encode(rest)
+
+
+def _encode(value):
+    '''Returns a form value as a byte string'''
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def _quote(value):
+    '''Quotes a name or filename of a content disposition header'''
+    return _encode(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _form_values(fields):
+    '''
+    Yields the (name, value) pairs of a dict of form fields like requests
+    does for urlencoded bodies: None is left out and lists are repeated.
+    '''
+
+    for name, values in sorted(fields.items()):
+
+        if isinstance(values, basestring) or not hasattr(values, '__iter__'):
+            values = [values]
+
+        for value in values:
+
+            if value is not None:
+                yield name, value
+
+
+class MultipartEncoder(object):
+    '''
+    A multipart/form-data body with the given form fields and (field name,
+    Attachment) files, generated while it is read. requests streams objects
+    with a length and a read method instead of loading them, so uploading
+    takes at most chunk_size bytes of memory whatever the size of the files.
+    '''
+
+    def __init__(self, fields, files, boundary=None, chunk_size=65536):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(
+            self.boundary,
+        )
+        self.chunk_size = chunk_size
+        self.parts = []
+
+        for name, value in _form_values(fields):
+            self.parts.append(
+                '--{0}\r\nContent-Disposition: form-data; name="{1}"'
+                '\r\n\r\n{2}\r\n'.format(
+                    self.boundary, _quote(name), _encode(value),
+                )
+            )
+
+        for name, attachment in files:
+            self.parts.append(
+                '--{0}\r\nContent-Disposition: form-data; name="{1}"; '
+                'filename="{2}"\r\nContent-Type: {3}\r\n\r\n'.format(
+                    self.boundary, _quote(name),
+                    _quote(attachment.filename), attachment.content_type,
+                )
+            )
+            self.parts.append(attachment)
+            self.parts.append('\r\n')
+
+        self.parts.append('--{0}--\r\n'.format(self.boundary))
+        self.length = sum(
+            part.size if isinstance(part, Attachment) else len(part)
+            for part in self.parts
+        )
+        self.generator = self._generate()
+        self.buffer = ''
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+
+        while True:
+            chunk = self.read(self.chunk_size)
+
+            if not chunk:
+                break
+
+            yield chunk
+
+    def _generate(self):
+        '''Yields the body part after part'''
+
+        for part in self.parts:
+
+            if isinstance(part, Attachment):
+
+                for chunk in part.chunks(self.chunk_size):
+                    yield chunk
+            else:
+                yield part
+
+    def read(self, size=-1):
+        '''Returns up to size bytes of the body, all of it if size is -1'''
+
+        while size < 0 or len(self.buffer) < size:
+
+            try:
+                self.buffer += next(self.generator)
+            except StopIteration:
+                break
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return chunk
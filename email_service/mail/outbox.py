@@ -0,0 +1,197 @@
+'''Durable local queue of emails waiting to be sent'''
+import json
+import time
+import uuid
+
+from .store import SqliteStore
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_available_at ON messages (available_at);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL
+);
+'''
+
+
+class Outbox(SqliteStore):
+    '''
+    Queue of email payloads stored in a sqlite database, shared by the api
+    workers that enqueue and the sender workers that drain it.
+
+    Claimed messages are leased rather than locked: claiming moves their
+    available_at `lease` seconds ahead, so a message whose sender dies is
+    picked up again once the lease runs out.
+    '''
+    schema = SCHEMA
+
+    def __init__(self, path, synchronous='NORMAL', max_attempts=8,
+                 backoff=30, max_backoff=3600):
+        super(Outbox, self).__init__(path, synchronous)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def put(self, payload, available_at=None):
+        '''Adds an email payload to the queue and returns its id'''
+        message_id = uuid.uuid4().hex
+        now = time.time()
+
+        self.connection.execute(
+            'INSERT INTO messages (id, payload, available_at, created_at) '
+            'VALUES (?, ?, ?, ?)',
+            (message_id, json.dumps(payload), available_at or now, now),
+        )
+
+        return message_id
+
+    def put_many(self, messages):
+        '''
+        Adds (payload, available_at) tuples to the queue in one transaction
+        and returns their ids
+        '''
+        now = time.time()
+        rows = [
+            (uuid.uuid4().hex, json.dumps(payload), available_at or now, now)
+            for payload, available_at in messages
+        ]
+
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT INTO messages (id, payload, available_at, created_at) '
+                'VALUES (?, ?, ?, ?)', rows,
+            )
+
+        return [row[0] for row in rows]
+
+    def claim_until(self, until, limit, leased_until):
+        '''
+        Returns up to limit (id, payload, attempts, available_at) tuples of
+        messages due by until, earliest first, leasing them until
+        leased_until.
+        '''
+
+        with self.transaction() as connection:
+            rows = connection.execute(
+                'SELECT id, payload, attempts, available_at FROM messages '
+                'WHERE available_at <= ? ORDER BY available_at LIMIT ?',
+                (until, limit),
+            ).fetchall()
+            connection.executemany(
+                'UPDATE messages SET available_at = ? WHERE id = ?',
+                [(leased_until, row[0]) for row in rows],
+            )
+
+        return [
+            (message_id, json.loads(payload), attempts, available_at)
+            for message_id, payload, attempts, available_at in rows
+        ]
+
+    def claim(self, limit=10, lease=60):
+        '''
+        Returns up to limit (id, payload, attempts) tuples of messages that
+        are due, leasing them for lease seconds.
+        '''
+        now = time.time()
+
+        return [
+            (message_id, payload, attempts)
+            for message_id, payload, attempts, _ in self.claim_until(
+                now, limit, now + lease,
+            )
+        ]
+
+    def ack(self, message_id):
+        '''Removes a sent message from the queue'''
+        self.connection.execute(
+            'DELETE FROM messages WHERE id = ?', (message_id,),
+        )
+
+    def retry(self, message_id, error=None):
+        '''
+        Schedules a failed message to be sent again with exponential backoff,
+        or moves it to the dead letters once it ran out of attempts.
+        '''
+        row = self.connection.execute(
+            'SELECT attempts FROM messages WHERE id = ?', (message_id,),
+        ).fetchone()
+
+        if row is None:
+            return
+
+        attempts = row[0] + 1
+
+        if attempts >= self.max_attempts:
+            return self.bury(message_id, error)
+
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        self.connection.execute(
+            'UPDATE messages SET attempts = ?, available_at = ?, '
+            'last_error = ? WHERE id = ?',
+            (attempts, time.time() + delay, error, message_id),
+        )
+
+    def defer(self, message_id, delay):
+        '''Makes a message due again in delay seconds, without an attempt'''
+        self.connection.execute(
+            'UPDATE messages SET available_at = ? WHERE id = ?',
+            (time.time() + delay, message_id),
+        )
+
+    def release(self, messages):
+        '''
+        Makes claimed messages, given as (id, available_at) tuples, due again
+        at available_at without an attempt
+        '''
+
+        with self.transaction() as connection:
+            connection.executemany(
+                'UPDATE messages SET available_at = ? WHERE id = ?',
+                [(available_at, message_id)
+                 for message_id, available_at in messages],
+            )
+
+    def bury(self, message_id, error=None):
+        '''Moves a message that can't be sent to the dead letters'''
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO dead_letters '
+                '(id, payload, attempts, last_error, created_at, failed_at) '
+                'SELECT id, payload, attempts + 1, ?, created_at, ? '
+                'FROM messages WHERE id = ?',
+                (error, time.time(), message_id),
+            )
+            connection.execute(
+                'DELETE FROM messages WHERE id = ?', (message_id,),
+            )
+
+    def dead_letters(self, limit=100):
+        '''Returns the most recent messages that couldn't be sent'''
+        rows = self.connection.execute(
+            'SELECT id, payload, attempts, last_error, failed_at '
+            'FROM dead_letters ORDER BY failed_at DESC LIMIT ?', (limit,),
+        ).fetchall()
+
+        return [
+            {
+                'id': message_id,
+                'payload': json.loads(payload),
+                'attempts': attempts,
+                'error': error,
+                'failed_at': failed_at,
+            }
+            for message_id, payload, attempts, error, failed_at in rows
+        ]
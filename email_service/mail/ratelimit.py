@@ -0,0 +1,57 @@
+'''Token buckets shared by all the worker processes'''
+import time
+
+from .store import SqliteStore
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+
+class RateLimiter(SqliteStore):
+    '''
+    Token buckets kept in a sqlite database, so every gunicorn worker draws
+    from the same budget. A bucket holds up to `burst` tokens and is refilled
+    with `rate` tokens per second. Each bucket costs a single short write
+    transaction per check.
+    '''
+    schema = SCHEMA
+
+    def acquire(self, name, rate, burst, tokens=1):
+        '''
+        Takes tokens from the named bucket. Returns (True, 0) if there were
+        enough of them, or (False, retry_after) with the seconds to wait until
+        there are.
+        '''
+        now = time.time()
+
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM buckets WHERE name = ?',
+                (name,),
+            ).fetchone()
+
+            if row is None:
+                available = burst
+            else:
+                available = min(burst, row[0] + (now - row[1]) * rate)
+
+            allowed = available >= tokens
+
+            if allowed:
+                available -= tokens
+
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets (name, tokens, updated_at) '
+                'VALUES (?, ?, ?)', (name, available, now),
+            )
+
+        if allowed:
+            return True, 0
+
+        return False, (tokens - available) / float(rate)
@@ -0,0 +1,185 @@
+'''Registry of email backends and the strategies routing emails to them'''
+import os
+import random
+import threading
+import importlib
+
+from flask import current_app as app
+
+from . import breaker
+
+
+_backend_classes = {}
+_backends = {}
+_routers = {}
+_pid = None
+
+
+def register(backend_class):
+    '''
+    Class decorator making a backend available under its name. Backends
+    living outside of this package are registered by listing their module in
+    EMAIL_BACKEND_MODULES.
+    '''
+    _backend_classes[backend_class.name] = backend_class
+    return backend_class
+
+
+def reset():
+    '''Forgets the backend instances and router state of the process'''
+    global _pid
+
+    _backends.clear()
+    _routers.clear()
+    _pid = os.getpid()
+
+
+def get_backend(name):
+    '''Returns the instance of the named backend for this worker'''
+
+    if _pid != os.getpid():
+        reset()
+
+    backend = _backends.get(name)
+
+    if backend is None:
+
+        if name not in _backend_classes:
+            from . import backends  # registers the built-in backends
+
+            for module in app.config['EMAIL_BACKEND_MODULES']:
+                importlib.import_module(module)
+
+        backend = _backends.setdefault(name, _backend_classes[name]())
+
+    return backend
+
+
+def get_backends():
+    '''Returns the instances of the backends listed in EMAIL_BACKENDS'''
+    return [get_backend(name) for name in app.config['EMAIL_BACKENDS']]
+
+
+class PriorityRouter(object):
+    '''Always tries the backends in the configured order'''
+
+    def order(self, backends):
+        '''Returns the backends in the order they should be tried'''
+        return list(backends)
+
+
+class WeightedRouter(object):
+    '''
+    Spreads emails over the backends in proportion to their weights with
+    smooth weighted round robin. The chosen backend goes first, the others
+    follow in the configured order as standbys.
+    '''
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def choose(self, backends):
+        '''Returns the backend whose turn it is'''
+
+        with self.lock:
+            total = 0
+            chosen = None
+
+            for backend in backends:
+                weight = self.weights.get(backend.name, 1)
+                total += weight
+                self.current[backend.name] = (
+                    self.current.get(backend.name, 0) + weight
+                )
+
+                if (chosen is None or self.current[backend.name] >
+                        self.current[chosen.name]):
+                    chosen = backend
+
+            if chosen is not None:
+                self.current[chosen.name] -= total
+
+        return chosen
+
+    def order(self, backends):
+        '''Returns the backends in the order they should be tried'''
+        chosen = self.choose(backends)
+
+        return [chosen] + [backend for backend in backends
+                           if backend is not chosen]
+
+
+class AdaptiveRouter(object):
+    '''
+    Picks the first backend at random, weighted by the inverse of its moving
+    average latency, penalised by its moving average error rate. Faster and
+    healthier backends take more of the load while the others still get
+    enough traffic to notice when they recover. Backends that have never
+    been used are tried first.
+    '''
+
+    def __init__(self, error_penalty=10):
+        self.error_penalty = error_penalty
+
+    def score(self, backend):
+        '''Returns the weight of a backend, higher is better'''
+        backend_breaker = breaker.get_breaker(backend.name)
+
+        if backend_breaker.latency is None:
+            return None
+
+        cost = max(backend_breaker.latency, 0.001) * (
+            1 + self.error_penalty * backend_breaker.error_rate
+        )
+
+        return 1 / cost
+
+    def order(self, backends):
+        '''Returns the backends in the order they should be tried'''
+        scores = [(self.score(backend), backend) for backend in backends]
+        unused = [backend for score, backend in scores if score is None]
+
+        if unused or not scores:
+            return unused + [
+                backend for score, backend in scores if score is not None
+            ]
+
+        pick = random.random() * sum(score for score, _ in scores)
+
+        for score, chosen in scores:
+            pick -= score
+
+            if pick <= 0:
+                break
+
+        return [chosen] + [backend for _, backend in scores
+                           if backend is not chosen]
+
+
+def get_router():
+    '''Returns the router configured with EMAIL_ROUTING for this worker'''
+    strategy = app.config['EMAIL_ROUTING']
+
+    if _pid != os.getpid():
+        reset()
+
+    router = _routers.get(strategy)
+
+    if router is None:
+
+        if strategy == 'weighted':
+            router = WeightedRouter(app.config['EMAIL_BACKEND_WEIGHTS'])
+        elif strategy == 'adaptive':
+            router = AdaptiveRouter(app.config['EMAIL_ROUTING_ERROR_PENALTY'])
+        elif strategy == 'priority':
+            router = PriorityRouter()
+        else:
+            raise ValueError(
+                'Unknown EMAIL_ROUTING strategy {0!r}'.format(strategy)
+            )
+
+        router = _routers.setdefault(strategy, router)
+
+    return router
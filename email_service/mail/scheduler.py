@@ -0,0 +1,102 @@
+'''Paced dispatch of the messages of an outbox at their due time'''
+import time
+import heapq
+import threading
+
+
+class Scheduler(object):
+    '''
+    Hands out the messages of an outbox once they are due, at most `rate` a
+    second and evenly spaced, so bursts of messages due at the same second
+    are spread over the following seconds. Messages are claimed from the
+    outbox into a heap ordered by due time. The heap holds no more messages
+    than can be dispatched in `lookahead` seconds, however many are pending
+    in the outbox, and claimed messages are leased long enough to be
+    dispatched before their lease runs out. A full heap still takes messages
+    that are already due, handing the ones due last back to the outbox.
+    '''
+
+    def __init__(self, outbox, rate, lookahead=60, lease=60):
+        self.outbox = outbox
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self.lookahead = lookahead
+        self.lease = lease
+        self.capacity = max(int(rate * lookahead), 1)
+        self.heap = []
+        self.next_dispatch = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def refill(self, now=None):
+        '''
+        Claims the messages due within lookahead seconds that fit in the
+        heap, returns how many were claimed. Once it is full, messages due
+        now are claimed in place of those in the heap that are due later.
+        '''
+        now = now or time.time()
+
+        with self.lock:
+            limit = self.capacity - len(self.heap)
+            until = now + self.lookahead
+
+            if limit <= 0:
+                limit = sum(1 for entry in self.heap if entry[0] > now)
+                until = now
+
+            if limit <= 0:
+                return 0
+
+            messages = self.outbox.claim_until(
+                until, limit, now + 2 * self.lookahead + self.lease,
+            )
+
+            for message_id, payload, _, available_at in messages:
+                heapq.heappush(self.heap, (available_at, message_id, payload))
+
+            if len(self.heap) > self.capacity:
+                # a sorted list is a heap
+                entries = sorted(self.heap)
+                self.heap = entries[:self.capacity]
+                self.outbox.release(
+                    (message_id, available_at)
+                    for available_at, message_id, _ in entries[self.capacity:]
+                )
+
+        return len(messages)
+
+    def pop(self, now=None):
+        '''
+        Returns the (id, payload) of the earliest due message if the pace
+        allows sending it now, None otherwise.
+        '''
+        now = now or time.time()
+
+        with self.lock:
+
+            if not self.heap or self.heap[0][0] > now:
+                return None
+
+            if now < self.next_dispatch:
+                return None
+
+            _, message_id, payload = heapq.heappop(self.heap)
+            self.next_dispatch = max(self.next_dispatch, now) + self.interval
+
+        return message_id, payload
+
+    def wait_time(self, now=None):
+        '''
+        Seconds until the next message can be dispatched, None if the heap
+        is empty
+        '''
+        now = now or time.time()
+
+        with self.lock:
+
+            if not self.heap:
+                return None
+
+            return max(self.heap[0][0], self.next_dispatch, now) - now
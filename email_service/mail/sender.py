@@ -0,0 +1,163 @@
+'''Workers sending the emails queued in the outbox'''
+import json
+import time
+import Queue
+import threading
+
+from .deadline import Deadline
+from .message import EmailMessage
+from .scheduler import Scheduler
+from .exceptions import ClientException, DeadlineExceeded, RateLimited
+
+
+class SenderPool(object):
+    '''
+    Pool of threads draining an outbox through EmailMessage.send. Messages
+    the providers reject are moved to the dead letters right away, others are
+    retried with backoff by the outbox. Messages over the provider rate limits
+    are put back until the limits allow them.
+
+    With a rate, a dispatcher thread hands the due messages of a Scheduler to
+    the senders at most `rate` a second instead of letting them claim as many
+    as they can send.
+    '''
+
+    def __init__(self, flask_app, outbox, concurrency=10, batch_size=10,
+                 poll_interval=1, lease=60, rate=None, lookahead=60):
+        self.app = flask_app
+        self.outbox = outbox
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.scheduler = None
+        self.queue = Queue.Queue(maxsize=concurrency)
+        self.threads = []
+
+        if rate:
+            self.scheduler = Scheduler(
+                outbox, rate, lookahead=lookahead, lease=lease,
+            )
+
+    def deliver(self, message_id, payload):
+        '''Sends a single queued message, returns True if it was sent'''
+        deadline = Deadline(
+            self.app.config['SEND_DEADLINE'],
+            connect_timeout=self.app.config['HTTP_CONNECT_TIMEOUT'],
+        )
+
+        try:
+            message = EmailMessage(**payload)
+            # attempts are logged under the id the client got
+            message.id = message_id
+            is_sent, _ = message.send(deadline=deadline)
+        except ClientException, excp:
+            self.outbox.bury(message_id, json.dumps(excp.error_message))
+            return False
+        except DeadlineExceeded:
+            self.outbox.retry(message_id, 'Deadline exceeded')
+            return False
+        except RateLimited, excp:
+            self.outbox.defer(message_id, excp.retry_after)
+            return False
+
+        if not is_sent:
+            self.outbox.retry(message_id, 'No backend could send the email')
+            return False
+
+        self.outbox.ack(message_id)
+        return True
+
+    def send(self, message_id, payload):
+        '''Delivers a message, retrying it later on unexpected errors'''
+
+        try:
+            self.deliver(message_id, payload)
+        except Exception:
+            self.app.logger.exception('Could not send %s', message_id)
+            self.outbox.retry(message_id, 'Unexpected error')
+
+    def run_once(self):
+        '''Sends one batch of due messages, returns the number claimed'''
+        messages = self.outbox.claim(self.batch_size, self.lease)
+
+        for message_id, payload, _ in messages:
+            self.send(message_id, payload)
+
+        self.app.metrics.flush()
+
+        return len(messages)
+
+    def work(self):
+        '''Keeps sending messages, sleeping while the outbox is empty'''
+
+        with self.app.app_context():
+
+            while True:
+
+                if not self.run_once():
+                    time.sleep(self.poll_interval)
+
+    def dispatch_once(self, now=None):
+        '''
+        Queues the next message of the scheduler for the senders if the pace
+        allows it. Returns the seconds to wait before the next call.
+        '''
+        now = now or time.time()
+        message = self.scheduler.pop(now)
+
+        if message is not None:
+            self.queue.put(message)
+
+        wait = self.scheduler.wait_time(now)
+
+        if wait is None:
+            return self.poll_interval
+
+        return min(wait, self.poll_interval)
+
+    def dispatch(self):
+        '''Keeps handing out the messages of the scheduler at its pace'''
+        refilled_at = 0
+
+        while True:
+            now = time.time()
+
+            if now - refilled_at >= self.poll_interval:
+                self.scheduler.refill(now)
+                refilled_at = now
+
+            time.sleep(self.dispatch_once(now))
+
+    def work_paced(self):
+        '''Keeps sending the messages handed out by the dispatcher'''
+
+        with self.app.app_context():
+
+            while True:
+                message_id, payload = self.queue.get()
+                self.send(message_id, payload)
+                self.app.metrics.flush()
+
+    def start(self):
+        '''Starts the sender threads, and the dispatcher if paced'''
+        targets = [self.work] * self.concurrency
+
+        if self.scheduler is not None:
+            targets = [self.dispatch] + [self.work_paced] * self.concurrency
+
+        for number, target in enumerate(targets):
+            thread = threading.Thread(
+                target=target, name='sender-{0}'.format(number),
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self):
+        '''Blocks until all sender threads have stopped'''
+
+        for thread in self.threads:
+
+            while thread.is_alive():
+                thread.join(1)
@@ -0,0 +1,417 @@
+'''Log of every attempt to send an email, kept in segments of time'''
+import os
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+
+from .events import EventBuffer
+from .store import SqliteStore
+from .suppression import key_of, normalize
+
+
+logger = logging.getLogger('email_service.sendlog')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    status TEXT NOT NULL,
+    status_code INTEGER,
+    latency REAL NOT NULL,
+    recipients INTEGER NOT NULL,
+    recipients_hash INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_message_id ON attempts (message_id);
+CREATE INDEX IF NOT EXISTS attempts_tenant_created_at
+    ON attempts (tenant, created_at);
+CREATE TABLE IF NOT EXISTS attempt_recipients (
+    key INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    attempt_id INTEGER NOT NULL,
+    PRIMARY KEY (key, created_at, attempt_id)
+) WITHOUT ROWID;
+'''
+
+FIELDS = (
+    'message_id', 'backend', 'status', 'status_code', 'latency',
+    'recipients', 'created_at',
+)
+
+SEGMENT_PREFIX = 'sendlog-'
+ACTIVE_SUFFIX = '.db'
+COMPACT_SUFFIX = '.compact.db'
+
+
+class Segment(SqliteStore):
+    '''
+    Attempts made during one segment of time, indexed by message id, by
+    recipient and by time. Compacted segments are read only and don't use a
+    write ahead log.
+    '''
+    schema = SCHEMA
+
+    def __init__(self, path, start, compacted=False):
+        super(Segment, self).__init__(
+            path, journal_mode='DELETE' if compacted else 'WAL',
+        )
+        self.start = start
+        self.compacted = compacted
+
+    def write(self, records):
+        '''Inserts attempts and their recipient keys in one transaction'''
+
+        with self.transaction() as connection:
+
+            for record in records:
+                recipients = sorted(set(
+                    normalize(address) for address in record['recipients']
+                ))
+                attempt_id = connection.execute(
+                    'INSERT INTO attempts (message_id, tenant, backend, '
+                    'status, status_code, latency, recipients, '
+                    'recipients_hash, created_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        record['message_id'], record['tenant'] or '',
+                        record['backend'],
+                        record['status'], record['status_code'],
+                        record['latency'], len(recipients),
+                        key_of(','.join(recipients)), record['created_at'],
+                    ),
+                ).lastrowid
+                connection.executemany(
+                    'INSERT OR IGNORE INTO attempt_recipients '
+                    '(key, created_at, attempt_id) VALUES (?, ?, ?)',
+                    [
+                        (key_of(address), record['created_at'], attempt_id)
+                        for address in recipients
+                    ],
+                )
+
+    def find(self, message_id, tenant):
+        '''Returns the attempts of a tenant to send a message'''
+        return [
+            dict(zip(FIELDS, row)) for row in self.connection.execute(
+                'SELECT {0} FROM attempts WHERE message_id = ? AND tenant = ? '
+                'ORDER BY id'.format(', '.join(FIELDS)),
+                (message_id, tenant or ''),
+            )
+        ]
+
+    def search(self, tenant, key, since, before, limit):
+        '''
+        Returns up to limit (attempt, cursor) tuples, newest first, of the
+        attempts of a tenant made since the given time and before the (time,
+        id) cursor. With a key, only attempts to the recipient of that key are
+        returned.
+        '''
+        columns = ', '.join('a.' + field for field in FIELDS)
+
+        if key is None:
+            rows = self.connection.execute(
+                'SELECT {0}, a.id FROM attempts a '
+                'WHERE a.tenant = ? AND a.created_at >= ? AND '
+                '(a.created_at < ? OR (a.created_at = ? AND a.id < ?)) '
+                'ORDER BY a.created_at DESC, a.id DESC LIMIT ?'.format(columns),
+                (tenant or '', since, before[0], before[0], before[1], limit),
+            )
+        else:
+            rows = self.connection.execute(
+                'SELECT {0}, a.id FROM attempt_recipients r '
+                'JOIN attempts a ON a.id = r.attempt_id '
+                'WHERE r.key = ? AND r.created_at >= ? AND (r.created_at < ? '
+                'OR (r.created_at = ? AND r.attempt_id < ?)) '
+                'AND a.tenant = ? '
+                'ORDER BY r.created_at DESC, r.attempt_id DESC '
+                'LIMIT ?'.format(columns),
+                (
+                    key, since, before[0], before[0], before[1], tenant or '',
+                    limit,
+                ),
+            )
+
+        return [
+            (dict(zip(FIELDS, row[:-1])), (row[-2], row[-1])) for row in rows
+        ]
+
+
+class SendLog(object):
+    '''
+    Log of every attempt to send an email: its message id, tenant, backend,
+    status, status code, latency and recipients. Tenants only find their own
+    attempts. Recipients are only kept as 64 bit
+    hashes, along with a hash of the whole list. Attempts are buffered and
+    written in batches to the segment of the `segment_length` seconds they
+    were made in. Every segment is a sqlite database with its own indexes,
+    so lookups only walk a few small b-trees, finished segments can be
+    compacted and segments older than `retention` seconds are deleted whole.
+    Without a directory nothing is logged.
+    '''
+
+    def __init__(self, directory, segment_length=86400, retention=2592000,
+                 batch_size=500, flush_interval=1, max_size=50000):
+        self.directory = directory
+        self.segment_length = segment_length
+        self.retention = retention
+        self.buffer = EventBuffer(
+            self, batch_size=batch_size, flush_interval=flush_interval,
+            max_size=max_size,
+        )
+        self.segments = {}
+        self.lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, message_id, backend, status, latency, recipients,
+               status_code=None, tenant=None):
+        '''Logs an attempt, returns False if there was no room for it'''
+
+        if self.directory is None:
+            return False
+
+        return self.buffer.add([{
+            'message_id': message_id,
+            'tenant': tenant,
+            'backend': backend,
+            'status': status,
+            'status_code': status_code,
+            'latency': latency,
+            'recipients': recipients,
+            'created_at': time.time(),
+        }])
+
+    def flush(self):
+        '''Writes the buffered attempts, returns how many'''
+
+        if self.directory is None:
+            return 0
+
+        return self.buffer.flush()
+
+    def start(self):
+        '''Starts writing the buffered attempts in the background'''
+
+        if self.directory is None:
+            return None
+
+        return self.buffer.start()
+
+    def segment_start(self, timestamp):
+        '''Returns the start of the segment a time falls in'''
+        return int(timestamp // self.segment_length * self.segment_length)
+
+    def path(self, start, compacted=False):
+        '''Returns the path of a segment'''
+        return os.path.join(self.directory, '{0}{1:012d}{2}'.format(
+            SEGMENT_PREFIX, start,
+            COMPACT_SUFFIX if compacted else ACTIVE_SUFFIX,
+        ))
+
+    def segment(self, start, compacted=False):
+        '''Returns the segment starting at start, opened once per process'''
+        path = self.path(start, compacted)
+
+        with self.lock:
+            segment = self.segments.get(path)
+
+            if segment is None:
+                segment = self.segments[path] = Segment(
+                    path, start, compacted,
+                )
+
+        return segment
+
+    def list_segments(self):
+        '''
+        Returns the segments on disk, newest first, preferring the compacted
+        copy of a segment. Segments deleted since are forgotten.
+        '''
+
+        if self.directory is None:
+            return []
+
+        found = {}
+
+        for filename in os.listdir(self.directory):
+
+            if not filename.startswith(SEGMENT_PREFIX):
+                continue
+
+            name = filename[len(SEGMENT_PREFIX):]
+
+            if name.endswith(COMPACT_SUFFIX):
+                found[int(name[:-len(COMPACT_SUFFIX)])] = True
+            elif name.endswith(ACTIVE_SUFFIX):
+                found.setdefault(int(name[:-len(ACTIVE_SUFFIX)]), False)
+
+        segments = [
+            self.segment(start, compacted)
+            for start, compacted in sorted(found.items(), reverse=True)
+        ]
+        paths = set(segment.path for segment in segments)
+
+        with self.lock:
+
+            for path in self.segments.keys():
+
+                if path not in paths:
+                    del self.segments[path]
+
+        return segments
+
+    def write(self, records):
+        '''Writes attempts to the segments they were made in'''
+        by_segment = {}
+
+        for record in records:
+            by_segment.setdefault(
+                self.segment_start(record['created_at']), [],
+            ).append(record)
+
+        for start, segment_records in by_segment.items():
+            self.segment(start).write(segment_records)
+
+    def find(self, message_id, tenant=None):
+        '''Returns the attempts of a tenant to send a message, oldest first'''
+        attempts = []
+
+        for segment in self.list_segments():
+            attempts.extend(segment.find(message_id, tenant))
+
+        return sorted(attempts, key=lambda attempt: attempt['created_at'])
+
+    def search(self, recipient=None, since=None, until=None, limit=100,
+               cursor=None, tenant=None):
+        '''
+        Returns up to limit attempts of a tenant made since and until the
+        given times, to recipient if given, newest first, with the cursor of
+        the next page or None if there is none. The cursor is the (time, id)
+        of the last attempt returned.
+        '''
+        since = since or 0
+        before = cursor or (until or time.time() + self.segment_length, 0)
+        key = None if recipient is None else key_of(normalize(recipient))
+        attempts = []
+        last = None
+
+        for segment in self.list_segments():
+
+            if segment.start > before[0]:
+                continue
+
+            if segment.start + self.segment_length <= since:
+                break
+
+            for attempt, position in segment.search(
+                    tenant, key, since, before, limit - len(attempts)):
+                attempts.append(attempt)
+                last = position
+
+            if len(attempts) >= limit:
+                return attempts, last
+
+            before = (segment.start, 0)
+
+        return attempts, None
+
+    def compact(self, start):
+        '''
+        Rewrites a finished segment into a read only copy with packed tables
+        and indexes, then deletes the original
+        '''
+        path = self.path(start)
+        compact_path = self.path(start, compacted=True)
+        temporary_path = compact_path + '.tmp'
+
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+        # creates the tables of the copy
+        Segment(temporary_path, start, compacted=True).connection.close()
+        connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+
+        try:
+            connection.execute(
+                'ATTACH DATABASE ? AS compact', (temporary_path,),
+            )
+            connection.execute('BEGIN')
+            connection.execute(
+                'INSERT INTO compact.attempts SELECT * FROM attempts '
+                'ORDER BY id',
+            )
+            connection.execute(
+                'INSERT INTO compact.attempt_recipients '
+                'SELECT * FROM attempt_recipients '
+                'ORDER BY key, created_at, attempt_id',
+            )
+            connection.execute('COMMIT')
+            connection.execute('ANALYZE compact')
+        finally:
+            connection.close()
+
+        os.rename(temporary_path, compact_path)
+
+        for suffix in ('', '-wal', '-shm'):
+
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def maintain(self, now=None):
+        '''
+        Deletes the segments past retention and compacts the segments that
+        ended at least a segment ago, so no attempt is still buffered for
+        them. Only one process maintains the log at a time, returns False if
+        another one is.
+        '''
+        now = now or time.time()
+
+        with open(os.path.join(self.directory, '.maintenance'), 'w') as lock:
+
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+
+            for segment in self.list_segments():
+                end = segment.start + self.segment_length
+
+                if end <= now - self.retention:
+
+                    for suffix in ('', '-wal', '-shm'):
+
+                        if os.path.exists(segment.path + suffix):
+                            os.remove(segment.path + suffix)
+                elif (not segment.compacted and
+                      end + self.segment_length <= now):
+                    self.compact(segment.start)
+
+        return True
+
+    def start_maintenance(self, interval):
+        '''Starts a daemon thread maintaining the log every interval seconds'''
+
+        if self.directory is None or not interval:
+            return None
+
+        def run():
+
+            while True:
+
+                try:
+                    self.maintain()
+                except (sqlite3.Error, OSError):
+                    logger.exception('Maintaining the send log failed')
+
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name='sendlog-maintenance')
+        thread.daemon = True
+        thread.start()
+
+        return thread
@@ -0,0 +1,243 @@
+'''Long lived, pooled smtp sessions used by the smtp backend'''
+import time
+import socket
+import smtplib
+import threading
+
+
+# sendmail resets the session after these, so it can carry on
+RECOVERABLE_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+def sendmail(connection, from_address, recipients, message):
+    '''
+    Sends a message like smtplib.SMTP.sendmail, returning the refused
+    recipients and raising the same errors. The message may also be a list
+    of strings and iterables of strings, e.g. attachments encoded while they
+    are sent, so it is never held in memory as a whole. Chunks must start at
+    the start of a line or with a line break, as dots are only escaped at
+    their start.
+    '''
+
+    if isinstance(message, basestring):
+        message = [message]
+
+    connection.ehlo_or_helo_if_needed()
+    code, reply = connection.mail(from_address)
+
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(code, reply, from_address)
+
+    refused = {}
+
+    for recipient in recipients:
+        code, reply = connection.rcpt(recipient)
+
+        if code not in (250, 251):
+            refused[recipient] = code, reply
+
+    if len(refused) == len(recipients):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    connection.putcmd('data')
+    code, reply = connection.getreply()
+
+    if code != 354:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, reply)
+
+    last = ''
+
+    for part in message:
+
+        for chunk in [part] if isinstance(part, basestring) else part:
+
+            if chunk:
+                last = smtplib.quotedata(chunk)
+                connection.send(last)
+
+    connection.send('.\r\n' if last.endswith('\r\n') else '\r\n.\r\n')
+    code, reply = connection.getreply()
+
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPDataError(code, reply)
+
+    return refused
+
+
+def close(connection):
+    '''Ends a session politely, or just drops it if that fails'''
+
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, socket.error):
+        connection.close()
+
+
+class SmtpConnectionPool(object):
+    '''
+    Keeps up to `size` smtp sessions open between emails, so each of them
+    sends many messages and the connection, STARTTLS and login are only paid
+    for once per session. Sessions are closed once they sent `max_messages`
+    messages or stayed idle for `idle_timeout` seconds, before the server
+    would drop them.
+    '''
+
+    def __init__(self, host, port, username=None, password=None,
+                 starttls=True, size=10, max_messages=100, idle_timeout=30,
+                 timeout=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        '''Opens a new session, upgraded to tls and logged in as configured'''
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            connection.ehlo()
+
+            if self.starttls:
+                connection.starttls()
+                connection.ehlo()
+
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+
+        return connection
+
+    def acquire(self):
+        '''
+        Returns a (connection, messages sent) tuple, reusing the most recently
+        used idle session unless it idled for too long
+        '''
+        now = time.time()
+        stale = []
+        found = None
+
+        with self.lock:
+
+            while self.idle:
+                connection, released_at, sent = self.idle.pop()
+
+                if now - released_at < self.idle_timeout:
+                    found = connection, sent
+                    break
+
+                stale.append(connection)
+
+        for connection in stale:
+            close(connection)
+
+        return found or (self.connect(), 0)
+
+    def release(self, connection, sent):
+        '''Puts a session back in the pool, or closes it if it is used up'''
+
+        if sent < self.max_messages:
+
+            with self.lock:
+
+                if len(self.idle) < self.size:
+                    self.idle.append((connection, time.time(), sent))
+                    return
+
+        close(connection)
+
+    def send(self, from_address, recipients, message, timeout=None):
+        '''
+        Sends a message over a pooled session and returns the recipients the
+        server refused, see sendmail. Reused sessions the server closed in the
+        meantime are replaced by new ones, so the parts of the message must
+        be iterable more than once.
+        '''
+
+        while True:
+            connection, sent = self.acquire()
+
+            try:
+                connection.sock.settimeout(timeout or self.timeout)
+                refused = sendmail(
+                    connection, from_address, recipients, message,
+                )
+            except RECOVERABLE_ERRORS:
+                self.release(connection, sent + 1)
+                raise
+            except smtplib.SMTPServerDisconnected:
+                connection.close()
+
+                if sent:
+                    continue
+
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            self.release(connection, sent + 1)
+
+            return refused
+
+    def warm(self, connections=1):
+        '''Opens up to `connections` sessions ahead of time'''
+        opened = []
+
+        for _ in range(connections):
+
+            try:
+                opened.append(self.connect())
+            except (smtplib.SMTPException, socket.error):
+                break
+
+        for connection in opened:
+            self.release(connection, 0)
+
+    def probe(self, timeout):
+        '''Returns True if the server answers a NOOP'''
+
+        try:
+            connection, sent = self.acquire()
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+        try:
+            connection.sock.settimeout(timeout)
+            code, _ = connection.noop()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+            return False
+
+        if code != 250:
+            close(connection)
+            return False
+
+        self.release(connection, sent)
+
+        return True
+
+    def clear(self):
+        '''Closes all the idle sessions'''
+
+        with self.lock:
+            idle, self.idle = self.idle, []
+
+        for connection, _, _ in idle:
+            close(connection)
@@ -0,0 +1,74 @@
+'''Base class of the local sqlite stores'''
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SqliteStore(object):
+    '''
+    Sqlite database, in WAL mode unless another journal_mode is given, shared
+    by all the worker processes. Every thread (or greenlet) gets its own
+    connection, and connections are never carried over a fork. Subclasses
+    define their tables in `schema`, and columns added to existing tables
+    since in `columns`, as (table, column definition) tuples.
+    '''
+    schema = ''
+    columns = ()
+
+    def __init__(self, path, synchronous='NORMAL', journal_mode='WAL'):
+        self.path = path
+        self.synchronous = synchronous
+        self.journal_mode = journal_mode
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        '''Connection of the current thread, opened on first use'''
+        pid = getattr(self.local, 'pid', None)
+
+        if pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None,
+            )
+            connection.execute(
+                'PRAGMA journal_mode={0}'.format(self.journal_mode),
+            )
+            connection.execute(
+                'PRAGMA synchronous={0}'.format(self.synchronous),
+            )
+            connection.executescript(self.schema)
+
+            for table, column in self.columns:
+
+                try:
+                    connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                        table, column,
+                    ))
+                except sqlite3.OperationalError, excp:
+
+                    if 'duplicate column' not in str(excp):
+                        raise
+
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return self.local.connection
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs the block in a write transaction, yielding the connection. The
+        write lock is taken upfront so concurrent writers wait instead of
+        failing halfway.
+        '''
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
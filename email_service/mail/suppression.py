@@ -0,0 +1,291 @@
+'''Addresses and domains emails are never sent to'''
+import time
+import struct
+import bisect
+import hashlib
+import threading
+from array import array
+
+from .store import SqliteStore
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS suppressions (
+    entry TEXT PRIMARY KEY,
+    key INTEGER NOT NULL,
+    domain INTEGER NOT NULL,
+    reason TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS suppressions_key ON suppressions (domain, key);
+CREATE TABLE IF NOT EXISTS suppression_generation (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO suppression_generation VALUES (0, 0);
+'''
+
+# signed 64 bit integers on the 64 bit platforms the service runs on,
+# python 2 arrays have no 'q'
+KEY_TYPECODE = 'l'
+
+# rows read between yields to the requests while an index is built
+BUILD_YIELD_ROWS = 10000
+
+
+def normalize(entry):
+    '''Returns the form addresses and domains are stored and looked up in'''
+    return entry.strip().lower()
+
+
+def key_of(entry):
+    '''Returns the signed 64 bit hash an entry is indexed by'''
+
+    if isinstance(entry, unicode):
+        entry = entry.encode('utf-8')
+
+    return struct.unpack('<q', hashlib.md5(entry).digest()[:8])[0]
+
+
+class SuppressionIndex(object):
+    '''
+    Immutable in-memory snapshot of a suppression list. Suppressed addresses
+    are kept as the sorted array of their 64 bit keys, 8 bytes per address
+    instead of the ~100 of a set of strings, and looked up by binary search.
+    The array is a single buffer, so workers forked after it was loaded share
+    its memory. Two addresses with the same key would both be suppressed,
+    which is negligible below billions of addresses. Suppressed domains are
+    few and kept as a set.
+    '''
+
+    def __init__(self, keys, domains):
+        '''Takes the sorted array of the address keys and the domains'''
+        self.keys = keys
+        self.domains = frozenset(domains)
+
+    def __len__(self):
+        return len(self.keys) + len(self.domains)
+
+    def __contains__(self, address):
+        address = normalize(address)
+
+        if self.domains and address.rpartition('@')[2] in self.domains:
+            return True
+
+        key = key_of(address)
+        position = bisect.bisect_left(self.keys, key)
+
+        return position < len(self.keys) and self.keys[position] == key
+
+
+class SuppressionList(SqliteStore):
+    '''
+    Addresses and domains suppressed after bounces, complaints or
+    unsubscribes, stored in sqlite and looked up in a SuppressionIndex of
+    every process. The index is loaded on first use. Every `reload_interval`
+    seconds at most, a lookup checks whether the list changed, and if it did
+    a new index is built in a background thread and swapped in once ready,
+    lookups carry on with the old one meanwhile. None disables the checks,
+    the index is then only rebuilt by reload.
+    '''
+    schema = SCHEMA
+
+    def __init__(self, path, synchronous='NORMAL', reload_interval=10):
+        super(SuppressionList, self).__init__(path, synchronous)
+        self.reload_interval = reload_interval
+        self.index = None
+        self.generation = None
+        self.checked_at = 0
+        self.reloading = None
+        self.lock = threading.Lock()
+
+    def _bump(self, connection):
+        '''Marks the list as changed, so every process reloads it'''
+        connection.execute(
+            'UPDATE suppression_generation SET generation = generation + 1',
+        )
+
+    def add(self, entries, reason=None):
+        '''
+        Suppresses addresses, or whole domains when given without an @, and
+        returns how many weren't suppressed yet
+        '''
+        now = time.time()
+        rows = []
+
+        for entry in entries:
+            entry = normalize(entry)
+            rows.append((entry, key_of(entry), '@' not in entry, reason, now))
+
+        with self.transaction() as connection:
+            added = connection.executemany(
+                'INSERT OR IGNORE INTO suppressions '
+                '(entry, key, domain, reason, created_at) '
+                'VALUES (?, ?, ?, ?, ?)', rows,
+            ).rowcount
+
+            if added:
+                self._bump(connection)
+
+        self.checked_at = 0
+
+        return added
+
+    def load_file(self, path, reason=None, chunk_size=10000):
+        '''
+        Suppresses the entries of a text file, one per line, and returns how
+        many weren't suppressed yet. Blank lines and lines starting with #
+        are skipped.
+        '''
+        added = 0
+        chunk = []
+
+        with open(path) as entries_file:
+
+            for line in entries_file:
+                line = line.strip()
+
+                if line and not line.startswith('#'):
+                    chunk.append(line.decode('utf-8'))
+
+                if len(chunk) >= chunk_size:
+                    added += self.add(chunk, reason)
+                    chunk = []
+
+        if chunk:
+            added += self.add(chunk, reason)
+
+        return added
+
+    def remove(self, entry):
+        '''Lifts the suppression of an entry, returns False if there was none'''
+
+        with self.transaction() as connection:
+            removed = connection.execute(
+                'DELETE FROM suppressions WHERE entry = ?', (normalize(entry),),
+            ).rowcount
+
+            if removed:
+                self._bump(connection)
+
+        self.checked_at = 0
+
+        return bool(removed)
+
+    def get(self, entry):
+        '''Returns a stored entry as a dict, or None if it isn't suppressed'''
+        row = self.connection.execute(
+            'SELECT entry, reason, created_at FROM suppressions '
+            'WHERE entry = ?', (normalize(entry),),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('entry', 'reason', 'created_at'), row))
+
+    def current_generation(self):
+        '''Returns the number of changes made to the list so far'''
+        return self.connection.execute(
+            'SELECT generation FROM suppression_generation',
+        ).fetchone()[0]
+
+    def build(self):
+        '''
+        Reads the whole list into a new SuppressionIndex and returns it with
+        the generation it was read at
+        '''
+        connection = self.connection
+        # a read transaction, so the rows match the generation
+        connection.execute('BEGIN')
+
+        try:
+            generation = self.current_generation()
+            domains = [
+                row[0] for row in connection.execute(
+                    'SELECT entry FROM suppressions WHERE domain = 1',
+                )
+            ]
+            keys = array(KEY_TYPECODE)
+            rows = connection.execute(
+                'SELECT key FROM suppressions WHERE domain = 0 ORDER BY key',
+            )
+
+            while True:
+                chunk = rows.fetchmany(BUILD_YIELD_ROWS)
+
+                if not chunk:
+                    break
+
+                keys.extend(row[0] for row in chunk)
+                time.sleep(0)
+        finally:
+            connection.execute('COMMIT')
+
+        return generation, SuppressionIndex(keys, domains)
+
+    def reload(self):
+        '''Builds a new index and swaps it in'''
+        generation, index = self.build()
+
+        with self.lock:
+
+            if self.generation is None or generation > self.generation:
+                self.generation, self.index = generation, index
+
+    def load(self):
+        '''Builds the index unless it is loaded already'''
+
+        if self.index is None:
+            self.reload()
+
+    def _reload_in_background(self):
+        '''Starts a reload thread unless one is running'''
+
+        with self.lock:
+
+            if self.reloading is not None and self.reloading.is_alive():
+                return
+
+            self.reloading = threading.Thread(target=self.reload)
+            self.reloading.daemon = True
+            self.reloading.start()
+
+    def refresh(self):
+        '''Reloads the index in the background if the list changed'''
+        now = time.time()
+
+        if (self.reload_interval is None or
+                now - self.checked_at < self.reload_interval):
+            return
+
+        self.checked_at = now
+
+        if self.current_generation() != self.generation:
+            self._reload_in_background()
+
+    def is_suppressed(self, address):
+        '''Returns True if emails to the address must not be sent'''
+        self.load()
+        self.refresh()
+
+        return address in self.index
+
+    def filter(self, addresses):
+        '''
+        Returns the addresses that aren't suppressed and those that are, as
+        two lists
+        '''
+        self.load()
+        self.refresh()
+        index = self.index
+        allowed, suppressed = [], []
+
+        for address in addresses:
+
+            if address in index:
+                suppressed.append(address)
+            else:
+                allowed.append(address)
+
+        return allowed, suppressed
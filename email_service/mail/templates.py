@@ -0,0 +1,158 @@
+'''Named, versioned email templates rendered with jinja2'''
+import time
+
+import jinja2
+from jinja2.sandbox import SandboxedEnvironment
+
+from .cache import LRUCache
+from .store import SqliteStore
+from .exceptions import ClientException
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS templates (
+    tenant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    text TEXT,
+    html TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (tenant, name, version)
+);
+'''
+
+FIELDS = ('subject', 'text', 'html')
+
+
+class TemplateStore(SqliteStore):
+    '''
+    Stores every version of the email templates of every tenant, each tenant
+    only seeing its own. Compiled templates are kept in a per-process LRU
+    cache keyed by tenant, name and version, so saving a new version never
+    serves a stale template and old versions simply age out. Templates are
+    uploaded by clients, so they are rendered in a sandbox. A tenant of None
+    stands for requests made without api keys.
+    '''
+    schema = SCHEMA
+
+    def __init__(self, path, synchronous='NORMAL', cache_size=256):
+        super(TemplateStore, self).__init__(path, synchronous)
+        self.cache = LRUCache(cache_size)
+        self.environments = {
+            'subject': SandboxedEnvironment(undefined=jinja2.StrictUndefined),
+            'text': SandboxedEnvironment(undefined=jinja2.StrictUndefined),
+            'html': SandboxedEnvironment(
+                undefined=jinja2.StrictUndefined, autoescape=True,
+            ),
+        }
+
+    def save(self, name, subject, text=None, html=None, tenant=None):
+        '''Stores a new version of the named template and returns it'''
+
+        for field, source in zip(FIELDS, (subject, text, html)):
+
+            if source is not None:
+
+                try:
+                    self.environments[field].parse(source)
+                except jinja2.TemplateSyntaxError, excp:
+                    raise ClientException(400, {
+                        'message': 'error',
+                        'error': {'field': field, 'message': excp.message},
+                    })
+
+        with self.transaction() as connection:
+            version = connection.execute(
+                'SELECT COALESCE(MAX(version), 0) + 1 FROM templates '
+                'WHERE tenant = ? AND name = ?', (tenant or '', name),
+            ).fetchone()[0]
+            connection.execute(
+                'INSERT INTO templates '
+                '(tenant, name, version, subject, text, html, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    tenant or '', name, version, subject, text, html,
+                    time.time(),
+                ),
+            )
+
+        return version
+
+    def get(self, name, version=None, tenant=None):
+        '''
+        Returns the given version of a template as a dict, the latest one if
+        no version is given, or None if it doesn't exist.
+        '''
+
+        if version is None:
+            row = self.connection.execute(
+                'SELECT version, subject, text, html FROM templates '
+                'WHERE tenant = ? AND name = ? ORDER BY version DESC LIMIT 1',
+                (tenant or '', name),
+            ).fetchone()
+        else:
+            row = self.connection.execute(
+                'SELECT version, subject, text, html FROM templates '
+                'WHERE tenant = ? AND name = ? AND version = ?',
+                (tenant or '', name, version),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('name', 'version') + FIELDS, (name,) + row))
+
+    def latest_version(self, name, tenant=None):
+        '''Returns the latest version of the named template'''
+        row = self.connection.execute(
+            'SELECT MAX(version) FROM templates WHERE tenant = ? AND name = ?',
+            (tenant or '', name),
+        ).fetchone()
+
+        return row[0]
+
+    def compiled(self, name, version, tenant=None):
+        '''Returns the compiled fields of a template, using the cache'''
+        key = (tenant, name, version)
+        compiled = self.cache.get(key)
+
+        if compiled is None:
+            template = self.get(name, version, tenant)
+
+            if template is None:
+                return None
+
+            compiled = dict(
+                (field, self.environments[field].from_string(template[field]))
+                for field in FIELDS if template[field]
+            )
+            self.cache.set(key, compiled)
+
+        return compiled
+
+    def render(self, name, context=None, version=None, tenant=None):
+        '''
+        Renders a template with the given context and returns a dict with
+        its subject, text and html. Raises ClientException if the template
+        doesn't exist or can't be rendered.
+        '''
+        version = version or self.latest_version(name, tenant)
+        compiled = version and self.compiled(name, version, tenant)
+
+        if not compiled:
+            raise ClientException(404, {
+                'message': 'error',
+                'error': {'field': 'template_id', 'message': 'Not found'},
+            })
+
+        try:
+            return dict(
+                (field, template.render(context or {}))
+                for field, template in compiled.items()
+            )
+        except jinja2.TemplateError, excp:
+            raise ClientException(400, {
+                'message': 'error',
+                'error': {'field': 'context', 'message': excp.message},
+            })
@@ -0,0 +1,80 @@
+'''Long lived, pooled http sessions shared by the email backends'''
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ProtocolError
+
+from flask import current_app as app
+
+
+_sessions = {}
+_pid = None
+
+
+def _create_session():
+    '''
+    Creates a keep-alive session whose connection pool is sized to match the
+    number of concurrent requests a worker handles. The environment is left
+    out unless HTTP_TRUST_ENV is set.
+    '''
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=app.config['HTTP_POOL_SIZE'],
+        pool_block=app.config['HTTP_POOL_BLOCK'],
+    )
+    session = requests.Session()
+    session.trust_env = app.config['HTTP_TRUST_ENV']
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def reset():
+    '''
+    Forgets every session. Called in a freshly forked worker so it never
+    writes to sockets (and tls state) owned by its parent.
+    '''
+    global _pid
+
+    _sessions.clear()
+    _pid = os.getpid()
+
+
+def get_session(name):
+    '''Returns the long lived session of the named provider'''
+
+    if _pid != os.getpid():
+        reset()
+
+    session = _sessions.get(name)
+
+    if session is None:
+        session = _sessions.setdefault(name, _create_session())
+
+    return session
+
+
+def warm(name, url, connections=1):
+    '''
+    Opens `connections` keep-alive connections to url, so the first emails sent
+    by a worker don't pay for the tcp and tls handshakes.
+    '''
+    session = get_session(name)
+    timeout = app.config['HTTP_WARM_TIMEOUT']
+
+    def connect():
+        try:
+            session.head(url, timeout=timeout)
+        except (requests.RequestException, ProtocolError):
+            pass
+
+    threads = [threading.Thread(target=connect) for _ in range(connections)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
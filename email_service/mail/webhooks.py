@@ -0,0 +1,160 @@
+'''
+Authentication and normalisation of the event webhooks of the providers.
+Events of every provider are turned into dicts with the same fields:
+provider, event, email, timestamp, message_id, reason and the original
+event as data.
+'''
+import hmac
+import time
+import hashlib
+
+from .exceptions import ClientException
+
+
+SENDGRID_EVENTS = {
+    'bounce': 'bounced',
+    'open': 'opened',
+    'click': 'clicked',
+    'spamreport': 'complained',
+    'unsubscribe': 'unsubscribed',
+    'group_unsubscribe': 'unsubscribed',
+}
+
+MAILGUN_EVENTS = {
+    'accepted': 'processed',
+    'failed': 'bounced',
+}
+
+
+def unauthorized():
+    '''Returns the error of webhooks failing authentication'''
+    return ClientException(401, {
+        'message': 'error',
+        'error': {'message': 'Invalid webhook credentials'},
+    })
+
+
+def _equal(value, expected):
+    '''Compares secrets in constant time, only strings can match'''
+
+    if not isinstance(value, basestring) or expected is None:
+        return False
+
+    return hmac.compare_digest(value.encode('utf-8'), expected.encode('utf-8'))
+
+
+def verify_sendgrid(authorization, user, password):
+    '''
+    Checks the basic auth credentials sendgrid was given in the webhook url.
+    Raises ClientException if they don't match.
+    '''
+
+    if authorization is None or not (
+            _equal(authorization.username, user) and
+            _equal(authorization.password, password)):
+        raise unauthorized()
+
+
+def verify_mailgun(signature, key, max_age):
+    '''
+    Checks the signature of a mailgun webhook, the hmac of its timestamp and
+    token, and that it is at most max_age seconds old. Raises
+    ClientException if it doesn't hold.
+    '''
+    timestamp = signature.get('timestamp') or ''
+
+    if key is None:
+        raise unauthorized()
+
+    expected = hmac.new(
+        key.encode('utf-8'),
+        u'{0}{1}'.format(timestamp, signature.get('token') or '').encode(
+            'utf-8',
+        ),
+        hashlib.sha256,
+    ).hexdigest()
+
+    if not _equal(signature.get('signature'), expected):
+        raise unauthorized()
+
+    try:
+        age = abs(time.time() - float(timestamp))
+    except (TypeError, ValueError):
+        raise unauthorized()
+
+    if age > max_age:
+        raise unauthorized()
+
+
+def _text(value):
+    '''Returns a field of an event if it is a string, None otherwise'''
+    return value if isinstance(value, basestring) else None
+
+
+def _number(value):
+    '''Returns a field of an event as a float, None if it isn't a number'''
+
+    if isinstance(value, bool):
+        return None
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _object(value):
+    '''Returns a field of an event if it is an object, {} otherwise'''
+    return value if isinstance(value, dict) else {}
+
+
+def normalize_sendgrid(event):
+    '''
+    Normalises an event of the sendgrid event webhook. Fields of the wrong
+    type are left out, the original event keeps them.
+    '''
+    name = _text(event.get('event')) or 'unknown'
+
+    return {
+        'provider': 'sendgrid',
+        'event': SENDGRID_EVENTS.get(name, name),
+        'email': _text(event.get('email')),
+        'timestamp': _number(event.get('timestamp')),
+        'message_id': (
+            _text(event.get('sg_message_id')) or _text(event.get('smtp-id'))
+        ),
+        'reason': _text(event.get('reason')) or _text(event.get('response')),
+        'data': event,
+    }
+
+
+def normalize_mailgun(event):
+    '''
+    Normalises an event of a mailgun webhook, given either as the event-data
+    of a json webhook or as the fields of a form one. Fields of the wrong
+    type are left out, the original event keeps them.
+    '''
+    name = _text(event.get('event')) or 'unknown'
+
+    if name == 'failed' and event.get('severity') == 'temporary':
+        name = 'deferred'
+
+    headers = _object(_object(event.get('message')).get('headers'))
+    status = _object(event.get('delivery-status'))
+
+    return {
+        'provider': 'mailgun',
+        'event': MAILGUN_EVENTS.get(name, name),
+        'email': _text(event.get('recipient')),
+        'timestamp': _number(event.get('timestamp')),
+        'message_id': (
+            _text(headers.get('message-id')) or
+            _text(event.get('Message-Id')) or _text(event.get('message-id'))
+        ),
+        'reason': (
+            _text(status.get('description')) or _text(status.get('message')) or
+            _text(event.get('reason')) or _text(event.get('error')) or
+            _text(event.get('description'))
+        ),
+        'data': event,
+    }
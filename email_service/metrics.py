@@ -0,0 +1,281 @@
+'''Prometheus metrics aggregated across the worker processes'''
+import os
+import json
+import time
+import bisect
+import threading
+
+from flask import g, request
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+
+def _format_labels(labels):
+    '''Renders a label tuple in the prometheus text format'''
+
+    if not labels:
+        return ''
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(
+            name,
+            unicode(value).replace('\\', '\\\\').replace('"', '\\"'),
+        )
+        for name, value in labels
+    ))
+
+
+class Metrics(object):
+    '''
+    Counters and histograms kept in memory by every process. Recording a
+    value is a dict update under a lock. Every `flush_interval` seconds at
+    most, a process writes a snapshot of its metrics to its own file in
+    `directory`, and the metrics of all the files are added up when they are
+    exported. Without a directory only the metrics of the current process are
+    exported.
+    '''
+
+    def __init__(self, directory=None, flush_interval=1,
+                 buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.flushed_at = 0
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        '''Sets the type and help text of a metric'''
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        '''Increments a counter'''
+        key = (name, tuple(labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels=(), value=0):
+        '''Records a value in a histogram'''
+        key = (name, tuple(labels))
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (
+                    len(self.buckets) + 3
+                )
+
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @property
+    def path(self):
+        '''File the metrics of this process are written to'''
+        return os.path.join(
+            self.directory, 'metrics-{0}.json'.format(os.getpid()),
+        )
+
+    def snapshot(self):
+        '''Returns the metrics of this process as a json serializable dict'''
+
+        with self.lock:
+            return {
+                'counters': [
+                    [name, labels, value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                'histograms': [
+                    [name, labels, list(values)]
+                    for (name, labels), values in self.histograms.items()
+                ],
+            }
+
+    def flush(self, force=False):
+        '''Writes the metrics of this process to its file, now and then'''
+        now = time.time()
+
+        if self.directory is None:
+            return
+
+        if not force and now - self.flushed_at < self.flush_interval:
+            return
+
+        self.flushed_at = now
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        temporary_path = self.path + '.tmp'
+
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+
+        os.rename(temporary_path, self.path)
+
+    def reset(self):
+        '''Forgets the metrics of this process'''
+
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def collect(self):
+        '''Returns (counters, histograms) dicts added up over all processes'''
+        snapshots = []
+
+        if self.directory is None:
+            snapshots.append(self.snapshot())
+        else:
+            self.flush(force=True)
+
+            for filename in os.listdir(self.directory):
+
+                if not filename.endswith('.json'):
+                    continue
+
+                try:
+                    with open(os.path.join(self.directory, filename)) as fp:
+                        snapshots.append(json.load(fp))
+                except (IOError, ValueError):
+                    continue
+
+        counters = {}
+        histograms = {}
+
+        for snapshot in snapshots:
+
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(values))
+
+                for index, value in enumerate(values):
+                    total[index] += value
+
+        return counters, histograms
+
+    def render(self):
+        '''Returns all the metrics in the prometheus text format'''
+        counters, histograms = self.collect()
+        samples = {}
+
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(
+                '{0}{1} {2}'.format(name, _format_labels(labels), value),
+            )
+
+        for (name, labels), values in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets]
+
+            for bound, count in zip(bounds + ['+Inf'], values[:-2]):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels + (('le', bound),)),
+                    cumulative,
+                ))
+
+            lines.append('{0}_sum{1} {2!r}'.format(
+                name, _format_labels(labels), float(values[-2]),
+            ))
+            lines.append('{0}_count{1} {2}'.format(
+                name, _format_labels(labels), values[-1],
+            ))
+
+        output = []
+
+        for name in sorted(samples):
+
+            if name in self.help:
+                kind, text = self.help[name]
+                output.append('# HELP {0} {1}'.format(name, text))
+                output.append('# TYPE {0} {1}'.format(name, kind))
+
+            output.extend(samples[name])
+
+        return '\n'.join(output) + '\n'
+
+    def init_app(self, flask_app):
+        '''
+        Makes the metrics available as flask_app.metrics and records the
+        count and duration of every request.
+        '''
+        flask_app.metrics = self
+        self.describe(
+            'email_service_requests_total', 'counter',
+            'Requests handled, by route, method and status code.',
+        )
+        self.describe(
+            'email_service_request_duration_seconds', 'histogram',
+            'Time spent handling requests, by route.',
+        )
+        self.describe(
+            'email_service_backend_send_duration_seconds', 'histogram',
+            'Time spent sending emails with a backend, by outcome.',
+        )
+        self.describe(
+            'email_service_backend_errors_total', 'counter',
+            'ServerException and ClientException raised by the backends.',
+        )
+        self.describe(
+            'email_service_failovers_total', 'counter',
+            'Emails handed over to the next backend after a backend failed.',
+        )
+        self.describe(
+            'email_service_suppressed_recipients_total', 'counter',
+            'Recipients left out of emails because they are suppressed.',
+        )
+        self.describe(
+            'email_service_rejected_recipients_total', 'counter',
+            'Recipients a backend refused while sending the email to others.',
+        )
+        self.describe(
+            'email_service_coalesced_emails_total', 'counter',
+            'Emails of concurrent requests merged into shared provider calls.',
+        )
+        self.describe(
+            'email_service_shed_emails_total', 'counter',
+            'Emails refused because too many were being sent at once.',
+        )
+        self.describe(
+            'email_service_webhook_events_total', 'counter',
+            'Events received from the provider webhooks, by type.',
+        )
+
+        @flask_app.before_request
+        def start_timer():
+            g.request_started_at = time.time()
+
+        @flask_app.after_request
+        def record_request(response):
+            started_at = getattr(g, 'request_started_at', None)
+            route = (
+                request.url_rule.rule if request.url_rule else 'unmatched'
+            )
+
+            self.inc('email_service_requests_total', (
+                ('route', route), ('method', request.method),
+                ('status', response.status_code),
+            ))
+
+            if started_at is not None:
+                self.observe(
+                    'email_service_request_duration_seconds',
+                    (('route', route),), time.time() - started_at,
+                )
+
+            self.flush()
+
+            return response
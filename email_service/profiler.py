@@ -0,0 +1,138 @@
+'''Sampling profiler writing the collapsed stacks of a live worker'''
+import os
+import time
+import signal
+from collections import Counter
+
+
+def collapse(frame):
+    '''
+    Returns the stack of frame as a line of the collapsed stack format read
+    by flamegraph.pl, outermost function first
+    '''
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        names.append('{0} ({1}:{2})'.format(
+            code.co_name, code.co_filename, code.co_firstlineno,
+        ))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    '''
+    Samples the running stack of the process every `interval` seconds of cpu
+    time, using SIGPROF, and counts the stacks. Idle time isn't sampled, so
+    the counts show where the cpu time goes. Profiles stop after `duration`
+    seconds, or when stop is called, and are written to
+    <directory>/profile-<pid>-<time>.folded, one "stack count" line per
+    stack. Signals can only be handled by the main thread, which is the one
+    sampled, or the running greenlet in a gevent worker.
+    '''
+
+    def __init__(self, directory, interval=0.005, duration=60):
+        self.directory = directory
+        self.interval = interval
+        self.duration = duration
+        self.stacks = Counter()
+        self.started_at = None
+
+    @property
+    def running(self):
+        '''True while the process is being sampled'''
+        return self.started_at is not None
+
+    def sample(self, signum, frame):
+        '''SIGPROF handler counting the stack it interrupted'''
+
+        if not self.running:
+            return
+
+        self.stacks[collapse(frame)] += 1
+
+        if time.time() - self.started_at >= self.duration:
+            self.stop()
+
+    def start(self):
+        '''Starts sampling, unless the process is already being sampled'''
+
+        if self.running:
+            return
+
+        self.stacks.clear()
+        self.started_at = time.time()
+        signal.signal(signal.SIGPROF, self.sample)
+        # let system calls interrupted by a sample carry on
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        '''Stops sampling and returns the path of the profile written'''
+
+        if not self.running:
+            return None
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.started_at = None
+
+        return self.write()
+
+    def toggle(self, signum=None, frame=None):
+        '''Signal handler starting the profiler, or stopping it if it runs'''
+
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def write(self):
+        '''Writes the stacks counted so far, returns the path of the file'''
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        path = os.path.join(self.directory, 'profile-{0}-{1}.folded'.format(
+            os.getpid(), time.strftime('%Y%m%dT%H%M%S'),
+        ))
+
+        with open(path, 'w') as profile_file:
+
+            for stack, count in self.stacks.most_common():
+                profile_file.write('{0} {1}\n'.format(stack, count))
+
+        return path
+
+    def install(self, signum):
+        '''Makes signum toggle the profiler'''
+        signal.signal(signum, self.toggle)
+        signal.siginterrupt(signum, False)
+
+
+def init_profiler(flask_app):
+    '''
+    Lets PROFILER_SIGNAL toggle a profiler of the current process, and starts
+    it right away if PROFILER_ON_START is set. Returns the profiler, or None
+    if neither is configured.
+    '''
+    config = flask_app.config
+
+    if not (config['PROFILER_SIGNAL'] or config['PROFILER_ON_START']):
+        return None
+
+    profiler = SamplingProfiler(
+        config['PROFILER_DIR'],
+        interval=config['PROFILER_INTERVAL'],
+        duration=config['PROFILER_DURATION'],
+    )
+
+    if config['PROFILER_SIGNAL']:
+        profiler.install(getattr(signal, config['PROFILER_SIGNAL']))
+
+    if config['PROFILER_ON_START']:
+        profiler.start()
+
+    return profiler
@@ -1,40 +1,175 @@
-'''API json schemas'''
+'''
+API json schemas. jsonschema and aniso8601 are imported when they are first
+needed, so importing the schemas is cheap.
+'''
+import re
+import calendar
+
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]*\Z')
+
+_format_checker = None
+
+
+def is_email(instance):
+    '''Checks email addresses with a precompiled regex'''
+
+    if not isinstance(instance, basestring):
+        return True
+
+    return EMAIL_RE.match(instance) is not None
+
+
+def parse_timestamp(value):
+    '''
+    Returns the unix timestamp of an ISO 8601 date and time, taken as UTC
+    unless it has an offset
+    '''
+    import aniso8601
+
+    moment = aniso8601.parse_datetime(value)
+
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+
+
+def is_datetime(instance):
+    '''Checks ISO 8601 dates and times'''
+
+    if not isinstance(instance, basestring):
+        return True
+
+    parse_timestamp(instance)
+
+    return True
+
+
+def get_format_checker():
+    '''Returns the format checker of the api schemas, created on first use'''
+    global _format_checker
+
+    if _format_checker is None:
+        import jsonschema
+
+        checker = jsonschema.FormatChecker(())
+        checker.checks('email')(is_email)
+        checker.checks('date-time', raises=ValueError)(is_datetime)
+        _format_checker = checker
+
+    return _format_checker
+
+
+email_list_schema = {
+    'type': 'array',
+    'items': {
+        'type': 'string',
+        'format': 'email',
+    },
+    'minItems': 1,
+}
 
 email_api_schema = {
     'type': 'object',
     'properties': {
-        'to': {
+        'to': email_list_schema,
+        'from_email': {'type': 'string', 'format': 'email'},
+        'from_name': {'type': 'string'},
+        'cc': email_list_schema,
+        'bcc': email_list_schema,
+        'subject': {'type': 'string', 'minLength': 1},
+        'text': {'type': 'string', 'minLength': 1},
+        'html': {'type': 'string', 'minLength': 1},
+        'headers': {'type': 'object'},
+        'template_id': {'type': 'string', 'minLength': 1},
+        'template_version': {'type': 'integer', 'minimum': 1},
+        'context': {'type': 'object'},
+        'send_at': {'type': 'string', 'format': 'date-time'},
+    },
+    # keys like attachments and tenant are only set by the service
+    'additionalProperties': False,
+    'anyOf': [
+        {'required': ['to', 'subject', 'text']},
+        {'required': ['to', 'subject', 'html']},
+        {'required': ['to', 'template_id']}
+    ]
+}
+
+email_template_schema = {
+    'type': 'object',
+    'properties': {
+        'from_email': {'type': 'string', 'format': 'email'},
+        'from_name': {'type': 'string'},
+        'subject': {'type': 'string', 'minLength': 1},
+        'text': {'type': 'string', 'minLength': 1},
+        'html': {'type': 'string', 'minLength': 1},
+        'headers': {'type': 'object'},
+        'template_id': {'type': 'string', 'minLength': 1},
+        'template_version': {'type': 'integer', 'minimum': 1},
+        'context': {'type': 'object'},
+    },
+    'additionalProperties': False,
+    'anyOf': [
+        {'required': ['subject', 'text']},
+        {'required': ['subject', 'html']},
+        {'required': ['template_id']}
+    ]
+}
+
+template_api_schema = {
+    'type': 'object',
+    'properties': {
+        'subject': {'type': 'string', 'minLength': 1},
+        'text': {'type': 'string', 'minLength': 1},
+        'html': {'type': 'string', 'minLength': 1},
+    },
+    'anyOf': [
+        {'required': ['subject', 'text']},
+        {'required': ['subject', 'html']}
+    ]
+}
+
+suppression_api_schema = {
+    'type': 'object',
+    'properties': {
+        'entries': {
             'type': 'array',
-            'items': {
-                'type': 'string',
-                'format': 'email',
-            },
+            'items': {'type': 'string', 'minLength': 1, 'maxLength': 254},
             'minItems': 1,
+            'maxItems': 100000,
         },
-        'from_email': {'type': 'string', 'format': 'email'},
-        'from_name': {'type': 'string'},
-        'cc': {
+        'reason': {'type': 'string', 'maxLength': 255},
+    },
+    'required': ['entries'],
+}
+
+email_batch_api_schema = {
+    'type': 'object',
+    'properties': {
+        'messages': {
             'type': 'array',
-            'items': {
-                'type': 'string',
-                'format': 'email',
-            },
+            'items': email_api_schema,
             'minItems': 1,
+            'maxItems': 10000,
         },
-        'bcc': {
+        'template': email_template_schema,
+        'recipients': {
             'type': 'array',
             'items': {
-                'type': 'string',
-                'format': 'email',
+                'type': 'object',
+                'properties': {
+                    'email': {'type': 'string', 'format': 'email'},
+                    'substitutions': {
+                        'type': 'object',
+                        'additionalProperties': {'type': 'string'},
+                    },
+                },
+                'required': ['email'],
             },
             'minItems': 1,
+            'maxItems': 10000,
         },
-        'subject': {'type': 'string', 'minLength': 1},
-        'text': {'type': 'string', 'minLength': 1},
-        'html': {'type': 'string', 'minLength': 1},
     },
-    'anyOf': [
-        {'required': ['to', 'subject', 'text']},
-        {'required': ['to', 'subject', 'html']}
+    'oneOf': [
+        {'required': ['messages']},
+        {'required': ['template', 'recipients']}
     ]
 }
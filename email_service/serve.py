@@ -0,0 +1,41 @@
+'''
+Serves the api from a single gevent process, without gunicorn. Every request
+runs in its own greenlet, so a process holds up to SERVER_CONNECTIONS
+requests, and their provider calls, at once. Run one process per core behind
+a load balancer, with HTTP_POOL_SIZE as large as SERVER_CONNECTIONS.
+'''
+from gevent import monkey
+monkey.patch_all(subprocess=True)
+
+import os
+import signal
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import app, start_worker
+
+
+def main():
+    '''
+    Serves requests on $PORT until the process gets SIGTERM or SIGINT, then
+    writes the webhook events and send attempts still buffered
+    '''
+    server = WSGIServer(
+        ('0.0.0.0', int(os.environ.get('PORT', 7000))), app,
+        spawn=Pool(app.config['SERVER_CONNECTIONS']), log=None,
+    )
+    start_worker(app)
+
+    # requests in flight get as long as a send may take to finish
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        gevent.signal(signum, server.stop, app.config['SEND_DEADLINE'])
+
+    server.serve_forever()
+    app.event_buffer.flush()
+    app.send_log.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+'''
+Suppresses the addresses and domains listed in a file, one per line. Every
+worker picks them up within SUPPRESSION_RELOAD_INTERVAL.
+'''
+import argparse
+
+from app import app
+
+
+def main():
+    '''Loads the files given on the command line into the suppression list'''
+    argument_parser = argparse.ArgumentParser(description=__doc__.strip())
+    argument_parser.add_argument('paths', nargs='+')
+    argument_parser.add_argument('--reason')
+    options = argument_parser.parse_args()
+
+    for path in options.paths:
+        added = app.suppression_list.load_file(path, options.reason)
+        print path, added, 'added'
+
+
+if __name__ == '__main__':
+    main()
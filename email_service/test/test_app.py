@@ -0,0 +1,72 @@
+import json
+import unittest
+
+import mock
+
+from app import app, create_app
+from email_service import decorators, timing
+
+
+class TestCases(unittest.TestCase):
+
+    def test_config_overrides_settings(self):
+        '''
+        Assert that the config given to create_app overrides the settings
+        file, When creating another app
+        '''
+        other_app = create_app({'BATCH_SIZE': 7})
+        self.assertEquals(other_app.config['BATCH_SIZE'], 7)
+        self.assertEquals(
+            other_app.config['DEFAULT_FROM_EMAIL'],
+            app.config['DEFAULT_FROM_EMAIL'],
+        )
+        self.assertIsNot(other_app.outbox, app.outbox)
+
+    def test_apps_serve_the_api(self):
+        '''
+        Assert that an app created by the factory has the api routes
+        '''
+        response = create_app({}).test_client().get(
+            '/api/v1/health', headers={'Accept': 'application/json'},
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data), {'status': 'ok'})
+
+    def test_timing_log_fields(self):
+        '''
+        Assert that the stage timings of a request are logged as key=value
+        fields, When TIMING_LOG is set
+        '''
+        other_app = create_app({'TIMING_LOG': True})
+
+        with mock.patch.object(timing.logger, 'info') as info:
+            other_app.test_client().get(
+                '/api/v1/health', headers={'Accept': 'application/json'},
+            )
+
+        fields = dict(
+            field.split('=', 1) for field in info.call_args[0][0].split()
+        )
+        self.assertEquals(fields['method'], 'GET')
+        self.assertEquals(fields['route'], '/api/v1/health')
+        self.assertEquals(fields['status'], '200')
+        self.assertIn('total_ms', fields)
+
+    def test_validators_compiled_once(self):
+        '''
+        Assert that a schema is compiled on first use only, When
+        compile_validators runs again
+        '''
+        validator = decorators.SchemaValidator({'type': 'object'})
+        self.assertIsNone(validator.validator)
+
+        decorators.compile_validators()
+        compiled = validator.validator
+        self.assertIsNotNone(compiled)
+
+        decorators.compile_validators()
+        self.assertIs(validator.compile(), compiled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,248 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from flask import g
+
+from app import app
+from auth import ApiKeyStore, digest_of
+from mail.suppression import SuppressionList
+from mail.templates import TemplateStore
+from views import tenant_payload
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ApiKeyStore(':memory:', refresh_interval=None)
+        app.api_key_store = self.store
+        app.config['API_KEYS_REQUIRED'] = True
+        self.client = app.test_client()
+        self.key_id, self.key = self.store.create('acme')
+
+    def tearDown(self):
+        app.config['API_KEYS_REQUIRED'] = False
+
+    def get_template(self, headers):
+        headers = dict(headers, accept='application/json')
+        return self.client.get('/api/v1/templates/welcome', headers=headers)
+
+    def test_key_is_verified(self):
+        '''
+        Assert that the tenant of a key is returned, and None for unknown keys
+        '''
+        self.assertEquals(self.store.verify(self.key), 'acme')
+        self.assertIsNone(self.store.verify(self.key + '0'))
+        self.assertIsNone(self.store.verify(''))
+
+    def test_keys_are_stored_hashed(self):
+        '''
+        Assert that only the digest and a short prefix of a key are stored
+        '''
+        digest, prefix = self.store.connection.execute(
+            'SELECT digest, prefix FROM api_keys',
+        ).fetchone()
+        self.assertEquals(digest, digest_of(self.key))
+        self.assertTrue(self.key.startswith(prefix))
+        self.assertLess(len(prefix), len(self.key) / 2)
+        self.assertNotIn('digest', self.store.list()[0])
+
+    def test_verified_and_rejected_keys_are_cached(self):
+        '''
+        Assert that the store isn't queried again, When a key was already
+        verified or rejected
+        '''
+        self.store.verify(self.key)
+        self.store.verify('es_unknown')
+        self.store.connection.execute('DELETE FROM api_keys')
+        self.assertEquals(self.store.verify(self.key), 'acme')
+        self.assertIsNone(self.store.verify('es_unknown'))
+        self.assertEquals(len(self.store.cache), 1)
+        self.assertEquals(len(self.store.negative_cache), 1)
+
+    def test_revoked_key_is_rejected(self):
+        '''
+        Assert that a cached key is rejected, When it was revoked
+        '''
+        self.assertEquals(self.store.verify(self.key), 'acme')
+        self.assertTrue(self.store.revoke(self.key_id))
+        self.assertIsNone(self.store.verify(self.key))
+        self.assertFalse(self.store.revoke(self.key_id))
+
+    def test_revocation_reaches_other_processes(self):
+        '''
+        Assert that another process rejects a revoked key, When its refresh
+        interval has passed
+        '''
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'apikeys.db')
+
+        try:
+            writer = ApiKeyStore(path)
+            reader = ApiKeyStore(path, refresh_interval=0)
+            key_id, key = writer.create('acme')
+            self.assertEquals(reader.verify(key), 'acme')
+
+            writer.revoke(key_id)
+            self.assertIsNone(reader.verify(key))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_request_without_key_is_unauthorized(self):
+        '''
+        Assert that 401 is returned with a WWW-Authenticate header, When the
+        request has no key or an invalid one
+        '''
+
+        for headers in ({}, {'authorization': 'Bearer es_invalid'}):
+            response = self.get_template(headers)
+            self.assertEquals(response.status_code, 401)
+            self.assertEquals(response.headers['WWW-Authenticate'], 'Bearer')
+            self.assertEquals(json.loads(response.data)['message'], 'error')
+
+    def test_request_with_key_is_served(self):
+        '''
+        Assert that the request is served, When it has a valid key as a bearer
+        token or in the X-Api-Key header
+        '''
+
+        for headers in ({'authorization': 'Bearer ' + self.key},
+                        {'x-api-key': self.key}):
+            self.assertEquals(self.get_template(headers).status_code, 404)
+
+    def test_idempotency_keys_are_scoped_by_tenant(self):
+        '''
+        Assert that each tenant gets its own response, When two tenants use
+        the same idempotency key
+        '''
+        _, other_key = self.store.create('globex')
+        ids = []
+
+        for key, address in ((self.key, 'a@example.com'),
+                             (other_key, 'b@example.com')):
+            response = self.client.post(
+                '/api/v1/emails?async=1', data=json.dumps({
+                    'to': [address], 'subject': 'Hi', 'text': 'Hello',
+                }), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                    'authorization': 'Bearer ' + key,
+                    'idempotency-key': 'shared',
+                },
+            )
+            self.assertEquals(response.status_code, 202)
+            self.assertNotIn('Idempotent-Replayed', response.headers)
+            ids.append(json.loads(response.data)['id'])
+
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_templates_are_isolated_by_tenant(self):
+        '''
+        Assert that a tenant can't read or overwrite the template of another
+        tenant with the same name
+        '''
+        _, other_key = self.store.create('globex')
+        headers = {
+            'content-type': 'application/json',
+            'accept': 'application/json',
+            'authorization': 'Bearer ' + self.key,
+        }
+        response = self.client.put(
+            '/api/v1/templates/welcome', data=json.dumps({
+                'subject': 'Welcome', 'text': 'Hi',
+            }), headers=headers,
+        )
+        self.assertEquals(response.status_code, 201)
+
+        other_headers = dict(headers, authorization='Bearer ' + other_key)
+        self.assertEquals(self.get_template(other_headers).status_code, 404)
+        response = self.client.put(
+            '/api/v1/templates/welcome', data=json.dumps({
+                'subject': 'Other', 'text': 'Hi',
+            }), headers=other_headers,
+        )
+        self.assertEquals(json.loads(response.data)['version'], 1)
+
+        template = json.loads(self.get_template(headers).data)
+        self.assertEquals(template['subject'], 'Welcome')
+
+    def test_client_cannot_pick_a_tenant_without_keys(self):
+        '''
+        Assert that an email isn't rendered from the template of another
+        tenant, When keys aren't required and the payload names a tenant
+        '''
+        app.config['API_KEYS_REQUIRED'] = False
+        template_store = app.template_store
+        app.template_store = TemplateStore(':memory:')
+        app.template_store.save('welcome', 'Secret', text='Hi', tenant='acme')
+        payload = {
+            'to': ['tapan.pandita@gmail.com'],
+            'template_id': 'welcome',
+            'tenant': 'acme',
+        }
+
+        with mock.patch('mail.backends.SendgridBackend.send_messages') as send:
+            response = self.client.post(
+                '/api/v1/emails', data=json.dumps(payload), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                },
+            )
+
+        app.template_store = template_store
+        self.assertEquals(response.status_code, 400)
+        self.assertFalse(send.called)
+
+        with app.test_request_context():
+            g.tenant = None
+            self.assertNotIn('tenant', tenant_payload(payload))
+
+    def test_suppressions_need_an_admin_key(self):
+        '''
+        Assert that 403 is returned, When a key of a tenant that isn't in
+        ADMIN_TENANTS changes or reads the suppression list
+        '''
+        headers = {
+            'content-type': 'application/json',
+            'accept': 'application/json',
+            'authorization': 'Bearer ' + self.key,
+        }
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        app.suppression_list.add(['a@example.com'])
+        responses = [
+            self.client.post('/api/v1/suppressions', data=json.dumps({
+                'entries': ['b@example.com'],
+            }), headers=headers),
+            self.client.get('/api/v1/suppressions/a@example.com',
+                            headers=headers),
+            self.client.delete('/api/v1/suppressions/a@example.com',
+                               headers=headers),
+        ]
+        self.assertEquals(
+            [response.status_code for response in responses], [403] * 3,
+        )
+        self.assertTrue(app.suppression_list.is_suppressed('a@example.com'))
+
+        with mock.patch.dict(app.config, {'ADMIN_TENANTS': ['acme']}):
+            response = self.client.delete(
+                '/api/v1/suppressions/a@example.com', headers=headers,
+            )
+
+        self.assertEquals(response.status_code, 200)
+
+    def test_health_needs_no_key(self):
+        '''
+        Assert that the health check is served, When the request has no key
+        '''
+        response = self.client.get(
+            '/api/v1/health', headers={'accept': 'application/json'},
+        )
+        self.assertEquals(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+import mock
+
+from app import app
+from mail import breaker
+from mail.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from mail.message import EmailMessage
+from mail.suppression import SuppressionList
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            'sendgrid', failure_threshold=2, reset_timeout=30,
+            slow_call_threshold=5,
+        )
+
+    def test_breaker_opens_after_threshold(self):
+        '''
+        Assert that the breaker opens after consecutive failures
+        '''
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, CLOSED)
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_failure_count(self):
+        '''
+        Assert that only consecutive failures open the breaker
+        '''
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, CLOSED)
+
+    def test_slow_calls_count_as_failures(self):
+        '''
+        Assert that calls slower than the threshold are failures
+        '''
+        self.breaker.record_success(10)
+        self.breaker.record_success(10)
+        self.assertEquals(self.breaker.state, OPEN)
+
+    def test_half_open_breaker_allows_single_probe(self):
+        '''
+        Assert that a half open breaker lets one request through at a time
+        and closes when it succeeds
+        '''
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        with mock.patch('time.time', return_value=self.breaker.opened_at + 30):
+            self.assertEquals(self.breaker.state, HALF_OPEN)
+            self.assertTrue(self.breaker.allow_request())
+            self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.record_success()
+        self.assertEquals(self.breaker.state, CLOSED)
+
+    def test_failed_probe_opens_breaker_again(self):
+        '''
+        Assert that a failing probe request opens the breaker again
+        '''
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        with mock.patch('time.time', return_value=self.breaker.opened_at + 30):
+            self.breaker.allow_request()
+
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, OPEN)
+
+    def test_unsettled_probe_lets_another_through(self):
+        '''
+        Assert that a half open breaker lets another probe through, When the
+        send of the probe raised an unexpected error
+        '''
+        backend = mock.Mock()
+        backend.name = 'sendgrid'
+        backend.send_messages.side_effect = ValueError()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        app.metrics.reset()
+        breaker._breakers['sendgrid'] = self.breaker
+
+        app.suppression_list = SuppressionList(
+            ':memory:', reload_interval=None,
+        )
+        half_open_at = self.breaker.opened_at + 30
+
+        with app.app_context():
+            message = EmailMessage(to=['a@example.com'], text='One')
+
+            with mock.patch('time.time', return_value=half_open_at):
+
+                with mock.patch.object(EmailMessage, 'ordered_backends',
+                                       return_value=[backend]):
+
+                    with self.assertRaises(ValueError):
+                        message.send()
+
+                self.assertTrue(self.breaker.allow_request())
+
+        breaker.reset()
+
+
+if __name__ == '__main__':
+    unittest.main()
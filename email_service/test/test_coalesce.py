@@ -0,0 +1,234 @@
+import json
+import threading
+import unittest
+from urlparse import parse_qs
+
+import responses
+
+from app import app
+from mail import breaker
+from mail.coalesce import Coalescer
+from mail.exceptions import ClientException, DeadlineExceeded
+from mail.suppression import SuppressionList
+
+
+def concurrently(fn, arguments):
+    '''Calls fn with every argument in its own thread, returns the results'''
+    results = [None] * len(arguments)
+
+    def call(index):
+
+        try:
+            results[index] = fn(arguments[index])
+        except Exception, excp:
+            results[index] = excp
+
+    threads = [
+        threading.Thread(target=call, args=(index,))
+        for index in range(len(arguments))
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        breaker.reset()
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        self.flushes = []
+
+    def tearDown(self):
+        app.coalescer = Coalescer(window=None)
+
+    def flush(self, items):
+        self.flushes.append(items)
+        return [
+            ClientException(400, {}) if item == 'bad' else item.upper()
+            for item in items
+        ]
+
+    def test_items_with_same_key_are_flushed_together(self):
+        '''
+        Assert that concurrent items with the same key are flushed with one
+        call and every item gets its own result
+        '''
+        coalescer = Coalescer(window=0.1)
+        results = concurrently(
+            lambda item: coalescer.submit('key', item, self.flush),
+            ['a', 'b', 'c'],
+        )
+        self.assertEquals(results, ['A', 'B', 'C'])
+        self.assertEquals(len(self.flushes), 1)
+
+    def test_items_with_different_keys_are_flushed_apart(self):
+        '''
+        Assert that items are flushed separately, When their keys differ
+        '''
+        coalescer = Coalescer(window=0.05)
+        results = concurrently(
+            lambda item: coalescer.submit(item, item, self.flush), ['a', 'b'],
+        )
+        self.assertEquals(results, ['A', 'B'])
+        self.assertEquals(len(self.flushes), 2)
+
+    def test_full_group_is_flushed_early(self):
+        '''
+        Assert that a group is flushed before the window ends, When max_size
+        items joined it
+        '''
+        coalescer = Coalescer(window=30, max_size=2)
+        results = concurrently(
+            lambda item: coalescer.submit('key', item, self.flush), ['a', 'b'],
+        )
+        self.assertEquals(results, ['A', 'B'])
+
+    def test_failed_item_raises_in_its_request(self):
+        '''
+        Assert that only the request of an item that failed gets its error
+        '''
+        coalescer = Coalescer(window=0.1)
+        results = concurrently(
+            lambda item: coalescer.submit('key', item, self.flush),
+            ['a', 'bad'],
+        )
+        self.assertEquals(results[0], 'A')
+        self.assertTrue(isinstance(results[1], ClientException))
+
+    def test_follower_times_out(self):
+        '''
+        Assert that DeadlineExceeded is raised, When the group isn't flushed
+        within the timeout of a request
+        '''
+        coalescer = Coalescer(window=0.2)
+        leader = threading.Thread(
+            target=coalescer.submit, args=('key', 'a', self.flush),
+        )
+        leader.start()
+
+        while not coalescer.pending:
+            pass
+
+        with self.assertRaises(DeadlineExceeded):
+            coalescer.submit('key', 'b', self.flush, timeout=0.01)
+
+        leader.join()
+
+    @responses.activate
+    def test_concurrent_requests_share_a_provider_call(self):
+        '''
+        Assert that concurrent requests with the same content are sent with
+        one sendgrid call, each recipient in the X-SMTPAPI header, and every
+        request gets a result
+        '''
+        app.coalescer = Coalescer(window=0.2)
+        responses.add(
+            responses.POST, 'https://api.sendgrid.com/api/mail.send.json',
+            body=json.dumps({'message': 'success'}), status=200,
+            content_type='application/json',
+        )
+        addresses = [
+            'tapan.pandita@gmail.com', 'tapan.pandita+1@gmail.com',
+            'tapan.pandita+2@gmail.com',
+        ]
+
+        def send(address):
+            response = app.test_client().post(
+                '/api/v1/emails', data=json.dumps({
+                    'to': [address],
+                    'subject': 'Coalesce test',
+                    'text': 'Same text for everyone',
+                }), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                },
+            )
+            return response.status_code, json.loads(response.data)
+
+        results = concurrently(send, addresses)
+        self.assertEquals(len(responses.calls), 1)
+        self.assertEquals(
+            [status_code for status_code, _ in results], [200] * 3,
+        )
+        self.assertEquals(
+            [result['backend'] for _, result in results], ['sendgrid'] * 3,
+        )
+        smtpapi = json.loads(
+            parse_qs(responses.calls[0].request.body)['x-smtpapi'][0],
+        )
+        self.assertEquals(sorted(smtpapi['to']), sorted(addresses))
+
+    @responses.activate
+    def test_requests_with_other_deadlines_are_sent_apart(self):
+        '''
+        Assert that concurrent requests with the same content are sent with
+        separate sendgrid calls, When they asked for different deadlines
+        '''
+        app.coalescer = Coalescer(window=0.2)
+        responses.add(
+            responses.POST, 'https://api.sendgrid.com/api/mail.send.json',
+            body=json.dumps({'message': 'success'}), status=200,
+            content_type='application/json',
+        )
+
+        def send(timeout):
+            headers = {
+                'content-type': 'application/json',
+                'accept': 'application/json',
+            }
+
+            if timeout is not None:
+                headers[app.config['SEND_DEADLINE_HEADER']] = timeout
+
+            return app.test_client().post(
+                '/api/v1/emails', data=json.dumps({
+                    'to': ['tapan.pandita@gmail.com'],
+                    'subject': 'Coalesce test',
+                    'text': 'Same text for everyone',
+                }), headers=headers,
+            ).status_code
+
+        self.assertEquals(concurrently(send, [None, '5000']), [200, 200])
+        self.assertEquals(len(responses.calls), 2)
+
+    @responses.activate
+    def test_suppressed_request_fails_alone(self):
+        '''
+        Assert that only the request to a suppressed address gets a 400, When
+        it was coalesced with others
+        '''
+        app.coalescer = Coalescer(window=0.2)
+        app.suppression_list.add(['tapan.pandita+1@gmail.com'])
+        # in-memory databases aren't shared with the request threads
+        app.suppression_list.load()
+        responses.add(
+            responses.POST, 'https://api.sendgrid.com/api/mail.send.json',
+            body=json.dumps({'message': 'success'}), status=200,
+            content_type='application/json',
+        )
+
+        def send(address):
+            return app.test_client().post(
+                '/api/v1/emails', data=json.dumps({
+                    'to': [address],
+                    'subject': 'Coalesce test',
+                    'text': 'Same text for everyone',
+                }), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                },
+            ).status_code
+
+        self.assertEquals(concurrently(send, [
+            'tapan.pandita@gmail.com', 'tapan.pandita+1@gmail.com',
+        ]), [200, 400])
+
+
+if __name__ == '__main__':
+    unittest.main()
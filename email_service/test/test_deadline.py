@@ -0,0 +1,38 @@
+import unittest
+
+import mock
+
+from mail.deadline import Deadline
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('time.time', return_value=100):
+            self.deadline = Deadline(10, connect_timeout=3)
+
+    def test_budget_is_split_between_remaining_attempts(self):
+        '''
+        Assert that the read timeout is an even share of the time left
+        '''
+        with mock.patch('time.time', return_value=102):
+            self.assertEquals(self.deadline.timeout(2), (3, 4))
+
+    def test_connect_timeout_never_exceeds_share(self):
+        '''
+        Assert that the connect timeout is capped by the time left
+        '''
+        with mock.patch('time.time', return_value=109):
+            self.assertEquals(self.deadline.timeout(1), (1, 1))
+
+    def test_deadline_expires(self):
+        '''
+        Assert that the deadline is expired once the budget is used up
+        '''
+        with mock.patch('time.time', return_value=111):
+            self.assertTrue(self.deadline.expired)
+            self.assertEquals(self.deadline.remaining(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,28 @@
 import re
 import json
+import hashlib
 import unittest
+from StringIO import StringIO
+from urlparse import parse_qs
 
+import mock
+import requests
 import responses
+from requests.packages.urllib3.exceptions import ProtocolError
 
 from app import app
+from mail import breaker
+from mail.ratelimit import RateLimiter
+from mail.suppression import SuppressionList
 
 
 class TestCases(unittest.TestCase):
 
     def setUp(self):
+        breaker.reset()
+        app.metrics.reset()
+        app.rate_limiter = RateLimiter(':memory:')
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
         self.client = app.test_client()
         self.headers = {
             'content-type': 'application/json',
@@ -41,6 +54,22 @@ class TestCases(unittest.TestCase):
         }
         self.incomplete_email_payload = {
         }
+        self.template_batch_payload = {
+            'template': {
+                'subject': 'Hello %name%',
+                'text': 'Your code is %code%',
+            },
+            'recipients': [
+                {
+                    'email': 'tapan.pandita@gmail.com',
+                    'substitutions': {'name': 'Tapan', 'code': '1'},
+                },
+                {
+                    'email': 'tapan.pandita+1@gmail.com',
+                    'substitutions': {'name': 'Pandita', 'code': '2'},
+                },
+            ],
+        }
         self.sendgrid_url = 'https://api.sendgrid.com/api/mail.send.json'
         self.mailgun_url = 'https://api.mailgun.net/v2/tapandita.com/messages'
 
@@ -70,6 +99,34 @@ class TestCases(unittest.TestCase):
             self.mailgun_url, response_code, response_body,
         )
 
+    def mock_sendgrid_timeout(self):
+        '''
+        Makes requests to the sendgrid api time out
+        '''
+        post = requests.Session.post
+
+        def timeout_sendgrid(session, url, **kwargs):
+
+            if url == self.sendgrid_url:
+                raise requests.exceptions.ReadTimeout()
+
+            return post(session, url, **kwargs)
+
+        return mock.patch('requests.Session.post', timeout_sendgrid)
+
+    def make_send_email_batch_request(self, payload, headers=None):
+        '''
+        Makes api requests to the send email batch endpoint
+        '''
+
+        if not headers:
+            headers = self.headers
+
+        response = self.client.post(
+            '/api/v1/emails/batch', data=json.dumps(payload), headers=headers,
+        )
+        return response
+
     def make_health_request(self, headers=None):
         '''
         Makes api requests to the health endpoint
@@ -96,6 +153,45 @@ class TestCases(unittest.TestCase):
         )
         return response
 
+    def make_send_email_multipart_request(self, payload, attachments,
+                                          query_string=''):
+        '''
+        Makes multipart api requests with attachments to the send email
+        endpoint
+        '''
+        data = {
+            'payload': json.dumps(payload),
+            'attachments': [
+                (StringIO(content), filename)
+                for filename, content in attachments
+            ],
+        }
+
+        response = self.client.post(
+            '/api/v1/emails' + query_string, data=data,
+            content_type='multipart/form-data',
+            headers={'accept': 'application/json'},
+        )
+        return response
+
+    def capture_request_bodies(self):
+        '''
+        Reads streamed request bodies before they are sent, returns the
+        patch and the list the (url, content type, body) are appended to
+        '''
+        post = requests.Session.post
+        bodies = []
+
+        def read_body(session, url, data=None, headers=None, **kwargs):
+
+            if hasattr(data, 'read'):
+                bodies.append((url, headers['Content-Type'], data.read()))
+                data = bodies[-1][2]
+
+            return post(session, url, data=data, headers=headers, **kwargs)
+
+        return mock.patch('requests.Session.post', read_body), bodies
+
     def test_health_endpoint(self):
         '''
         Assert that the health endpoint works
@@ -103,6 +199,19 @@ class TestCases(unittest.TestCase):
         response = self.make_health_request()
         self.assertEquals(response.status_code, 200)
 
+    def test_backends_health_endpoint(self):
+        '''
+        Assert that the backends health endpoint lists breaker states
+        '''
+        response = self.client.get(
+            '/api/v1/health/backends', headers=self.headers,
+        )
+        backends = json.loads(response.data).get('backends')
+        self.assertEquals(
+            [(backend['name'], backend['state']) for backend in backends],
+            [('sendgrid', 'closed'), ('mailgun', 'closed')],
+        )
+
     def test_health_endpoint_when_client_doesnt_accept_json(self):
         '''
         Assert that the health endpoint returns NotAcceptable, 406,
@@ -191,6 +300,20 @@ class TestCases(unittest.TestCase):
         response = self.make_send_email_request(self.incomplete_email_payload)
         self.assertEquals(response.status_code, 400)
 
+    def test_send_email_endpoint_with_invalid_email_address(self):
+        '''
+        Assert that the send email endpoint returns BadResponse, 400, naming
+        the invalid field, When an address fails the email format check
+        '''
+
+        for address in ('tapandita', 'tapan.pandita@gmail.com\n'):
+            payload = dict(self.minimum_required_email_payload, to=[address])
+            response = self.make_send_email_request(payload)
+            self.assertEquals(response.status_code, 400)
+            self.assertEquals(
+                json.loads(response.data)['error']['field'], 'to',
+            )
+
     @responses.activate
     def test_send_email_endpoint_with_incorrect_payload(self):
         '''
@@ -260,6 +383,1022 @@ class TestCases(unittest.TestCase):
         )
         self.assertEquals(response.status_code, 502)
 
+    @responses.activate
+    def test_send_email_skips_backend_with_open_breaker(self):
+        '''
+        Assert that sendgrid isn't called at all,
+        When its breaker is open after repeated failures
+        '''
+        self.mock_sendgrid_response(500, {'message': 'error'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+
+        with app.app_context():
+            sendgrid_breaker = breaker.get_breaker('sendgrid')
+
+            for _ in range(sendgrid_breaker.failure_threshold):
+                sendgrid_breaker.record_failure()
+
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload,
+        )
+        self.assertEquals(json.loads(response.data).get('backend'), 'mailgun')
+        self.assertEquals(len(responses.calls), 1)
+
+    @responses.activate
+    def test_refused_probe_keeps_rate_limit_tokens(self):
+        '''
+        Assert that no token of the sendgrid rate limit is taken,
+        When its half open breaker is already being probed
+        '''
+        self.mock_mailgun_response(500, {'message': 'error'})
+        limits = {'PROVIDER_RATE_LIMITS': {'sendgrid': (1, 1)}}
+
+        with app.app_context():
+            sendgrid_breaker = breaker.get_breaker('sendgrid')
+
+            for _ in range(sendgrid_breaker.failure_threshold):
+                sendgrid_breaker.record_failure()
+
+        sendgrid_breaker.opened_at -= sendgrid_breaker.reset_timeout
+        sendgrid_breaker.probing = True
+
+        with mock.patch.dict(app.config, limits):
+            self.make_send_email_request(self.minimum_required_email_payload)
+            allowed, _ = app.rate_limiter.acquire('provider:sendgrid', 1, 1)
+
+        self.assertTrue(allowed)
+
+    @responses.activate
+    def test_send_email_uses_mailgun_when_sendgrid_times_out(self):
+        '''
+        Assert that the send email endpoint fails over to mailgun,
+        When sendgrid doesn't respond in time
+        '''
+        self.mock_mailgun_response(200, {'message': 'success'})
+
+        with self.mock_sendgrid_timeout():
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload,
+            )
+
+        self.assertEquals(json.loads(response.data).get('backend'), 'mailgun')
+
+    @responses.activate
+    def test_send_email_reports_server_timing(self):
+        '''
+        Assert that the send email response times every stage in its
+        Server-Timing header, When sendgrid fails and mailgun works
+        '''
+        self.mock_sendgrid_response(500, {'message': 'error'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload,
+        )
+        stages = [
+            re.match(r'^([\w.]+);dur=\d+\.\d{3}$', stage.strip()).group(1)
+            for stage in response.headers['Server-Timing'].split(',')
+        ]
+        self.assertEquals(stages, [
+            'parse', 'validate', 'message', 'sendgrid.payload',
+            'sendgrid.http', 'mailgun.payload', 'mailgun.http', 'total',
+        ])
+
+    @responses.activate
+    def test_send_email_uses_mailgun_when_sendgrid_aborts_connection(self):
+        '''
+        Assert that the send email endpoint fails over to mailgun,
+        When sendgrid drops the connection before responding
+        '''
+        self.mock_mailgun_response(200, {'message': 'success'})
+        post = requests.Session.post
+
+        def abort_sendgrid(session, url, **kwargs):
+
+            if url == self.sendgrid_url:
+                raise ProtocolError('Connection aborted.')
+
+            return post(session, url, **kwargs)
+
+        with mock.patch('requests.Session.post', abort_sendgrid):
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload,
+            )
+
+        self.assertEquals(json.loads(response.data).get('backend'), 'mailgun')
+
+    @responses.activate
+    def test_send_email_when_deadline_is_exceeded(self):
+        '''
+        Assert that send email endpoint returns GatewayTimeout, 504,
+        When the deadline requested by the client runs out
+        '''
+        headers = dict(self.headers)
+        headers['x-request-timeout'] = '0'
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(response.status_code, 504)
+        self.assertEquals(len(responses.calls), 0)
+
+    @responses.activate
+    def test_send_email_asynchronously(self):
+        '''
+        Assert that the send email endpoint returns Accepted, 202, and queues
+        the email without calling any provider,
+        When the client asks for an asynchronous response
+        '''
+        headers = dict(self.headers)
+        headers['prefer'] = 'respond-async'
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        message_id = json.loads(response.data).get('id')
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(len(responses.calls), 0)
+        self.assertIn(
+            (message_id, self.minimum_required_email_payload, 0),
+            app.outbox.claim(limit=100),
+        )
+
+    @responses.activate
+    def test_send_email_batch_with_template_uses_single_sendgrid_call(self):
+        '''
+        Assert that a templated batch is sent with one sendgrid call,
+        With recipients and substitutions in the X-SMTPAPI header
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        response = self.make_send_email_batch_request(
+            self.template_batch_payload,
+        )
+        results = json.loads(response.data).get('results')
+        self.assertEquals(len(responses.calls), 1)
+        self.assertEquals(
+            [result['backend'] for result in results], ['sendgrid'] * 2,
+        )
+        smtpapi = json.loads(
+            parse_qs(responses.calls[0].request.body)['x-smtpapi'][0],
+        )
+        self.assertEquals(smtpapi, {
+            'to': ['tapan.pandita@gmail.com', 'tapan.pandita+1@gmail.com'],
+            'sub': {'%name%': ['Tapan', 'Pandita'], '%code%': ['1', '2']},
+        })
+
+    @responses.activate
+    def test_send_email_batch_uses_mailgun_recipient_variables(self):
+        '''
+        Assert that a templated batch is sent with mailgun recipient
+        variables, When sendgrid is down
+        '''
+        self.mock_sendgrid_response(500, {'message': 'error'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        response = self.make_send_email_batch_request(
+            self.template_batch_payload,
+        )
+        results = json.loads(response.data).get('results')
+        self.assertEquals(
+            [result['backend'] for result in results], ['mailgun'] * 2,
+        )
+        body = parse_qs(responses.calls[1].request.body)
+        self.assertEquals(body['subject'], ['Hello %recipient.name%'])
+        self.assertEquals(
+            json.loads(body['recipient-variables'][0]),
+            {
+                'tapan.pandita@gmail.com': {'name': 'Tapan', 'code': '1'},
+                'tapan.pandita+1@gmail.com': {'name': 'Pandita', 'code': '2'},
+            },
+        )
+
+    @responses.activate
+    def test_send_email_batch_merges_messages_with_same_content(self):
+        '''
+        Assert that messages with the same content are sent together,
+        And every message gets its own result
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        same_content = [
+            dict(self.minimum_required_email_payload, to=[email])
+            for email in ['a@tapandita.com', 'b@tapandita.com']
+        ]
+        response = self.make_send_email_batch_request({
+            'messages': same_content + [self.full_email_payload],
+        })
+        results = json.loads(response.data).get('results')
+        self.assertEquals(len(responses.calls), 2)
+        self.assertEquals(
+            [result['message'] for result in results], ['success'] * 3,
+        )
+
+    @responses.activate
+    def test_send_email_batch_keeps_template_contexts_apart(self):
+        '''
+        Assert that templated messages are rendered with their own context,
+        When they use the same template with different contexts
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.client.put(
+            '/api/v1/templates/greeting',
+            data=json.dumps({
+                'subject': 'Hello {{ name }}', 'text': 'Hi {{ name }}',
+            }),
+            headers=self.headers,
+        )
+        response = self.make_send_email_batch_request({'messages': [
+            {
+                'to': [email], 'template_id': 'greeting',
+                'context': {'name': name},
+            }
+            for email, name in [
+                ('a@tapandita.com', 'Alice'), ('b@tapandita.com', 'Bob'),
+            ]
+        ]})
+        results = json.loads(response.data).get('results')
+        self.assertNotEqual(results[0]['id'], results[1]['id'])
+        subjects = sorted(
+            parse_qs(call.request.body)['subject'][0]
+            for call in responses.calls
+        )
+        self.assertEquals(subjects, ['Hello Alice', 'Hello Bob'])
+
+    @responses.activate
+    def test_send_email_batch_reports_missing_template_per_message(self):
+        '''
+        Assert that only the message with a missing template gets a 404
+        result, And the other messages are sent
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        response = self.make_send_email_batch_request({'messages': [
+            self.minimum_required_email_payload,
+            {'to': ['a@tapandita.com'], 'template_id': 'missing'},
+        ]})
+        results = json.loads(response.data).get('results')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(results[0]['message'], 'success')
+        self.assertEquals(results[1]['status_code'], 404)
+
+    @responses.activate
+    def test_send_email_batch_reports_errors_per_message(self):
+        '''
+        Assert that a rejected batch is reported in the results,
+        When sendgrid returns a client error
+        '''
+        self.mock_sendgrid_response(400, {'message': 'error'})
+        response = self.make_send_email_batch_request(
+            self.template_batch_payload,
+        )
+        results = json.loads(response.data).get('results')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            [result['status_code'] for result in results], [400, 400],
+        )
+
+    def test_send_email_batch_with_invalid_payload(self):
+        '''
+        Assert that the send email batch endpoint returns BadResponse, 400,
+        When neither messages nor a template is posted
+        '''
+        response = self.make_send_email_batch_request({'recipients': []})
+        self.assertEquals(response.status_code, 400)
+
+    @responses.activate
+    def test_send_email_with_stored_template(self):
+        '''
+        Assert that the email is rendered from a stored template,
+        When a template_id and context are posted
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        response = self.client.put(
+            '/api/v1/templates/welcome',
+            data=json.dumps({
+                'subject': 'Welcome {{ name }}',
+                'text': 'Hello {{ name }}',
+            }),
+            headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 201)
+        response = self.make_send_email_request({
+            'to': ['tapan.pandita@gmail.com'],
+            'template_id': 'welcome',
+            'context': {'name': 'Tapan'},
+        })
+        self.assertEquals(response.status_code, 200)
+        body = parse_qs(responses.calls[0].request.body)
+        self.assertEquals(body['subject'], ['Welcome Tapan'])
+        self.assertEquals(body['text'], ['Hello Tapan'])
+
+    def test_send_email_with_unknown_template(self):
+        '''
+        Assert that the send email endpoint returns NotFound, 404,
+        When the template doesn't exist
+        '''
+        response = self.make_send_email_request({
+            'to': ['tapan.pandita@gmail.com'],
+            'template_id': 'missing',
+        })
+        self.assertEquals(response.status_code, 404)
+
+    @responses.activate
+    def test_send_email_with_idempotency_key_sends_once(self):
+        '''
+        Assert that the email is sent once and the response replayed,
+        When a request is retried with the same idempotency key
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'send-once'
+        first = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        second = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(len(responses.calls), 1)
+        self.assertEquals(second.status_code, first.status_code)
+        self.assertEquals(second.data, first.data)
+        self.assertEquals(second.headers['idempotent-replayed'], 'true')
+
+    @responses.activate
+    def test_send_email_with_idempotency_key_caches_failures(self):
+        '''
+        Assert that a failed send isn't retried with the same key
+        '''
+        self.mock_sendgrid_response(400, {'message': 'error'})
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'rejected'
+        self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(len(responses.calls), 1)
+
+    @responses.activate
+    def test_send_email_with_idempotency_key_retries_transient_errors(self):
+        '''
+        Assert that a request retried with the same key is sent, When the
+        first one was rate limited
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'transient'
+        limits = {'PROVIDER_RATE_LIMITS': {
+            'sendgrid': (1, 0), 'mailgun': (1, 0),
+        }}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload, headers=headers,
+            )
+
+        self.assertEquals(response.status_code, 429)
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEquals(len(responses.calls), 1)
+
+    def test_replayed_response_keeps_its_headers(self):
+        '''
+        Assert that a replayed response has the headers of the first one
+        '''
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'queued'
+        headers['prefer'] = 'respond-async'
+        self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEquals(
+            response.headers['Preference-Applied'], 'respond-async',
+        )
+        self.assertEquals(response.headers['Content-Type'], 'application/json')
+
+    def test_send_email_with_reused_idempotency_key(self):
+        '''
+        Assert that send email endpoint returns UnprocessableEntity, 422,
+        When an idempotency key is reused for a different payload
+        '''
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'reused'
+        app.idempotency_store.claim(' /api/v1/emails reused', 'fingerprint')
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload, headers=headers,
+        )
+        self.assertEquals(response.status_code, 422)
+
+    def test_send_email_with_idempotency_key_in_progress(self):
+        '''
+        Assert that send email endpoint returns Conflict, 409,
+        When a request with the same key doesn't finish in time
+        '''
+        headers = dict(self.headers)
+        headers['idempotency-key'] = 'in-progress'
+        app.idempotency_store.claim(
+            ' /api/v1/emails in-progress',
+            hashlib.sha256(
+                json.dumps(self.minimum_required_email_payload),
+            ).hexdigest(),
+        )
+
+        with mock.patch.dict(app.config, {'IDEMPOTENCY_WAIT_TIMEOUT': 0}):
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload, headers=headers,
+            )
+
+        self.assertEquals(response.status_code, 409)
+
+    @responses.activate
+    def test_send_email_skips_backend_over_rate_limit(self):
+        '''
+        Assert that the send email endpoint uses mailgun,
+        When sendgrid is over its rate limit
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        limits = {'PROVIDER_RATE_LIMITS': {'sendgrid': (1, 1)}}
+
+        with mock.patch.dict(app.config, limits):
+            self.make_send_email_request(self.minimum_required_email_payload)
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload,
+            )
+
+        self.assertEquals(json.loads(response.data).get('backend'), 'mailgun')
+
+    @responses.activate
+    def test_send_email_when_all_backends_are_over_rate_limit(self):
+        '''
+        Assert that the send email endpoint returns TooManyRequests, 429,
+        With a Retry-After header, When every backend is over its rate limit
+        '''
+        limits = {'PROVIDER_RATE_LIMITS': {
+            'sendgrid': (0.5, 0), 'mailgun': (0.25, 0),
+        }}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload,
+            )
+
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response.headers['retry-after'], '2')
+        self.assertEquals(len(responses.calls), 0)
+
+    @responses.activate
+    def test_send_email_when_client_is_over_rate_limit(self):
+        '''
+        Assert that the send email endpoint returns TooManyRequests, 429,
+        When the client made too many requests
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+
+        with mock.patch.dict(app.config, {'CLIENT_RATE_LIMIT': (0.1, 1)}):
+            self.make_send_email_request(self.minimum_required_email_payload)
+            response = self.make_send_email_request(
+                self.minimum_required_email_payload,
+            )
+
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response.headers['retry-after'], '10')
+        self.assertEquals(len(responses.calls), 1)
+
+    @responses.activate
+    def test_metrics_endpoint_reports_failovers(self):
+        '''
+        Assert that the metrics endpoint counts backend errors and failovers,
+        When sendgrid is down and mailgun works
+        '''
+        self.mock_sendgrid_response(500, {'message': 'error'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        self.make_send_email_request(self.minimum_required_email_payload)
+        lines = self.client.get('/metrics').data.splitlines()
+        self.assertIn(
+            'email_service_failovers_total{backend="sendgrid"} 1', lines,
+        )
+        self.assertIn(
+            'email_service_backend_errors_total{backend="sendgrid",'
+            'exception="ServerException"} 1', lines,
+        )
+        self.assertIn(
+            'email_service_backend_send_duration_seconds_count'
+            '{backend="mailgun",outcome="sent"} 1', lines,
+        )
+        self.assertIn(
+            'email_service_requests_total{route="/api/v1/emails",'
+            'method="POST",status="200"} 1', lines,
+        )
+
+    @responses.activate
+    def test_send_email_with_attachments(self):
+        '''
+        Assert that attachments are streamed to sendgrid in a multipart body,
+        When the email is posted as a multipart form
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        patch, bodies = self.capture_request_bodies()
+
+        with patch:
+            response = self.make_send_email_multipart_request(
+                self.minimum_required_email_payload,
+                [('report.csv', 'a,b\n1,2\n'), ('notes.txt', 'notes')],
+            )
+
+        self.assertEquals(response.status_code, 200)
+        url, content_type, body = bodies[0]
+        self.assertEquals(url, self.sendgrid_url)
+        self.assertTrue(content_type.startswith('multipart/form-data'))
+        self.assertIn(
+            'name="files[report.csv]"; filename="report.csv"\r\n'
+            'Content-Type: text/csv\r\n\r\na,b\n1,2\n\r\n', body,
+        )
+        self.assertIn('name="files[notes.txt]"', body)
+        self.assertIn('name="subject"\r\n\r\nMinimum paylod test\r\n', body)
+
+    @responses.activate
+    def test_send_email_with_attachments_when_sendgrid_is_down(self):
+        '''
+        Assert that attachments are streamed again to mailgun,
+        When sendgrid fails after reading them
+        '''
+        self.mock_sendgrid_response(500, {'message': 'error'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        patch, bodies = self.capture_request_bodies()
+
+        with patch:
+            response = self.make_send_email_multipart_request(
+                self.minimum_required_email_payload,
+                [('notes.txt', 'notes')],
+            )
+
+        self.assertEquals(json.loads(response.data).get('backend'), 'mailgun')
+        url, _, body = bodies[1]
+        self.assertEquals(url, self.mailgun_url)
+        self.assertIn(
+            'name="attachment"; filename="notes.txt"\r\n'
+            'Content-Type: text/plain\r\n\r\nnotes\r\n', body,
+        )
+
+    @responses.activate
+    def test_send_email_with_attachments_and_idempotency_key(self):
+        '''
+        Assert that the email is sent once,
+        When a multipart request is retried with the same idempotency key
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        data = lambda: {
+            'payload': json.dumps(self.minimum_required_email_payload),
+            'attachments': [(StringIO('notes'), 'notes.txt')],
+        }
+        headers = {'accept': 'application/json', 'Idempotency-Key': 'abc'}
+
+        for _ in range(2):
+            response = self.client.post(
+                '/api/v1/emails', data=data(), headers=headers,
+                content_type='multipart/form-data',
+            )
+
+        self.assertEquals(response.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEquals(len(responses.calls), 1)
+
+    def test_send_email_with_attachments_asynchronously(self):
+        '''
+        Assert that the send email endpoint returns bad request, 400,
+        When an email with attachments should be queued
+        '''
+        response = self.make_send_email_multipart_request(
+            self.minimum_required_email_payload, [('notes.txt', 'notes')],
+            query_string='?async=1',
+        )
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(
+            json.loads(response.data)['error']['field'], 'attachments',
+        )
+
+    def test_send_email_with_internal_keys(self):
+        '''
+        Assert that the send email endpoint returns bad request, 400, and
+        queues nothing, When the json payload sets keys only the service sets
+        '''
+
+        for key, value in (('attachments', ['notes.txt']), ('tenant', 'acme')):
+            payload = dict(
+                self.minimum_required_email_payload,
+                to=['internal@tapandita.com'], **{key: value}
+            )
+
+            for query_string in ('', '?async=1'):
+                response = self.client.post(
+                    '/api/v1/emails' + query_string, data=json.dumps(payload),
+                    headers=self.headers,
+                )
+                self.assertEquals(response.status_code, 400)
+
+        claimed = app.outbox.claim_until(10 ** 10, 100, 60)
+        self.assertNotIn(
+            ['internal@tapandita.com'], [row[1]['to'] for row in claimed],
+        )
+
+    def test_send_email_multipart_with_invalid_payload(self):
+        '''
+        Assert that the send email endpoint returns bad request, 400,
+        When the payload field of a multipart request isn't valid
+        '''
+        response = self.make_send_email_multipart_request(
+            self.incomplete_email_payload, [('notes.txt', 'notes')],
+        )
+        self.assertEquals(response.status_code, 400)
+
+    def fail_sendgrid_for(self, recipient):
+        '''
+        Makes the sendgrid api unreachable for emails to the given recipient
+        '''
+        post = requests.Session.post
+
+        def fail_sendgrid(session, url, data=None, **kwargs):
+
+            if url == self.sendgrid_url and recipient in data['to']:
+                raise requests.exceptions.ConnectionError()
+
+            return post(session, url, data=data, **kwargs)
+
+        return mock.patch('requests.Session.post', fail_sendgrid)
+
+    @responses.activate
+    def test_send_email_to_more_recipients_than_backends_accept(self):
+        '''
+        Assert that the email is sent in chunks of at most the limit,
+        When it has more recipients than the backends accept in one call
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        payload = dict(
+            self.minimum_required_email_payload,
+            to=['user{0}@tapandita.com'.format(n) for n in range(5)],
+            bcc=['audit@tapandita.com'],
+        )
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2, 'mailgun': 3}}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_request(payload)
+
+        body = json.loads(response.data)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(body['message'], 'success')
+        self.assertEquals(
+            [(chunk['offset'], chunk['count']) for chunk in body['chunks']],
+            [(0, 1), (1, 2), (3, 2)],
+        )
+        bodies = [parse_qs(call.request.body) for call in responses.calls]
+        sent = sorted((body['to'], body.get('bcc')) for body in bodies)
+        self.assertEquals(sent, [
+            (['user0@tapandita.com'], ['audit@tapandita.com']),
+            (['user1@tapandita.com', 'user2@tapandita.com'], None),
+            (['user3@tapandita.com', 'user4@tapandita.com'], None),
+        ])
+
+    @responses.activate
+    def test_send_email_spreads_cc_and_bcc_over_chunks(self):
+        '''
+        Assert that no chunk has more recipients than the limit,
+        When the cc and bcc recipients don't fit in the first chunk
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        payload = dict(
+            self.minimum_required_email_payload,
+            to=['user{0}@tapandita.com'.format(n) for n in range(3)],
+            cc=['cc{0}@tapandita.com'.format(n) for n in range(2)],
+            bcc=['audit@tapandita.com'],
+        )
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2, 'mailgun': 3}}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_request(payload)
+
+        body = json.loads(response.data)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            [(chunk['offset'], chunk['count']) for chunk in body['chunks']],
+            [(0, 1), (1, 1), (2, 1)],
+        )
+        bodies = [parse_qs(call.request.body) for call in responses.calls]
+        sent = sorted(
+            (body['to'], body.get('cc'), body.get('bcc')) for body in bodies
+        )
+        self.assertEquals(sent, [
+            (['user0@tapandita.com'], ['cc0@tapandita.com'], None),
+            (['user1@tapandita.com'], ['cc1@tapandita.com'], None),
+            (['user2@tapandita.com'], None, ['audit@tapandita.com']),
+        ])
+
+    def test_send_email_with_too_many_cc_for_the_limit(self):
+        '''
+        Assert that the send email endpoint returns BadRequest, 400,
+        When there are too few to addresses to spread the cc over chunks
+        '''
+        payload = dict(
+            self.minimum_required_email_payload,
+            cc=['cc{0}@tapandita.com'.format(n) for n in range(2)],
+        )
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2}}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_request(payload)
+
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(json.loads(response.data)['error']['field'], 'cc')
+
+    @responses.activate
+    def test_send_email_chunk_fails_over_on_its_own(self):
+        '''
+        Assert that only the failed chunk is sent with mailgun,
+        When sendgrid can't send one of the chunks
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.mock_mailgun_response(200, {'message': 'success'})
+        payload = dict(
+            self.minimum_required_email_payload,
+            to=['user{0}@tapandita.com'.format(n) for n in range(4)],
+        )
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2}}
+
+        with mock.patch.dict(app.config, limits):
+
+            with self.fail_sendgrid_for('user3@tapandita.com'):
+                response = self.make_send_email_request(payload)
+
+        body = json.loads(response.data)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(
+            [chunk['backend'] for chunk in body['chunks']],
+            ['sendgrid', 'mailgun'],
+        )
+
+    @responses.activate
+    def test_send_email_when_a_chunk_cannot_be_sent(self):
+        '''
+        Assert that the send email endpoint returns multi status, 207,
+        When one chunk can't be sent by any backend
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.mock_mailgun_response(400, {'message': 'error'})
+        payload = dict(
+            self.minimum_required_email_payload,
+            to=['user{0}@tapandita.com'.format(n) for n in range(4)],
+        )
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2}}
+
+        with mock.patch.dict(app.config, limits):
+
+            with self.fail_sendgrid_for('user0@tapandita.com'):
+                response = self.make_send_email_request(payload)
+
+        body = json.loads(response.data)
+        self.assertEquals(response.status_code, 207)
+        self.assertEquals(body['message'], 'partial')
+        self.assertEquals(
+            [chunk['message'] for chunk in body['chunks']],
+            ['error', 'success'],
+        )
+
+    @responses.activate
+    def test_send_email_batch_splits_large_messages(self):
+        '''
+        Assert that a message of a batch gets one result for all its chunks,
+        When it has more recipients than the backends accept in one call
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        payload = {'messages': [
+            dict(
+                self.minimum_required_email_payload,
+                to=['user{0}@tapandita.com'.format(n) for n in range(3)],
+            ),
+            self.minimum_required_email_payload,
+        ]}
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2}}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_batch_request(payload)
+
+        results = json.loads(response.data)['results']
+        self.assertEquals(len(responses.calls), 3)
+        self.assertEquals(results[0]['message'], 'success')
+        self.assertEquals(len(results[0]['chunks']), 2)
+        self.assertEquals(results[1]['backend'], 'sendgrid')
+
+    @responses.activate
+    def test_send_email_batch_with_structured_headers(self):
+        '''
+        Assert that the messages of a batch are sent together,
+        When their headers have values that aren't strings
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        message = dict(
+            self.minimum_required_email_payload,
+            headers={'X-Tags': ['a', 'b'], 'X-Meta': {'campaign': 1}},
+        )
+        payload = {'messages': [
+            message, dict(message, to=['tapan.pandita+1@gmail.com']),
+        ]}
+        response = self.make_send_email_batch_request(payload)
+
+        results = json.loads(response.data)['results']
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(results[0]['id'], results[1]['id'])
+        self.assertEquals(len(responses.calls), 1)
+
+    @responses.activate
+    def test_send_email_batch_with_too_many_cc_for_the_limit(self):
+        '''
+        Assert that only the message with too many cc recipients fails,
+        When a batch has too few to addresses to spread them over chunks
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        payload = {'messages': [
+            dict(
+                self.minimum_required_email_payload,
+                cc=['cc{0}@tapandita.com'.format(n) for n in range(2)],
+            ),
+            self.minimum_required_email_payload,
+        ]}
+        limits = {'BACKEND_MAX_RECIPIENTS': {'sendgrid': 2}}
+
+        with mock.patch.dict(app.config, limits):
+            response = self.make_send_email_batch_request(payload)
+
+        results = json.loads(response.data)['results']
+        self.assertEquals(results[0]['status_code'], 400)
+        self.assertEquals(results[1]['backend'], 'sendgrid')
+
+    @responses.activate
+    def test_send_email_scheduled(self):
+        '''
+        Assert that the send email endpoint returns Accepted, 202, and queues
+        the email until send_at without calling any provider,
+        When the email has a send_at
+        '''
+        payload = dict(
+            self.minimum_required_email_payload,
+            send_at='2030-01-01T10:00:00+05:30',
+        )
+        response = self.make_send_email_request(payload)
+        body = json.loads(response.data)
+        self.assertEquals(response.status_code, 202)
+        self.assertEquals(body['message'], 'scheduled')
+        self.assertEquals(len(responses.calls), 0)
+        self.assertNotIn(
+            body['id'], [row[0] for row in app.outbox.claim(limit=100)],
+        )
+        claimed = app.outbox.claim_until(1893472200, 100, 10 ** 10)
+        self.assertIn(
+            (body['id'], self.minimum_required_email_payload, 0, 1893472200),
+            claimed,
+        )
+
+    def test_send_email_with_invalid_send_at(self):
+        '''
+        Assert that the send email endpoint returns bad request, 400,
+        When send_at isn't an ISO 8601 date and time
+        '''
+        payload = dict(
+            self.minimum_required_email_payload, send_at='tomorrow',
+        )
+        response = self.make_send_email_request(payload)
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(
+            json.loads(response.data)['error']['field'], 'send_at',
+        )
+
+    @responses.activate
+    def test_send_email_batch_with_scheduled_messages(self):
+        '''
+        Assert that messages with a send_at are queued and the others sent,
+        When a batch mixes both
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        payload = {'messages': [
+            dict(
+                self.minimum_required_email_payload,
+                send_at='2030-01-01T00:00:00Z',
+            ),
+            self.minimum_required_email_payload,
+        ]}
+        response = self.make_send_email_batch_request(payload)
+        results = json.loads(response.data)['results']
+        self.assertEquals(len(responses.calls), 1)
+        self.assertEquals(results[0]['message'], 'scheduled')
+        self.assertEquals(results[1]['message'], 'success')
+        self.assertIn(
+            (results[0]['id'], self.minimum_required_email_payload, 0,
+             1893456000),
+            app.outbox.claim_until(1893456000, 100, 10 ** 10),
+        )
+
+
+    def suppress(self, entries):
+        '''
+        Suppresses addresses or domains with the api and reloads the list
+        '''
+        response = self.client.post(
+            '/api/v1/suppressions',
+            data=json.dumps({'entries': entries, 'reason': 'bounce'}),
+            headers=self.headers,
+        )
+        app.suppression_list.reload()
+        return response
+
+    def test_suppression_endpoints(self):
+        '''
+        Assert that suppressions are added in bulk, returned and lifted
+        '''
+        response = self.suppress(['Bounced@Tapandita.com', 'spam.com'])
+        self.assertEquals(json.loads(response.data)['added'], 2)
+        self.assertEquals(
+            json.loads(self.suppress(['bounced@tapandita.com']).data)['added'],
+            0,
+        )
+
+        response = self.client.get(
+            '/api/v1/suppressions/bounced@tapandita.com', headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data)['reason'], 'bounce')
+
+        response = self.client.delete(
+            '/api/v1/suppressions/spam.com', headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 200)
+        response = self.client.get(
+            '/api/v1/suppressions/spam.com', headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 404)
+
+    @responses.activate
+    def test_send_email_leaves_out_suppressed_recipients(self):
+        '''
+        Assert that suppressed addresses and domains aren't sent to and are
+        reported, When some recipients are suppressed
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.suppress(['tapan.pandita+1@gmail.com', 'tapan.pandita+3@gmail.com'])
+        response = self.make_send_email_request(self.full_email_payload)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data)['suppressed'], [
+            'tapan.pandita+1@gmail.com', 'tapan.pandita+3@gmail.com',
+        ])
+        body = parse_qs(responses.calls[0].request.body)
+        self.assertEquals(body['to'], ['tapan.pandita@gmail.com'])
+        self.assertEquals(body['cc'], ['tapan.pandita+2@gmail.com'])
+        self.assertNotIn('bcc', body)
+
+    @responses.activate
+    def test_send_email_to_suppressed_recipients_only(self):
+        '''
+        Assert that the send email endpoint returns bad request, 400, without
+        calling a provider, When every to address is suppressed
+        '''
+        self.suppress(['gmail.com'])
+        response = self.make_send_email_request(
+            self.minimum_required_email_payload,
+        )
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(json.loads(response.data)['error']['field'], 'to')
+        self.assertEquals(len(responses.calls), 0)
+
+    @responses.activate
+    def test_send_email_batch_reports_suppressed_recipients(self):
+        '''
+        Assert that suppressed recipients of a batch get an error result and
+        the others are sent to
+        '''
+        self.mock_sendgrid_response(200, {'message': 'success'})
+        self.suppress(['tapan.pandita@gmail.com'])
+        response = self.make_send_email_batch_request(
+            self.template_batch_payload,
+        )
+        results = json.loads(response.data)['results']
+        self.assertEquals(results[0]['status_code'], 400)
+        self.assertEquals(results[1]['message'], 'success')
+        smtpapi = json.loads(
+            parse_qs(responses.calls[0].request.body)['x-smtpapi'][0],
+        )
+        self.assertEquals(smtpapi['to'], ['tapan.pandita+1@gmail.com'])
+
+        same_content = [
+            dict(self.minimum_required_email_payload, to=[email])
+            for email in ['tapan.pandita@gmail.com', 'a@tapandita.com']
+        ]
+        response = self.make_send_email_batch_request({
+            'messages': same_content,
+        })
+        results = json.loads(response.data)['results']
+        self.assertEquals(results[0]['status_code'], 400)
+        self.assertEquals(results[1]['message'], 'success')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,69 @@
+import time
+import threading
+import unittest
+
+from app import app
+from mail.fanout import fan_out
+
+
+class TestCases(unittest.TestCase):
+
+    def test_results_in_order(self):
+        '''
+        Assert that results are returned in the order of the items,
+        When later items finish first
+        '''
+
+        def slow_square(number):
+            time.sleep((5 - number) * 0.01)
+            return number * number
+
+        with app.app_context():
+            results = fan_out(slow_square, range(5), 5)
+
+        self.assertEquals(results, [0, 1, 4, 9, 16])
+
+    def test_concurrency_is_bounded(self):
+        '''
+        Assert that at most concurrency calls run at once,
+        When there are more items than threads
+        '''
+        lock = threading.Lock()
+        running = [0]
+        most = [0]
+
+        def track(item):
+
+            with lock:
+                running[0] += 1
+                most[0] = max(most[0], running[0])
+
+            time.sleep(0.01)
+
+            with lock:
+                running[0] -= 1
+
+        with app.app_context():
+            fan_out(track, range(10), 3)
+
+        self.assertEquals(most[0], 3)
+
+    def test_exception_is_raised(self):
+        '''
+        Assert that an exception raised by a call is raised by fan_out,
+        When the other calls succeed
+        '''
+
+        def fail_on_three(number):
+
+            if number == 3:
+                raise KeyError(number)
+
+            return number
+
+        with app.app_context():
+            self.assertRaises(KeyError, fan_out, fail_on_three, range(5), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
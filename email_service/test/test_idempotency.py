@@ -0,0 +1,95 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import mock
+
+from email_service import idempotency
+from email_service.idempotency import IdempotencyStore
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.store = IdempotencyStore(
+            ':memory:', ttl=60, pending_timeout=10, max_keys=2,
+        )
+
+    def test_claimed_key_is_pending_until_finished(self):
+        '''
+        Assert that a key is pending until its response is stored
+        '''
+        self.assertEquals(self.store.claim('key', 'a'), (idempotency.NEW, None))
+        self.assertEquals(self.store.claim('key', 'a')[0], idempotency.PENDING)
+        self.store.finish(
+            'key', 200, 'application/json', '{}', [('Location', '/a')],
+        )
+        self.assertEquals(
+            self.store.claim('key', 'a'),
+            (idempotency.DONE, (200, 'application/json', '{}', [
+                ['Location', '/a'],
+            ])),
+        )
+
+    def test_released_key_can_be_claimed_again(self):
+        '''
+        Assert that a key is free again when its request failed
+        '''
+        self.store.claim('key', 'a')
+        self.store.release('key')
+        self.assertEquals(self.store.claim('key', 'a')[0], idempotency.NEW)
+
+    def test_expired_keys_can_be_claimed_again(self):
+        '''
+        Assert that responses are forgotten after the ttl
+        '''
+        self.store.claim('key', 'a')
+        self.store.finish('key', 200, 'application/json', '{}')
+
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.assertEquals(self.store.claim('key', 'b')[0], idempotency.NEW)
+
+    def test_headers_column_is_added_to_existing_store(self):
+        '''
+        Assert that responses are stored with their headers, When the store
+        was created before headers were kept
+        '''
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'idempotency.db')
+
+        try:
+            connection = sqlite3.connect(path)
+            connection.executescript(idempotency.SCHEMA.replace(
+                'headers TEXT,', '',
+            ))
+            connection.close()
+
+            store = IdempotencyStore(path)
+            store.claim('key', 'a')
+            store.finish('key', 200, 'application/json', '{}', [('A', 'b')])
+            self.assertEquals(store.claim('key', 'a')[1][3], [['A', 'b']])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_prune_evicts_least_recently_used_keys(self):
+        '''
+        Assert that the store keeps at most max_keys keys
+        '''
+
+        now = time.time()
+
+        for number, key in enumerate(['a', 'b', 'c']):
+
+            with mock.patch('time.time', return_value=now + number):
+                self.store.claim(key, key)
+
+        self.store.prune()
+        self.assertEquals(self.store.claim('a', 'a')[0], idempotency.NEW)
+        self.assertEquals(self.store.claim('c', 'c')[0], idempotency.PENDING)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import json
+import time
+import threading
+import unittest
+
+import mock
+
+from app import app
+from mail.exceptions import Overloaded, RateLimited
+from mail.limiter import ConcurrencyLimiter
+from mail.suppression import SuppressionList
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = ConcurrencyLimiter(
+            initial_limit=2, min_limit=1, max_limit=10, queue_size=1,
+            queue_timeout=0.05,
+        )
+        self.concurrency_limiter = app.concurrency_limiter
+
+    def tearDown(self):
+        app.concurrency_limiter = self.concurrency_limiter
+
+    def test_sends_over_limit_are_shed(self):
+        '''
+        Assert that Overloaded is raised with a retry delay, When the limit
+        is reached and the queue timeout runs out
+        '''
+        self.limiter.acquire()
+        self.limiter.acquire()
+
+        with self.assertRaises(Overloaded) as context:
+            self.limiter.acquire()
+
+        self.assertEquals(context.exception.status_code, 503)
+        self.assertEquals(context.exception.retry_after, 1)
+        self.assertTrue(isinstance(context.exception, RateLimited))
+        self.assertEquals(self.limiter.shed, 1)
+
+    def test_waiting_send_gets_freed_slot(self):
+        '''
+        Assert that a send waiting in the queue takes the slot of a send that
+        finished
+        '''
+        self.limiter.queue_timeout = 5
+        permits = [self.limiter.acquire(), self.limiter.acquire()]
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.limiter.acquire()),
+        )
+        waiter.start()
+
+        while not self.limiter.waiting:
+            time.sleep(0.001)
+
+        self.limiter.release(permits[0], sample=False)
+        waiter.join(1)
+        self.assertEquals(len(acquired), 1)
+        self.assertEquals(self.limiter.inflight, 2)
+
+    def test_full_queue_sheds_right_away(self):
+        '''
+        Assert that a send is shed without waiting, When queue_size sends
+        already wait
+        '''
+        self.limiter.acquire()
+        self.limiter.acquire()
+        self.limiter.waiting = 1
+        started_at = time.time()
+
+        with self.assertRaises(Overloaded):
+            self.limiter.acquire()
+
+        self.assertLess(time.time() - started_at, 0.01)
+
+    def test_limit_follows_latency(self):
+        '''
+        Assert that the limit grows while latency is steady, and shrinks when
+        it goes up or sends fail
+        '''
+        limiter = ConcurrencyLimiter(initial_limit=10, max_limit=100)
+
+        for _ in range(20):
+            permits = [limiter.acquire() for _ in range(limiter.slots)]
+
+            for started_at, inflight in permits:
+                limiter.release((time.time() - 0.1, inflight))
+
+        grown = limiter.limit
+        self.assertGreater(grown, 10)
+
+        permits = [limiter.acquire() for _ in range(limiter.slots)]
+
+        for started_at, inflight in permits:
+            limiter.release((time.time() - 1, inflight))
+
+        self.assertLess(limiter.limit, grown / 2)
+
+        limiter = ConcurrencyLimiter(initial_limit=20)
+        limiter.release(limiter.acquire(), failed=True)
+        self.assertAlmostEquals(limiter.limit, 18)
+
+    def test_limit_stays_within_bounds(self):
+        '''
+        Assert that failures never take the limit below min_limit
+        '''
+
+        for _ in range(50):
+            self.limiter.release(self.limiter.acquire(), failed=True)
+
+        self.assertEquals(self.limiter.limit, 1)
+        self.assertEquals(self.limiter.inflight, 0)
+
+    def test_shed_email_gets_503_with_retry_after(self):
+        '''
+        Assert that the send email endpoint returns 503 with a Retry-After
+        header, without calling a provider, When the limit is reached
+        '''
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        app.concurrency_limiter = self.limiter
+        self.limiter.acquire()
+        self.limiter.acquire()
+
+        with mock.patch('requests.Session.post') as post:
+            response = app.test_client().post(
+                '/api/v1/emails', data=json.dumps({
+                    'to': ['tapan.pandita@gmail.com'],
+                    'subject': 'Shed test',
+                    'text': 'This is the text',
+                }), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                },
+            )
+
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response.headers['Retry-After'], '1')
+        self.assertFalse(post.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
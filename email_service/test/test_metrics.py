@@ -0,0 +1,72 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from email_service.metrics import Metrics
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_histogram_buckets_are_cumulative(self):
+        '''
+        Assert that histograms are rendered with cumulative buckets
+        '''
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.observe('latency', (('backend', 'sendgrid'),), 0.05)
+        metrics.observe('latency', (('backend', 'sendgrid'),), 0.5)
+        metrics.observe('latency', (('backend', 'sendgrid'),), 5)
+        self.assertEquals(metrics.render().splitlines(), [
+            'latency_bucket{backend="sendgrid",le="0.1"} 1',
+            'latency_bucket{backend="sendgrid",le="1.0"} 2',
+            'latency_bucket{backend="sendgrid",le="+Inf"} 3',
+            'latency_sum{backend="sendgrid"} 5.55',
+            'latency_count{backend="sendgrid"} 3',
+        ])
+
+    def test_metrics_are_added_up_across_processes(self):
+        '''
+        Assert that the exported metrics include the files of other workers
+        '''
+        other_worker = Metrics(self.directory)
+        other_worker.describe('sent', 'counter', 'Emails sent.')
+        other_worker.inc('sent', (('backend', 'mailgun'),), 2)
+
+        with mock.patch('os.getpid', return_value=-1):
+            other_worker.flush(force=True)
+
+        metrics = Metrics(self.directory)
+        metrics.describe('sent', 'counter', 'Emails sent.')
+        metrics.inc('sent', (('backend', 'mailgun'),))
+        self.assertEquals(metrics.render().splitlines(), [
+            '# HELP sent Emails sent.',
+            '# TYPE sent counter',
+            'sent{backend="mailgun"} 3',
+        ])
+
+    def test_flush_is_throttled(self):
+        '''
+        Assert that a process writes its file at most once per interval
+        '''
+        metrics = Metrics(self.directory, flush_interval=60)
+        metrics.inc('sent')
+        metrics.flush()
+        metrics.inc('sent')
+        metrics.flush()
+
+        with open(metrics.path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+
+        self.assertEquals(snapshot['counters'], [['sent', [], 1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from StringIO import StringIO
+
+from werkzeug.formparser import parse_form_data
+from werkzeug.test import EnvironBuilder
+
+from mail.multipart import Attachment, MultipartEncoder
+
+
+class TestCases(unittest.TestCase):
+
+    def parse(self, encoder):
+        '''Parses an encoded body like a werkzeug application would'''
+        body = encoder.read()
+        environ = EnvironBuilder(
+            method='POST', input_stream=StringIO(body),
+            content_type=encoder.content_type, content_length=len(body),
+        ).get_environ()
+        _, form, files = parse_form_data(environ)
+        return body, form, files
+
+    def test_encoded_body(self):
+        '''
+        Assert that fields and files survive encoding and parsing,
+        When values are lists, unicode or None
+        '''
+        encoder = MultipartEncoder(
+            {'to': ['a@b.com', 'c@d.com'], 'subject': u'H\xe9llo', 'cc': None},
+            [('attachment', Attachment('notes.txt', StringIO('x' * 200000)))],
+            chunk_size=1024,
+        )
+        body, form, files = self.parse(encoder)
+        self.assertEquals(len(body), len(encoder))
+        self.assertEquals(form.getlist('to'), ['a@b.com', 'c@d.com'])
+        self.assertEquals(form['subject'], u'H\xe9llo')
+        self.assertNotIn('cc', form)
+        self.assertEquals(files['attachment'].filename, 'notes.txt')
+        self.assertEquals(files['attachment'].mimetype, 'text/plain')
+        self.assertEquals(files['attachment'].read(), 'x' * 200000)
+
+    def test_read_in_chunks(self):
+        '''
+        Assert that reads return at most the requested size,
+        When the body is read in chunks
+        '''
+        encoder = MultipartEncoder(
+            {'subject': 'test'},
+            [('attachment', Attachment('data.bin', StringIO('y' * 5000)))],
+            chunk_size=1000,
+        )
+        chunks = list(encoder)
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEquals(sum(len(chunk) for chunk in chunks), len(encoder))
+
+    def test_attachment_read_from_start(self):
+        '''
+        Assert that attachments are uploaded whole,
+        When their file was already read
+        '''
+        fileobj = StringIO('content')
+        fileobj.read()
+        attachment = Attachment('file', fileobj)
+        self.assertEquals(attachment.size, 7)
+        self.assertEquals(attachment.content_type, 'application/octet-stream')
+        self.assertEquals(''.join(attachment.chunks(3)), 'content')
+
+
+if __name__ == '__main__':
+    unittest.main()
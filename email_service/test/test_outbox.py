@@ -0,0 +1,149 @@
+import json
+import unittest
+
+import mock
+import responses
+
+from app import app
+from mail import breaker
+from mail.outbox import Outbox
+from mail.sender import SenderPool
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        breaker.reset()
+        self.outbox = Outbox(':memory:', max_attempts=2, backoff=30)
+        self.pool = SenderPool(app, self.outbox)
+        self.payload = {
+            'to': ['tapan.pandita@gmail.com'],
+            'subject': 'Outbox test',
+            'text': 'This is the text',
+        }
+        self.sendgrid_url = 'https://api.sendgrid.com/api/mail.send.json'
+        self.mailgun_url = 'https://api.mailgun.net/v2/tapandita.com/messages'
+
+    def mock_response(self, url, response_code):
+        '''
+        Mocks responses for post requests
+        '''
+        responses.add(
+            responses.POST, url, body=json.dumps({'message': 'error'}),
+            status=response_code, content_type='application/json',
+        )
+
+    def test_claimed_messages_are_leased(self):
+        '''
+        Assert that a claimed message isn't handed out again during its lease
+        '''
+        message_id = self.outbox.put(self.payload)
+        claimed = self.outbox.claim(lease=60)
+        self.assertEquals(claimed, [(message_id, self.payload, 0)])
+        self.assertEquals(self.outbox.claim(), [])
+
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.assertEquals(len(self.outbox.claim()), 1)
+
+    def test_claim_until_returns_messages_due_by_then(self):
+        '''
+        Assert that claim_until hands out messages due by the given time,
+        earliest first, With their original due time
+        '''
+        ids = self.outbox.put_many([
+            (self.payload, 300), (self.payload, 100), (self.payload, 200),
+        ])
+        claimed = self.outbox.claim_until(250, 10, leased_until=1000)
+        self.assertEquals(
+            [(row[0], row[3]) for row in claimed],
+            [(ids[1], 100), (ids[2], 200)],
+        )
+        self.assertEquals(
+            [row[0] for row in self.outbox.claim_until(999, 10, 2000)],
+            [ids[0]],
+        )
+
+    def test_paced_sender_dispatches_due_messages(self):
+        '''
+        Assert that the dispatcher of a paced pool queues one due message
+        per call, Leaving the ones not yet due
+        '''
+        pool = SenderPool(app, self.outbox, rate=10, lookahead=60)
+        due = self.outbox.put(self.payload)
+        self.outbox.put(self.payload, available_at=10 ** 10)
+        pool.scheduler.refill()
+        self.assertEquals(len(pool.scheduler), 1)
+        self.assertEquals(pool.dispatch_once(), pool.poll_interval)
+        self.assertEquals(pool.dispatch_once(), pool.poll_interval)
+        self.assertEquals(pool.queue.get_nowait(), (due, self.payload))
+        self.assertTrue(pool.queue.empty())
+
+    def test_failed_messages_are_retried_with_backoff(self):
+        '''
+        Assert that a failed message is due again after the backoff
+        '''
+        message_id = self.outbox.put(self.payload)
+        self.outbox.retry(message_id, 'error')
+        self.assertEquals(self.outbox.claim(), [])
+        self.assertEquals(self.outbox.dead_letters(), [])
+
+    def test_messages_are_buried_after_max_attempts(self):
+        '''
+        Assert that a message is moved to the dead letters,
+        When it runs out of attempts
+        '''
+        message_id = self.outbox.put(self.payload)
+        self.outbox.retry(message_id, 'error')
+        self.outbox.retry(message_id, 'error')
+        dead_letters = self.outbox.dead_letters()
+        self.assertEquals(dead_letters[0]['id'], message_id)
+        self.assertEquals(dead_letters[0]['attempts'], 2)
+
+    @responses.activate
+    def test_sender_acks_sent_messages(self):
+        '''
+        Assert that the sender removes a message from the outbox,
+        When it is sent
+        '''
+        self.mock_response(self.sendgrid_url, 200)
+        self.outbox.put(self.payload)
+
+        with app.app_context():
+            self.assertEquals(self.pool.run_once(), 1)
+
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.assertEquals(self.outbox.claim(), [])
+
+    @responses.activate
+    def test_sender_buries_rejected_messages(self):
+        '''
+        Assert that the sender moves a message to the dead letters,
+        When the provider rejects it
+        '''
+        self.mock_response(self.sendgrid_url, 400)
+        message_id = self.outbox.put(self.payload)
+
+        with app.app_context():
+            self.pool.run_once()
+
+        self.assertEquals(self.outbox.dead_letters()[0]['id'], message_id)
+
+    @responses.activate
+    def test_sender_retries_when_backends_are_down(self):
+        '''
+        Assert that the sender keeps a message for a retry,
+        When sendgrid and mailgun are down
+        '''
+        self.mock_response(self.sendgrid_url, 500)
+        self.mock_response(self.mailgun_url, 500)
+        self.outbox.put(self.payload)
+
+        with app.app_context():
+            self.pool.run_once()
+
+        with mock.patch('time.time', return_value=10 ** 10):
+            self.assertEquals(self.outbox.claim()[0][2], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+from email_service.profiler import SamplingProfiler, collapse
+
+
+def spin(seconds):
+    '''Keeps the cpu busy for the given number of seconds of cpu time'''
+    until = time.clock() + seconds
+
+    while time.clock() < until:
+        pass
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_collapse_lists_outermost_frame_first(self):
+        '''
+        Assert that a collapsed stack ends with the current function
+        '''
+        stack = collapse(sys._getframe()).split(';')
+        self.assertTrue(
+            stack[-1].startswith('test_collapse_lists_outermost_frame_first ('),
+        )
+        self.assertIn('test_profiler.py:', stack[-1])
+        self.assertGreater(len(stack), 1)
+
+    def test_profiler_samples_busy_functions(self):
+        '''
+        Assert that the profile counts the stacks of the code using the cpu,
+        When the profiler runs while it is busy
+        '''
+        profiler = SamplingProfiler(self.directory, interval=0.001)
+        profiler.start()
+        spin(0.1)
+        path = profiler.stop()
+
+        self.assertFalse(profiler.running)
+        self.assertEquals(os.path.dirname(path), self.directory)
+
+        with open(path) as profile_file:
+            lines = profile_file.read().splitlines()
+
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn(';spin (', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_profiler_stops_after_duration(self):
+        '''
+        Assert that the profiler stops and writes its profile by itself,
+        When it ran for its duration
+        '''
+        profiler = SamplingProfiler(
+            self.directory, interval=0.001, duration=0.05,
+        )
+        profiler.start()
+        spin(0.2)
+
+        self.assertFalse(profiler.running)
+        self.assertEquals(len(os.listdir(self.directory)), 1)
+
+    def test_toggle_starts_and_stops(self):
+        '''
+        Assert that toggling the profiler twice writes a profile
+        '''
+        profiler = SamplingProfiler(self.directory)
+        profiler.toggle()
+        self.assertTrue(profiler.running)
+
+        profiler.toggle()
+        self.assertFalse(profiler.running)
+        self.assertEquals(len(os.listdir(self.directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
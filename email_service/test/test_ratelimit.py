@@ -0,0 +1,45 @@
+import unittest
+
+import mock
+
+from mail.ratelimit import RateLimiter
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(':memory:')
+
+    def acquire(self, now):
+        with mock.patch('time.time', return_value=now):
+            return self.limiter.acquire('bucket', rate=2, burst=2)
+
+    def test_bucket_allows_burst(self):
+        '''
+        Assert that a full bucket allows burst requests at once
+        '''
+        self.assertEquals(self.acquire(100), (True, 0))
+        self.assertEquals(self.acquire(100), (True, 0))
+        self.assertEquals(self.acquire(100), (False, 0.5))
+
+    def test_bucket_is_refilled_at_rate(self):
+        '''
+        Assert that tokens come back at the configured rate
+        '''
+        self.acquire(100)
+        self.acquire(100)
+        self.assertEquals(self.acquire(100.25), (False, 0.25))
+        self.assertEquals(self.acquire(100.5)[0], True)
+
+    def test_bucket_never_exceeds_burst(self):
+        '''
+        Assert that an idle bucket doesn't save up more than burst tokens
+        '''
+        self.acquire(100)
+        self.acquire(1000)
+        self.acquire(1000)
+        self.assertEquals(self.acquire(1000)[0], False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+import mock
+
+from app import app
+from mail import breaker, registry
+from mail.backends import BaseEmailBackend
+
+
+class FakeBackend(BaseEmailBackend):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        breaker.reset()
+        registry.reset()
+        self.sendgrid = FakeBackend('sendgrid')
+        self.mailgun = FakeBackend('mailgun')
+        self.backends = [self.sendgrid, self.mailgun]
+
+    def tearDown(self):
+        registry.reset()
+        self.context.pop()
+
+    def test_backends_are_singletons(self):
+        '''
+        Assert that a worker uses a single instance of every backend
+        '''
+        self.assertEquals(
+            [backend.name for backend in registry.get_backends()],
+            ['sendgrid', 'mailgun'],
+        )
+        self.assertIs(
+            registry.get_backend('sendgrid'), registry.get_backend('sendgrid'),
+        )
+
+    def test_registered_backends_can_be_configured(self):
+        '''
+        Assert that a registered backend is used once listed in EMAIL_BACKENDS
+        '''
+
+        @registry.register
+        class SmtpBackend(BaseEmailBackend):
+            name = 'fake-smtp'
+
+        with mock.patch.dict(app.config, {'EMAIL_BACKENDS': ['fake-smtp']}):
+            backends = registry.get_backends()
+
+        self.assertIsInstance(backends[0], SmtpBackend)
+
+    def test_weighted_router_spreads_load_by_weight(self):
+        '''
+        Assert that backends go first in proportion to their weights
+        '''
+        router = registry.WeightedRouter({'sendgrid': 2, 'mailgun': 1})
+        firsts = [router.order(self.backends)[0].name for _ in range(6)]
+        self.assertEquals(firsts.count('sendgrid'), 4)
+        self.assertEquals(firsts.count('mailgun'), 2)
+        self.assertEquals(len(router.order(self.backends)), 2)
+
+    def test_adaptive_router_tries_unused_backends_first(self):
+        '''
+        Assert that a backend without latency samples is tried first
+        '''
+        breaker.get_breaker('sendgrid').record_success(0.1)
+        router = registry.AdaptiveRouter()
+        self.assertEquals(
+            router.order(self.backends), [self.mailgun, self.sendgrid],
+        )
+
+    def test_adaptive_router_prefers_faster_backend(self):
+        '''
+        Assert that the faster backend takes more of the load
+        '''
+        breaker.get_breaker('sendgrid').record_success(0.4)
+        breaker.get_breaker('mailgun').record_success(0.1)
+        router = registry.AdaptiveRouter()
+
+        with mock.patch('random.random', return_value=0.5):
+            self.assertEquals(router.order(self.backends)[0], self.mailgun)
+
+        with mock.patch('random.random', return_value=0.1):
+            self.assertEquals(router.order(self.backends)[0], self.sendgrid)
+
+    def test_unknown_routing_strategy(self):
+        '''
+        Assert that a misconfigured strategy is reported
+        '''
+        with mock.patch.dict(app.config, {'EMAIL_ROUTING': 'fastest'}):
+            self.assertRaises(ValueError, registry.get_router)
+
+
+if __name__ == '__main__':
+    unittest.main()
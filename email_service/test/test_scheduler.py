@@ -0,0 +1,78 @@
+import unittest
+
+from mail.outbox import Outbox
+from mail.scheduler import Scheduler
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.outbox = Outbox(':memory:')
+        self.payload = {
+            'to': ['tapan.pandita@gmail.com'],
+            'subject': 'Scheduler test',
+            'text': 'This is the text',
+        }
+
+    def test_refill_claims_messages_due_within_lookahead(self):
+        '''
+        Assert that only messages due within the lookahead are claimed,
+        When others are due later
+        '''
+        scheduler = Scheduler(self.outbox, rate=10, lookahead=60)
+        soon = self.outbox.put(self.payload, available_at=1050)
+        self.outbox.put(self.payload, available_at=2000)
+        self.assertEquals(scheduler.refill(now=1000), 1)
+        self.assertEquals(scheduler.pop(now=1049), None)
+        self.assertEquals(scheduler.wait_time(now=1049), 1)
+        self.assertEquals(scheduler.pop(now=1050), (soon, self.payload))
+
+    def test_burst_is_spread_at_the_rate(self):
+        '''
+        Assert that messages due at the same second are handed out one every
+        1 / rate seconds
+        '''
+        scheduler = Scheduler(self.outbox, rate=2, lookahead=60)
+        self.outbox.put_many([(self.payload, 1000)] * 3)
+        scheduler.refill(now=1000)
+        self.assertNotEquals(scheduler.pop(now=1000), None)
+        self.assertEquals(scheduler.pop(now=1000.4), None)
+        self.assertAlmostEqual(scheduler.wait_time(now=1000.4), 0.1)
+        self.assertNotEquals(scheduler.pop(now=1000.5), None)
+        self.assertNotEquals(scheduler.pop(now=1001), None)
+        self.assertEquals(scheduler.wait_time(now=1001), None)
+
+    def test_heap_holds_what_can_be_sent_within_lookahead(self):
+        '''
+        Assert that the heap doesn't grow past rate * lookahead messages,
+        When more are due
+        '''
+        scheduler = Scheduler(self.outbox, rate=1, lookahead=5)
+        self.outbox.put_many([(self.payload, 1000)] * 20)
+        self.assertEquals(scheduler.refill(now=1000), 5)
+        self.assertEquals(scheduler.refill(now=1000), 0)
+        scheduler.pop(now=1000)
+        self.assertEquals(scheduler.refill(now=1000), 1)
+        self.assertEquals(len(scheduler), 5)
+
+
+    def test_due_messages_take_the_place_of_later_ones(self):
+        '''
+        Assert that a message due now is claimed and the one due last goes
+        back to the outbox, When the heap is full of messages due later
+        '''
+        scheduler = Scheduler(self.outbox, rate=0.5, lookahead=5)
+        self.outbox.put_many([(self.payload, 1003), (self.payload, 1004)])
+        self.assertEquals(scheduler.refill(now=1000), 2)
+
+        due = self.outbox.put(self.payload, available_at=1000)
+        self.assertEquals(scheduler.refill(now=1000), 1)
+        self.assertEquals(len(scheduler), 2)
+        self.assertEquals(scheduler.pop(now=1000), (due, self.payload))
+        self.assertEquals(
+            [row[3] for row in self.outbox.claim_until(1004, 10, 10 ** 10)],
+            [1004],
+        )
+
+if __name__ == '__main__':
+    unittest.main()
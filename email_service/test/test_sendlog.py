@@ -0,0 +1,282 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import responses
+
+from app import app
+from mail import breaker
+from mail.sendlog import SendLog
+from mail.suppression import SuppressionList
+
+
+DAY = 86400
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.send_log = SendLog(
+            self.directory, segment_length=DAY, retention=3 * DAY,
+            flush_interval=None,
+        )
+        breaker.reset()
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        app.send_log = SendLog(self.directory, batch_size=1, flush_interval=None)
+        self.client = app.test_client()
+        self.headers = {
+            'content-type': 'application/json',
+            'accept': 'application/json',
+        }
+
+    def tearDown(self):
+        app.send_log = SendLog(None)
+        shutil.rmtree(self.directory)
+
+    def write(self, message_id, recipients, created_at, status='sent',
+              tenant=None):
+        '''Writes an attempt made at created_at to the log'''
+        self.send_log.write([{
+            'message_id': message_id,
+            'tenant': tenant,
+            'backend': 'sendgrid',
+            'status': status,
+            'status_code': None,
+            'latency': 0.1,
+            'recipients': recipients,
+            'created_at': created_at,
+        }])
+
+    def segment_files(self):
+        '''Returns the names of the segment databases, without their logs'''
+        return sorted(
+            filename for filename in os.listdir(self.directory)
+            if filename.startswith('sendlog-') and filename.endswith('.db')
+        )
+
+    def test_attempts_are_found_across_segments(self):
+        '''
+        Assert that every attempt of a message is found, oldest first, When
+        they were made in different segments
+        '''
+        self.write('a', ['one@example.com'], DAY + 10, 'server_error')
+        self.write('a', ['one@example.com'], 2 * DAY + 10)
+        self.write('b', ['one@example.com'], 2 * DAY + 20)
+
+        attempts = self.send_log.find('a')
+        self.assertEquals(
+            [attempt['status'] for attempt in attempts],
+            ['server_error', 'sent'],
+        )
+        self.assertEquals(len(self.segment_files()), 2)
+        self.assertEquals(self.send_log.find('c'), [])
+
+    def test_search_by_recipient_pages_newest_first(self):
+        '''
+        Assert that search returns the attempts to a recipient, whatever the
+        case of the address, a page at a time across segments
+        '''
+
+        for number in range(5):
+            self.write(
+                str(number), ['One@example.com', 'two@example.com'],
+                DAY + number * DAY / 2,
+            )
+
+        self.write('other', ['three@example.com'], DAY + 1)
+
+        ids = []
+        cursor = None
+
+        while True:
+            attempts, cursor = self.send_log.search(
+                'one@EXAMPLE.com', limit=2, cursor=cursor,
+            )
+            ids.extend(attempt['message_id'] for attempt in attempts)
+
+            if cursor is None:
+                break
+
+        self.assertEquals(ids, ['4', '3', '2', '1', '0'])
+
+        attempts, _ = self.send_log.search(
+            since=DAY + 1, until=DAY + DAY / 2 + 1,
+        )
+        self.assertEquals(
+            [attempt['message_id'] for attempt in attempts], ['1', 'other'],
+        )
+
+    def test_recipients_are_not_stored_in_clear(self):
+        '''
+        Assert that no recipient address is written to a segment or its log
+        '''
+        self.write('a', ['secret@example.com'], DAY)
+
+        for filename in os.listdir(self.directory):
+
+            with open(os.path.join(self.directory, filename), 'rb') as segment:
+                self.assertNotIn('secret@example.com', segment.read())
+
+    def test_maintenance_compacts_and_deletes_segments(self):
+        '''
+        Assert that finished segments are compacted and still searchable, and
+        that segments past retention are deleted, When the log is maintained
+        '''
+
+        for day in range(1, 5):
+            self.write(str(day), ['one@example.com'], day * DAY + 10)
+
+        self.assertTrue(self.send_log.maintain(now=6 * DAY))
+        self.assertEquals(self.segment_files(), [
+            'sendlog-000000259200.compact.db',
+            'sendlog-000000345600.compact.db',
+        ])
+        self.assertEquals(
+            [attempt['message_id'] for attempt in
+             self.send_log.search('one@example.com')[0]],
+            ['4', '3'],
+        )
+        self.assertEquals(self.send_log.find('3')[0]['status'], 'sent')
+
+    def test_active_segment_is_not_compacted(self):
+        '''
+        Assert that the segments attempts may still be written to are left
+        alone, When the log is maintained
+        '''
+        self.write('a', ['one@example.com'], DAY + 10)
+        self.write('b', ['one@example.com'], 2 * DAY + 10)
+        self.send_log.maintain(now=2 * DAY + 20)
+        self.assertEquals(self.segment_files(), [
+            'sendlog-000000086400.db', 'sendlog-000000172800.db',
+        ])
+
+    def test_log_without_directory_records_nothing(self):
+        '''
+        Assert that nothing is recorded or found, When the log is disabled
+        '''
+        send_log = SendLog(None)
+        self.assertFalse(send_log.record('a', 'sendgrid', 'sent', 0.1, []))
+        self.assertEquals(send_log.find('a'), [])
+        self.assertEquals(send_log.search(), ([], None))
+
+    @responses.activate
+    def test_sent_email_status_is_returned(self):
+        '''
+        Assert that the status of an email is returned by its id, When it
+        was sent through the api
+        '''
+        responses.add(
+            responses.POST, 'https://api.sendgrid.com/api/mail.send.json',
+            body=json.dumps({'message': 'success'}), status=200,
+            content_type='application/json',
+        )
+        response = self.client.post(
+            '/api/v1/emails', headers=self.headers, data=json.dumps({
+                'to': ['tapan.pandita@gmail.com'],
+                'subject': 'Status test',
+                'text': 'Where is this email',
+            }),
+        )
+        message_id = json.loads(response.data)['id']
+
+        response = self.client.get(
+            '/api/v1/emails/' + message_id, headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 200)
+        status = json.loads(response.data)
+        self.assertEquals(status['status'], 'sent')
+        self.assertEquals(status['backend'], 'sendgrid')
+        self.assertEquals(len(status['attempts']), 1)
+        self.assertEquals(status['attempts'][0]['recipients'], 1)
+
+        response = self.client.get(
+            '/api/v1/emails?recipient=Tapan.Pandita@gmail.com',
+            headers=self.headers,
+        )
+        emails = json.loads(response.data)
+        self.assertEquals(
+            [email['id'] for email in emails['emails']], [message_id],
+        )
+        self.assertIsNone(emails['next'])
+
+    def test_tenants_only_find_their_attempts(self):
+        '''
+        Assert that attempts are only found and searched by the tenant that
+        made them
+        '''
+        self.write('a', ['one@example.com'], DAY + 10, tenant='acme')
+        self.write('b', ['one@example.com'], DAY + 20, tenant='globex')
+
+        self.assertEquals(len(self.send_log.find('a', 'acme')), 1)
+        self.assertEquals(self.send_log.find('a', 'globex'), [])
+        self.assertEquals(self.send_log.find('a'), [])
+
+        for recipient in (None, 'one@example.com'):
+            attempts, _ = self.send_log.search(
+                recipient, until=2 * DAY, tenant='globex',
+            )
+            self.assertEquals(
+                [attempt['message_id'] for attempt in attempts], ['b'],
+            )
+
+    def test_unknown_email_is_not_found(self):
+        '''
+        Assert that 404 is returned, When no attempt was made to send an email
+        '''
+        response = self.client.get(
+            '/api/v1/emails/unknown', headers=self.headers,
+        )
+        self.assertEquals(response.status_code, 404)
+
+    def test_search_pages_with_cursor(self):
+        '''
+        Assert that the next cursor returns the next page, When there are
+        more attempts than the limit
+        '''
+
+        for number in range(3):
+            app.send_log.write([{
+                'message_id': str(number),
+                'tenant': None,
+                'backend': 'mailgun',
+                'status': 'sent',
+                'status_code': None,
+                'latency': 0.1,
+                'recipients': ['one@example.com'],
+                'created_at': 1400000000 + number,
+            }])
+
+        response = self.client.get(
+            '/api/v1/emails?limit=2&since=2014-05-13T00:00:00Z',
+            headers=self.headers,
+        )
+        page = json.loads(response.data)
+        self.assertEquals([email['id'] for email in page['emails']], ['2', '1'])
+
+        response = self.client.get(
+            '/api/v1/emails?limit=2&cursor=' + page['next'],
+            headers=self.headers,
+        )
+        page = json.loads(response.data)
+        self.assertEquals([email['id'] for email in page['emails']], ['0'])
+        self.assertIsNone(page['next'])
+
+    def test_search_arguments_are_validated(self):
+        '''
+        Assert that 400 is returned, When the limit, times or cursor of a
+        search are invalid
+        '''
+
+        for query in ('limit=0', 'limit=1001', 'since=yesterday',
+                      'cursor=abc'):
+            response = self.client.get(
+                '/api/v1/emails?' + query, headers=self.headers,
+            )
+            self.assertEquals(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
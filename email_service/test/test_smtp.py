@@ -0,0 +1,366 @@
+import json
+import email
+import threading
+import unittest
+import SocketServer
+from StringIO import StringIO
+
+from app import app
+from mail import breaker, registry
+from mail.backends import SmtpBackend
+from mail.exceptions import ClientException, ServerException
+from mail.message import EmailMessage, BatchEmailMessage
+from mail.multipart import Attachment
+from mail.smtp import SmtpConnectionPool
+from mail.suppression import SuppressionList
+
+
+class SmtpHandler(SocketServer.StreamRequestHandler):
+    '''
+    Speaks just enough smtp for the tests. Every session is counted and every
+    message is stored on the server. Replies to RCPT and DATA can be
+    overridden with server.reject, and to RCPT of one address by its key
+    there, and server.drop_after closes sessions once they sent that many
+    messages.
+    '''
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        sent = 0
+        envelope = {}
+        self.reply('220 localhost ready')
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            command = line[:4].upper()
+
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN')
+            elif command == 'AUTH':
+                self.reply('235 Authenticated')
+            elif command == 'MAIL':
+                envelope = {'from': line[10:].strip(), 'to': []}
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line[8:].strip()
+                envelope['to'].append(address)
+                self.reply(server.reject.get(
+                    address, server.reject.get('RCPT', '250 OK'),
+                ))
+            elif command == 'DATA':
+                self.reply('354 Go ahead')
+                data = []
+
+                for data_line in iter(self.rfile.readline, ''):
+
+                    if data_line == '.\r\n':
+                        break
+
+                    data.append(data_line)
+
+                envelope['data'] = ''.join(data)
+                server.messages.append(envelope)
+                self.reply(server.reject.get('DATA', '250 Queued'))
+                sent += 1
+
+                if server.drop_after and sent >= server.drop_after:
+                    return
+            elif command in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class SmtpServer(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SmtpHandler,
+        )
+        self.sessions = 0
+        self.messages = []
+        self.reject = {}
+        self.drop_after = None
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SmtpServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.context = app.app_context()
+        self.context.push()
+        self.backend = SmtpBackend(
+            host='127.0.0.1', port=self.server.server_address[1],
+            username='user', password='secret', starttls=False,
+        )
+
+    def tearDown(self):
+        self.backend.pool.clear()
+        self.context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_sessions_are_reused(self):
+        '''
+        Assert that messages are sent over the same smtp session, When sending
+        one after the other
+        '''
+        messages = [
+            EmailMessage(to=['a@example.com'], subject='Hi', text='One'),
+            EmailMessage(to=['b@example.com'], subject='Hi', text='Two'),
+        ]
+        self.assertEquals(self.backend.send_messages(messages), 2)
+        self.assertEquals(self.server.sessions, 1)
+        self.assertEquals(
+            [message['to'] for message in self.server.messages],
+            [['<a@example.com>'], ['<b@example.com>']],
+        )
+
+    def test_message_is_built_from_email(self):
+        '''
+        Assert that cc and bcc addresses are recipients, the headers are set
+        and the text and html are alternatives
+        '''
+        self.backend.send_messages([EmailMessage(
+            to=['a@example.com'], cc=['b@example.com'], bcc=['c@example.com'],
+            from_email='test@tapandita.com', from_name='Test client',
+            subject='Hi', text='Text', html='<b>Html</b>',
+            headers={'X-Test': 'test'},
+        )])
+        envelope = self.server.messages[0]
+        self.assertEquals(envelope['to'], [
+            '<a@example.com>', '<b@example.com>', '<c@example.com>',
+        ])
+
+        mime = email.message_from_string(envelope['data'])
+        self.assertEquals(mime['From'], 'Test client <test@tapandita.com>')
+        self.assertEquals(mime['Cc'], 'b@example.com')
+        self.assertIsNone(mime['Bcc'])
+        self.assertEquals(mime['X-Test'], 'test')
+        self.assertEquals(mime.get_content_type(), 'multipart/alternative')
+        self.assertEquals(
+            [part.get_payload(decode=True) for part in mime.get_payload()],
+            ['Text', '<b>Html</b>'],
+        )
+
+    def test_deadline_timeout_is_applied(self):
+        '''
+        Assert that the message is sent, When it is given the (connect, read)
+        timeout tuple of a deadline
+        '''
+        message = EmailMessage(to=['a@example.com'], text='One')
+        self.assertEquals(
+            self.backend.send_messages([message], timeout=(1, 2)), 1,
+        )
+        self.assertEquals(self.backend.pool.idle[0][0].sock.gettimeout(), 2)
+
+    def test_attachment_is_streamed(self):
+        '''
+        Assert that attachments are sent base64 encoded, read a chunk at a
+        time instead of whole
+        '''
+        content = ''.join(chr(number % 256) for number in range(200003))
+        attachment = Attachment('data.bin', StringIO(content))
+        chunks = attachment.chunks
+        sizes = []
+
+        def recorded_chunks(chunk_size):
+            sizes.append(chunk_size)
+            return chunks(chunk_size)
+
+        attachment.chunks = recorded_chunks
+        self.backend.send_messages([EmailMessage(
+            to=['a@example.com'], subject='Hi', text='Text',
+            attachments=[attachment],
+        )])
+
+        mime = email.message_from_string(
+            self.server.messages[0]['data'].replace('\r\n', '\n'),
+        )
+        body, part = mime.get_payload()
+        self.assertEquals(body.get_payload(decode=True), 'Text')
+        self.assertEquals(part.get_filename(), 'data.bin')
+        self.assertEquals(part.get_payload(decode=True), content)
+        self.assertTrue(all(line and len(line) <= 76 for line in
+                            part.get_payload().splitlines()))
+        self.assertLess(max(sizes), len(content))
+
+    def test_batch_is_personalised(self):
+        '''
+        Assert that every recipient of a batch gets a message of their own
+        with their substitutions, over one session
+        '''
+        batch = BatchEmailMessage([
+            {'email': 'a@example.com', 'substitutions': {'name': 'A'}},
+            {'email': 'b@example.com', 'substitutions': {'name': 'B'}},
+        ], subject='Hello %name%', text='Hi %name%')
+        self.assertEquals(self.backend.send_batch(batch), 2)
+        self.assertEquals(self.server.sessions, 1)
+        self.assertEquals([
+            email.message_from_string(message['data'])['Subject']
+            for message in self.server.messages
+        ], ['Hello A', 'Hello B'])
+
+    def test_permanent_rejection_is_client_error(self):
+        '''
+        Assert that ClientException is raised and the session is kept, When
+        the relay refuses a recipient with a 5xx reply
+        '''
+        self.server.reject['RCPT'] = '550 No such user'
+        message = EmailMessage(to=['a@example.com'], text='One')
+
+        with self.assertRaises(ClientException) as context:
+            self.backend.send_messages([message])
+
+        self.assertEquals(context.exception.status_code, 400)
+        self.assertEquals(len(self.backend.pool.idle), 1)
+
+    def test_refused_recipients_are_rejected(self):
+        '''
+        Assert that the recipients the relay refused are listed in rejected,
+        When it accepted the others
+        '''
+        self.server.reject['<b@example.com>'] = '550 No such user'
+        message = EmailMessage(to=['a@example.com', 'b@example.com'])
+        self.assertEquals(self.backend.send_messages([message]), 1)
+        self.assertEquals(message.rejected, ['b@example.com'])
+
+        batch = BatchEmailMessage(
+            [{'email': 'a@example.com'}, {'email': 'b@example.com'}],
+            text='Hi',
+        )
+        self.backend.send_batch(batch)
+        self.assertEquals(batch.rejected, ['b@example.com'])
+
+    def test_send_email_reports_rejected_recipients(self):
+        '''
+        Assert that the send email endpoint sends through the smtp backend
+        within its deadline, And lists the refused recipients as rejected
+        '''
+        self.server.reject['<b@example.com>'] = '550 No such user'
+        breaker.reset()
+        app.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        backends = app.config['EMAIL_BACKENDS']
+        app.config['EMAIL_BACKENDS'] = ['smtp']
+        registry.reset()
+        registry._backends['smtp'] = self.backend
+
+        try:
+            response = app.test_client().post(
+                '/api/v1/emails', data=json.dumps({
+                    'to': ['a@example.com', 'b@example.com'],
+                    'subject': 'Hi',
+                    'text': 'One',
+                }), headers={
+                    'content-type': 'application/json',
+                    'accept': 'application/json',
+                },
+            )
+        finally:
+            app.config['EMAIL_BACKENDS'] = backends
+            registry.reset()
+
+        result = json.loads(response.data)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(result['backend'], 'smtp')
+        self.assertEquals(result['rejected'], ['b@example.com'])
+
+    def test_transient_rejection_is_server_error(self):
+        '''
+        Assert that ServerException is raised, When the relay defers a
+        message with a 4xx reply
+        '''
+        self.server.reject['DATA'] = '451 Try again later'
+        message = EmailMessage(to=['a@example.com'], text='One')
+
+        with self.assertRaises(ServerException) as context:
+            self.backend.send_messages([message])
+
+        self.assertEquals(context.exception.status_code, 503)
+
+    def test_unreachable_relay_is_server_error(self):
+        '''
+        Assert that ServerException is raised, When the relay is down
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+        message = EmailMessage(to=['a@example.com'], text='One')
+
+        with self.assertRaises(ServerException):
+            self.backend.send_messages([message])
+
+        self.assertFalse(self.backend.probe())
+
+    def test_dropped_sessions_are_replaced(self):
+        '''
+        Assert that the message is sent over a new session, When the relay
+        closed the pooled one
+        '''
+        self.server.drop_after = 1
+        messages = [
+            EmailMessage(to=['a@example.com'], text='One'),
+            EmailMessage(to=['b@example.com'], text='Two'),
+        ]
+        self.assertEquals(self.backend.send_messages(messages), 2)
+        self.assertEquals(self.server.sessions, 2)
+        self.assertEquals(len(self.server.messages), 2)
+
+    def test_sessions_are_recycled(self):
+        '''
+        Assert that a session is closed, When it sent max_messages messages
+        '''
+        self.backend.pool.max_messages = 2
+        messages = [
+            EmailMessage(to=['a@example.com'], text=str(number))
+            for number in range(3)
+        ]
+        self.backend.send_messages(messages)
+        self.assertEquals(self.server.sessions, 2)
+
+    def test_warm_opens_sessions(self):
+        '''
+        Assert that warm opens sessions that are used by the next message
+        '''
+        self.backend.warm(2)
+        self.assertEquals(len(self.backend.pool.idle), 2)
+        self.assertTrue(self.backend.probe())
+
+        self.backend.send_messages([
+            EmailMessage(to=['a@example.com'], text='One'),
+        ])
+        self.assertEquals(self.server.sessions, 2)
+
+    def test_idle_sessions_are_pooled_up_to_size(self):
+        '''
+        Assert that the pool keeps no more than size idle sessions
+        '''
+        pool = SmtpConnectionPool(
+            '127.0.0.1', self.server.server_address[1], starttls=False,
+            size=1,
+        )
+        pool.warm(3)
+        self.assertEquals(len(pool.idle), 1)
+        pool.clear()
+        self.assertEquals(pool.idle, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
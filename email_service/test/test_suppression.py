@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from mail.suppression import (
+    KEY_TYPECODE, SuppressionIndex, SuppressionList, key_of,
+)
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.suppression_list = SuppressionList(':memory:', reload_interval=None)
+        self.suppression_list.add(
+            ['bounced@tapandita.com', 'spam.com'], reason='bounce',
+        )
+
+    def test_index_matches_addresses_and_domains(self):
+        '''
+        Assert that an index matches its addresses and every address of its
+        domains, whatever their case
+        '''
+        addresses = ['a@tapandita.com', 'b@tapandita.com']
+        index = SuppressionIndex(
+            array(KEY_TYPECODE, sorted(key_of(entry) for entry in addresses)),
+            ['spam.com'],
+        )
+        self.assertIn('A@Tapandita.com', index)
+        self.assertIn('b@tapandita.com', index)
+        self.assertIn('anyone@spam.com', index)
+        self.assertNotIn('c@tapandita.com', index)
+        self.assertNotIn('a@spam.com.au', index)
+        self.assertEquals(len(index), 3)
+
+    def test_filter_splits_addresses(self):
+        '''
+        Assert that filter returns the allowed and the suppressed addresses
+        '''
+        allowed, suppressed = self.suppression_list.filter([
+            'tapan@tapandita.com', 'Bounced@tapandita.com', 'x@spam.com',
+        ])
+        self.assertEquals(allowed, ['tapan@tapandita.com'])
+        self.assertEquals(suppressed, ['Bounced@tapandita.com', 'x@spam.com'])
+
+    def test_changes_are_seen_once_reloaded(self):
+        '''
+        Assert that the index is rebuilt by reload, When entries are added
+        and removed
+        '''
+        self.assertTrue(self.suppression_list.is_suppressed('x@spam.com'))
+        self.assertEquals(self.suppression_list.add(['new@tapandita.com']), 1)
+        self.assertTrue(self.suppression_list.remove('spam.com'))
+        self.assertFalse(self.suppression_list.remove('spam.com'))
+        self.assertTrue(self.suppression_list.is_suppressed('x@spam.com'))
+
+        self.suppression_list.reload()
+        self.assertFalse(self.suppression_list.is_suppressed('x@spam.com'))
+        self.assertTrue(
+            self.suppression_list.is_suppressed('new@tapandita.com'),
+        )
+
+    def test_duplicates_are_ignored(self):
+        '''
+        Assert that entries already suppressed aren't counted or changed
+        '''
+        generation = self.suppression_list.current_generation()
+        self.assertEquals(
+            self.suppression_list.add(['BOUNCED@tapandita.com'], 'unsubscribe'),
+            0,
+        )
+        self.assertEquals(
+            self.suppression_list.get('bounced@tapandita.com')['reason'],
+            'bounce',
+        )
+        self.assertEquals(
+            self.suppression_list.current_generation(), generation,
+        )
+
+    def test_changes_are_reloaded_in_background(self):
+        '''
+        Assert that another process picks changes up in a background reload,
+        When its reload interval has passed
+        '''
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'suppressions.db')
+
+        try:
+            writer = SuppressionList(path)
+            reader = SuppressionList(path, reload_interval=0)
+            self.assertFalse(reader.is_suppressed('a@tapandita.com'))
+
+            writer.add(['a@tapandita.com'])
+            # the old index answers until the new one is swapped in
+            reader.is_suppressed('a@tapandita.com')
+            reader.reloading.join()
+            self.assertTrue(reader.is_suppressed('a@tapandita.com'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_load_file(self):
+        '''
+        Assert that the entries of a file are suppressed, skipping blank and
+        comment lines
+        '''
+        entries_file = tempfile.NamedTemporaryFile()
+        entries_file.write('# bounces\na@tapandita.com\n\nspam.com\nb.com\n')
+        entries_file.flush()
+
+        self.assertEquals(
+            self.suppression_list.load_file(entries_file.name, chunk_size=1),
+            2,
+        )
+        self.suppression_list.reload()
+        self.assertTrue(self.suppression_list.is_suppressed('a@tapandita.com'))
+        self.assertTrue(self.suppression_list.is_suppressed('x@b.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+from mail.cache import LRUCache
+from mail.templates import TemplateStore
+from mail.exceptions import ClientException
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.store = TemplateStore(':memory:', cache_size=2)
+        self.store.save(
+            'welcome', 'Hi {{ name }}', text='Welcome {{ name }}',
+            html='<b>{{ name }}</b>',
+        )
+
+    def test_saving_a_template_creates_a_new_version(self):
+        '''
+        Assert that templates are versioned
+        '''
+        self.assertEquals(self.store.save('welcome', 'Hello'), 2)
+        self.assertEquals(self.store.get('welcome')['subject'], 'Hello')
+        self.assertEquals(self.store.get('welcome', 1)['subject'],
+                          'Hi {{ name }}')
+
+    def test_render_uses_latest_version(self):
+        '''
+        Assert that a new version is rendered once saved,
+        Even if the previous one is cached
+        '''
+        self.store.render('welcome', {'name': 'Tapan'})
+        self.store.save('welcome', 'Hello {{ name }}', text='Hello')
+        rendered = self.store.render('welcome', {'name': 'Tapan'})
+        self.assertEquals(rendered['subject'], 'Hello Tapan')
+
+    def test_html_is_autoescaped(self):
+        '''
+        Assert that context values are escaped in the html body only
+        '''
+        rendered = self.store.render('welcome', {'name': '<i>'})
+        self.assertEquals(rendered['html'], '<b>&lt;i&gt;</b>')
+        self.assertEquals(rendered['text'], 'Welcome <i>')
+
+    def test_render_unknown_template(self):
+        '''
+        Assert that rendering a missing template raises ClientException
+        '''
+        with self.assertRaises(ClientException) as context:
+            self.store.render('missing')
+        self.assertEquals(context.exception.status_code, 404)
+
+    def test_render_with_missing_context(self):
+        '''
+        Assert that undefined variables raise ClientException
+        '''
+        with self.assertRaises(ClientException) as context:
+            self.store.render('welcome', {})
+        self.assertEquals(context.exception.status_code, 400)
+
+    def test_templates_are_sandboxed(self):
+        '''
+        Assert that ClientException is raised, When a template reaches for
+        python internals
+        '''
+        self.store.save(
+            'unsafe', "{{ ''.__class__.__mro__[2].__subclasses__() }}",
+        )
+
+        with self.assertRaises(ClientException) as context:
+            self.store.render('unsafe')
+        self.assertEquals(context.exception.status_code, 400)
+
+    def test_templates_are_kept_per_tenant(self):
+        '''
+        Assert that a tenant neither sees nor overwrites the templates of
+        another tenant with the same name
+        '''
+        self.assertEquals(
+            self.store.save('welcome', 'Hey {{ name }}', tenant='acme'), 1,
+        )
+        self.assertEquals(
+            self.store.render('welcome', {'name': 'A'}, tenant='acme'),
+            {'subject': 'Hey A'},
+        )
+        self.assertEquals(
+            self.store.render('welcome', {'name': 'A'})['subject'], 'Hi A',
+        )
+        self.assertIsNone(self.store.get('welcome', tenant='globex'))
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        '''
+        Assert that the cache drops the least recently used key when full
+        '''
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
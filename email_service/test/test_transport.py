@@ -0,0 +1,65 @@
+import unittest
+
+import mock
+
+from app import app
+from mail import transport
+from mail.backends import SendgridBackend, MailgunBackend
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        transport.reset()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_backends_share_session_of_their_provider(self):
+        '''
+        Assert that backend instances of the same provider use one session
+        '''
+        self.assertIs(
+            SendgridBackend().requests_session,
+            SendgridBackend().requests_session,
+        )
+
+    def test_providers_have_separate_sessions(self):
+        '''
+        Assert that sendgrid and mailgun don't share a connection pool
+        '''
+        self.assertIsNot(
+            SendgridBackend().requests_session,
+            MailgunBackend().requests_session,
+        )
+
+    def test_session_pool_is_sized_from_config(self):
+        '''
+        Assert that the connection pool size comes from HTTP_POOL_SIZE
+        '''
+        adapter = transport.get_session('sendgrid').get_adapter(
+            'https://api.sendgrid.com',
+        )
+        self.assertEquals(adapter._pool_maxsize, app.config['HTTP_POOL_SIZE'])
+
+    def test_sessions_ignore_environment(self):
+        '''
+        Assert that sessions don't look up proxies and credentials in the
+        environment, When HTTP_TRUST_ENV isn't set
+        '''
+        self.assertFalse(transport.get_session('sendgrid').trust_env)
+
+    def test_sessions_are_recreated_after_fork(self):
+        '''
+        Assert that a forked process doesn't reuse the sessions of its parent
+        '''
+        session = transport.get_session('sendgrid')
+
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(transport.get_session('sendgrid'), session)
+
+
+if __name__ == '__main__':
+    unittest.main()
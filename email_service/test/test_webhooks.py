@@ -0,0 +1,266 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import unittest
+
+import mock
+
+from app import app
+from mail.events import EventBuffer, EventStore
+from mail.exceptions import ClientException
+from mail.webhooks import normalize_mailgun, verify_mailgun
+
+
+class TestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.store = EventStore(':memory:')
+        app.event_buffer = EventBuffer(
+            self.store, batch_size=2, flush_interval=None,
+        )
+        self.client = app.test_client()
+        credentials = base64.b64encode('sendgrid:wh00k')
+        self.sendgrid_headers = {
+            'content-type': 'application/json',
+            'authorization': 'Basic ' + credentials,
+        }
+        self.sendgrid_events = [
+            {
+                'email': 'tapan.pandita@gmail.com',
+                'timestamp': 1400000000,
+                'event': 'delivered',
+                'sg_message_id': '14c5d75ce93.dfd.64b469.filter0001.16648',
+                'response': '250 OK',
+            },
+            {
+                'email': 'tapan.pandita+1@gmail.com',
+                'timestamp': 1400000001,
+                'event': 'bounce',
+                'reason': '500 unknown recipient',
+            },
+        ]
+
+    def sign(self, timestamp=None, token='50dcec0e7f1e0a4d'):
+        '''Returns the fields of a mailgun webhook signature'''
+        timestamp = str(int(timestamp or time.time()))
+        return {
+            'timestamp': timestamp,
+            'token': token,
+            'signature': hmac.new(
+                app.config['MAILGUN_WEBHOOK_KEY'], timestamp + token,
+                hashlib.sha256,
+            ).hexdigest(),
+        }
+
+    def test_sendgrid_events_are_normalised_and_stored(self):
+        '''
+        Assert that sendgrid events are acknowledged and stored with the
+        common event names, When a batch of events is posted
+        '''
+        response = self.client.post(
+            '/api/v1/webhooks/sendgrid', data=json.dumps(self.sendgrid_events),
+            headers=self.sendgrid_headers,
+        )
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data)['count'], 2)
+
+        events = self.store.find()
+        self.assertEquals(
+            [(event['event'], event['reason']) for event in events],
+            [('delivered', '250 OK'), ('bounced', '500 unknown recipient')],
+        )
+        self.assertEquals(
+            events[0]['message_id'], self.sendgrid_events[0]['sg_message_id'],
+        )
+        self.assertEquals(events[1]['data'], self.sendgrid_events[1])
+
+    def test_sendgrid_event_fields_of_the_wrong_type(self):
+        '''
+        Assert that sendgrid events are stored without the fields of the wrong
+        type, When an event has a list or object where a string is expected
+        '''
+        events = [dict(
+            self.sendgrid_events[0], email=['tapan.pandita@gmail.com'],
+            timestamp={'at': 1400000000}, event=['delivered'],
+        )]
+        response = self.client.post(
+            '/api/v1/webhooks/sendgrid', data=json.dumps(events * 2),
+            headers=self.sendgrid_headers,
+        )
+        self.assertEquals(response.status_code, 200)
+
+        event = self.store.find()[0]
+        self.assertEquals(
+            (event['event'], event['email'], event['timestamp']),
+            ('unknown', None, None),
+        )
+        self.assertEquals(event['data'], events[0])
+
+    def test_sendgrid_webhook_with_wrong_credentials(self):
+        '''
+        Assert that the sendgrid webhook returns unauthorized, 401, When the
+        basic auth credentials don't match
+        '''
+        headers = dict(
+            self.sendgrid_headers,
+            authorization='Basic ' + base64.b64encode('sendgrid:wrong'),
+        )
+        response = self.client.post(
+            '/api/v1/webhooks/sendgrid', data=json.dumps(self.sendgrid_events),
+            headers=headers,
+        )
+        self.assertEquals(response.status_code, 401)
+        self.assertEquals(len(app.event_buffer), 0)
+
+    def test_sendgrid_webhook_with_invalid_payload(self):
+        '''
+        Assert that the sendgrid webhook returns bad request, 400, When the
+        payload isn't a list of events
+        '''
+        response = self.client.post(
+            '/api/v1/webhooks/sendgrid', data=json.dumps({'event': 'open'}),
+            headers=self.sendgrid_headers,
+        )
+        self.assertEquals(response.status_code, 400)
+
+    def test_mailgun_form_webhook(self):
+        '''
+        Assert that a signed mailgun form webhook is buffered until a batch
+        is full
+        '''
+        fields = dict(
+            self.sign(), event='bounced', recipient='tapan.pandita@gmail.com',
+            error='5.1.1 The email account does not exist',
+        )
+        fields['Message-Id'] = '<20140101.1@tapandita.com>'
+        response = self.client.post('/api/v1/webhooks/mailgun', data=fields)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(app.event_buffer), 1)
+        self.assertEquals(self.store.find(), [])
+
+        app.event_buffer.flush()
+        event = self.store.find('tapan.pandita@gmail.com')[0]
+        self.assertEquals(event['event'], 'bounced')
+        self.assertEquals(event['message_id'], '<20140101.1@tapandita.com>')
+        self.assertEquals(
+            event['reason'], '5.1.1 The email account does not exist',
+        )
+
+    def test_mailgun_json_webhook(self):
+        '''
+        Assert that a temporary failure of a mailgun json webhook is stored
+        as deferred
+        '''
+        payload = {
+            'signature': self.sign(),
+            'event-data': {
+                'event': 'failed',
+                'severity': 'temporary',
+                'recipient': 'tapan.pandita@gmail.com',
+                'timestamp': 1400000000.5,
+                'message': {'headers': {'message-id': '1@tapandita.com'}},
+                'delivery-status': {'message': '452 Mailbox full'},
+            },
+        }
+        response = self.client.post(
+            '/api/v1/webhooks/mailgun', data=json.dumps(payload),
+            content_type='application/json',
+        )
+        self.assertEquals(response.status_code, 200)
+        app.event_buffer.flush()
+        event = self.store.find()[0]
+        self.assertEquals(event['event'], 'deferred')
+        self.assertEquals(event['timestamp'], 1400000000.5)
+        self.assertEquals(event['message_id'], '1@tapandita.com')
+        self.assertEquals(event['reason'], '452 Mailbox full')
+
+    def test_mailgun_webhook_with_bad_signature(self):
+        '''
+        Assert that the mailgun webhook returns unauthorized, 401, When the
+        signature is forged or too old
+        '''
+        forged = dict(self.sign(), signature='0' * 64, event='opened')
+        stale = dict(self.sign(time.time() - 3600), event='opened')
+
+        for fields in (forged, stale):
+            response = self.client.post(
+                '/api/v1/webhooks/mailgun', data=fields,
+            )
+            self.assertEquals(response.status_code, 401)
+
+    def test_verify_mailgun_without_key(self):
+        '''
+        Assert that every webhook is refused, When no key is configured
+        '''
+        with self.assertRaises(ClientException):
+            verify_mailgun(self.sign(), None, 300)
+
+    def test_webhooks_get_503_when_buffer_is_full(self):
+        '''
+        Assert that webhooks are refused with Retry-After, When the buffer
+        can't take their events
+        '''
+        app.event_buffer.max_size = 1
+        response = self.client.post(
+            '/api/v1/webhooks/sendgrid', data=json.dumps(self.sendgrid_events),
+            headers=self.sendgrid_headers,
+        )
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response.headers['Retry-After'], '1')
+
+    def test_failed_writes_are_buffered_again(self):
+        '''
+        Assert that events are kept for the next flush, When writing them
+        fails
+        '''
+        events = [normalize_mailgun({'event': 'opened'})]
+        app.event_buffer.add(events)
+
+        with mock.patch.object(self.store, 'write', side_effect=IOError):
+
+            with self.assertRaises(IOError):
+                app.event_buffer.flush()
+
+        self.assertEquals(len(app.event_buffer), 1)
+        self.assertEquals(app.event_buffer.flush(), 1)
+        self.assertEquals(app.event_buffer.flush(), 0)
+
+    def test_events_that_cannot_be_stored_are_dropped(self):
+        '''
+        Assert that the other events are written and the buffer is emptied,
+        When an event in it can never be stored
+        '''
+        events = [normalize_mailgun({'event': 'opened'}) for _ in range(3)]
+        events[1]['email'] = ['tapan.pandita@gmail.com']
+        app.event_buffer.batch_size = len(events) + 1
+        app.event_buffer.add(events)
+
+        self.assertEquals(app.event_buffer.flush(), 2)
+        self.assertEquals(len(app.event_buffer), 0)
+        self.assertEquals(len(self.store.find()), 2)
+
+    def test_flusher_writes_full_batches(self):
+        '''
+        Assert that the flusher thread writes a batch as soon as it is full
+        '''
+        buffer = EventBuffer(
+            mock.Mock(), batch_size=2, flush_interval=60,
+        )
+        buffer.start()
+        buffer.add([normalize_mailgun({'event': 'opened'})] * 2)
+
+        for _ in range(100):
+
+            if buffer.store.write.called:
+                break
+
+            time.sleep(0.01)
+
+        self.assertEquals(len(buffer.store.write.call_args[0][0]), 2)
+        self.assertEquals(len(buffer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+'''Stage timings of every request, sent in a Server-Timing header and logged'''
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+
+logger = logging.getLogger('email_service.timing')
+
+
+def format_header(timings):
+    '''Renders (name, seconds) tuples as a Server-Timing header value'''
+    return ', '.join(
+        '{0};dur={1:.3f}'.format(name, duration * 1000)
+        for name, duration in timings
+    )
+
+
+def format_fields(fields):
+    '''Renders (name, value) tuples as key=value log fields'''
+    return ' '.join(
+        '{0}={1}'.format(name, value) for name, value in fields
+    )
+
+
+class RequestTimer(object):
+    '''
+    Records how long the stages of a request take: parsing and validating its
+    payload, building the email and, for every backend tried, creating the
+    provider payload and the http round trip. Stages run more than once, like
+    the round trips of a batch, are added up. Stages are timed only while a
+    request is handled in the current thread, elsewhere they are not recorded.
+    '''
+
+    def __init__(self, header=True, log=False):
+        self.header = header
+        self.log = log
+
+    @contextmanager
+    def stage(self, name):
+        '''Times the block as a stage of the current request'''
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, duration):
+        '''Adds duration seconds to a stage of the current request'''
+
+        if not has_request_context():
+            return
+
+        timings = getattr(g, 'timings', None)
+
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + duration
+
+    def init_app(self, flask_app):
+        '''
+        Makes the timer available as flask_app.timer and reports the stages
+        of every request, with its total duration, in milliseconds.
+        '''
+        flask_app.timer = self
+
+        if self.log and not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+
+        @flask_app.before_request
+        def start_timings():
+            g.timings = OrderedDict()
+            g.timings_started_at = time.time()
+
+        @flask_app.after_request
+        def report_timings(response):
+            timings = getattr(g, 'timings', None)
+
+            if timings is None:
+                return response
+
+            stages = timings.items() + [
+                ('total', time.time() - g.timings_started_at),
+            ]
+
+            if self.header:
+                response.headers['Server-Timing'] = format_header(stages)
+
+            if self.log:
+                route = (
+                    request.url_rule.rule if request.url_rule else 'unmatched'
+                )
+                logger.info(format_fields([
+                    ('method', request.method), ('route', route),
+                    ('status', response.status_code),
+                ] + [
+                    ('{0}_ms'.format(name), '{0:.3f}'.format(duration * 1000))
+                    for name, duration in stages
+                ]))
+
+            return response
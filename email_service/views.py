@@ -0,0 +1,777 @@
+'''Routes of the email service api'''
+import math
+
+from flask import Blueprint, Response, request, jsonify, g
+from flask import current_app as app
+
+from email_service.decorators import (
+    admin_required, authenticate, consumes, produces, json_validate,
+    idempotent, rate_limit,
+)
+from email_service.schemas import (
+    email_api_schema, email_batch_api_schema, template_api_schema,
+    suppression_api_schema, get_format_checker, parse_timestamp,
+)
+from email_service.errors import ValidationError
+from mail import breaker, registry
+from mail.deadline import Deadline
+from mail.fanout import fan_out
+from mail.message import (
+    EmailMessage, BatchEmailMessage, content_key, group_payloads,
+    recipient_limit, rejected_error, suppressed_error,
+)
+from mail.multipart import Attachment
+from mail.webhooks import (
+    verify_sendgrid, verify_mailgun, normalize_sendgrid, normalize_mailgun,
+)
+from mail.exceptions import ClientException, DeadlineExceeded, RateLimited
+
+
+api = Blueprint('api', __name__)
+
+
+@api.route('/api/v1/health', methods=['GET'])
+@produces('application/json')
+def health():
+    '''Check the status of the service.'''
+    return jsonify({'status': 'ok'})
+
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    '''Exports the metrics of all the workers in the prometheus format.'''
+    return Response(
+        app.metrics.render(), mimetype='text/plain',
+        headers={'Content-Type': 'text/plain; version=0.0.4'},
+    )
+
+
+@api.route('/api/v1/health/backends', methods=['GET'])
+@produces('application/json')
+def backends_health():
+    '''
+    Returns the circuit breaker state of every email backend, and the
+    concurrency limit of the worker.
+    '''
+    backends = [
+        breaker.get_breaker(backend.name).to_dict()
+        for backend in registry.get_backends()
+    ]
+
+    return jsonify({
+        'backends': backends,
+        'concurrency': app.concurrency_limiter.to_dict(),
+    })
+
+
+def request_deadline():
+    '''
+    Returns the deadline for the current request. Clients may shorten the
+    configured SEND_DEADLINE with a header holding a timeout in milliseconds.
+    '''
+    budget = app.config['SEND_DEADLINE']
+
+    try:
+        requested = float(request.headers[app.config['SEND_DEADLINE_HEADER']])
+    except (KeyError, ValueError):
+        pass
+    else:
+        budget = min(budget, max(requested / 1000, 0))
+
+    return Deadline(budget, connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'])
+
+
+def tenant_payload(payload):
+    '''
+    Returns an email payload with the tenant of the request, so the email is
+    rendered from the templates of the tenant and logged as theirs, even once
+    queued. A tenant set by the client is never kept.
+    '''
+    payload = dict(payload)
+    payload.pop('tenant', None)
+
+    if g.tenant is not None:
+        payload['tenant'] = g.tenant
+
+    return payload
+
+
+def wants_async():
+    '''
+    True if the client asked for the email to be queued, with `?async=1` or a
+    `Prefer: respond-async` header.
+    '''
+    prefer = request.headers.get('Prefer', '')
+
+    return (
+        request.args.get('async') in ('1', 'true') or
+        'respond-async' in [value.strip() for value in prefer.split(',')]
+    )
+
+
+@api.route('/api/v1/emails', methods=['POST'])
+@authenticate
+@consumes('application/json', 'multipart/form-data')
+@produces('application/json')
+@rate_limit
+@json_validate(email_api_schema, get_format_checker)
+@idempotent
+def send_email():
+    '''
+    Thin wrapper around sendgrid and mailgun apis. Sends emails to provided
+    email addresses, or queues them to be sent by the workers if the client
+    asked for an asynchronous response. Emails with a send_at are queued
+    until then. Emails with attachments are posted as multipart forms, with
+    the json payload in the payload field. Concurrent emails with the same
+    content may be sent together, see coalescable.
+    '''
+    deadline = request_deadline()
+    request_payload = tenant_payload(request.get_json())
+    send_at = request_payload.pop('send_at', None)
+    attachments = [
+        Attachment.from_storage(storage) for storage in request.attachments
+    ]
+
+    if (wants_async() or send_at is not None) and attachments:
+        raise ValidationError(
+            'attachments', 'Emails with attachments cannot be queued',
+        )
+
+    if send_at is not None:
+        message_id = app.outbox.put(request_payload, parse_timestamp(send_at))
+        return jsonify({
+            'message': 'scheduled', 'id': message_id, 'send_at': send_at,
+        }), 202
+
+    if wants_async():
+        message_id = app.outbox.put(request_payload)
+        response = jsonify({'message': 'queued', 'id': message_id})
+        response.headers['Preference-Applied'] = 'respond-async'
+        return response, 202
+
+    if coalescable(request_payload, attachments):
+        # the group is sent under the deadline of its first request, so only
+        # requests with the same budget share one, see coalescable
+        is_sent, backend, message_id = app.coalescer.submit(
+            (g.tenant, deadline.budget, content_key(request_payload)),
+            request_payload,
+            lambda payloads: send_coalesced(payloads, deadline),
+            timeout=deadline.remaining(),
+        )
+
+        if not is_sent:
+            return jsonify({'message': 'error', 'id': message_id}), 502
+
+        return jsonify({
+            'message': 'success', 'id': message_id, 'backend': backend.name,
+        })
+
+    with app.timer.stage('message'):
+        message = EmailMessage(attachments=attachments, **request_payload)
+        chunks = message.split(recipient_limit())
+
+    if len(chunks) > 1:
+        # chunks share the attachment files, they can't be read concurrently
+        concurrency = 1 if attachments else app.config['FANOUT_CONCURRENCY']
+        result = chunk_results(chunks, fan_out(
+            lambda chunk: deliver(chunk, deadline), chunks, concurrency,
+        ))
+        status_code = {'success': 200, 'partial': 207}.get(
+            result['message'], 502,
+        )
+        result['id'] = message.id
+        return jsonify(result), status_code
+
+    is_sent, backend = message.send(deadline=deadline)
+
+    if not is_sent:
+        return jsonify({'message': 'error', 'id': message.id}), 502
+
+    result = {'message': 'success', 'id': message.id, 'backend': backend.name}
+
+    if message.suppressed:
+        result['suppressed'] = message.suppressed
+
+    if message.rejected:
+        result['rejected'] = message.rejected
+
+    return jsonify(result)
+
+
+def coalescable(payload, attachments):
+    '''
+    True if an email may be merged by the coalescer of the app with the
+    emails of the same content sent by concurrent requests. Only emails to a
+    single address, without cc, bcc, template or attachments, are, and only
+    if the coalescer has a window. Emails are only merged with those of
+    requests with the same deadline budget, whose deadline, started at most a
+    window earlier, ends no later than their own.
+    '''
+    return bool(
+        app.coalescer.window and not attachments and
+        len(payload['to']) == 1 and
+        not (payload.get('cc') or payload.get('bcc')) and
+        'template_id' not in payload
+    )
+
+
+def send_coalesced(payloads, deadline):
+    '''
+    Sends the emails coalesced from concurrent requests. Emails with the same
+    content go out as batches, one provider call for up to recipient_limit
+    of them, every recipient getting their own copy. Returns, for every
+    payload, the (is_sent, backend, id) of its message or the exception it
+    failed with.
+    '''
+    outcomes = [None] * len(payloads)
+    limit = recipient_limit()
+    jobs = []
+
+    if len(payloads) > 1:
+        app.metrics.inc('email_service_coalesced_emails_total', value=len(
+            payloads,
+        ))
+
+    for indexes, message in group_payloads(payloads):
+
+        if isinstance(message, ClientException):
+
+            for index in indexes:
+                outcomes[index] = message
+
+            continue
+
+        size = limit or len(indexes)
+        jobs.extend(
+            (indexes[start:start + size], chunk)
+            for start, chunk in zip(
+                range(0, len(indexes), size), message.split(size),
+            )
+        )
+
+    def send(job):
+        message = job[1]
+
+        try:
+            is_sent, backend = message.send(deadline=deadline)
+        except (ClientException, DeadlineExceeded, RateLimited), excp:
+            return excp
+
+        return is_sent, backend, message.id
+
+    results = fan_out(send, jobs, app.config['FANOUT_CONCURRENCY'])
+
+    for (indexes, message), outcome in zip(jobs, results):
+
+        for index in indexes:
+            outcomes[index] = outcome
+
+        if message.rejected:
+
+            for index, address in zip(indexes, message.to):
+
+                if address in message.rejected:
+                    outcomes[index] = rejected_error()
+
+    return outcomes
+
+
+def error_result(excp):
+    '''Returns the result of a message that failed with excp'''
+    return {
+        'message': 'error',
+        'status_code': excp.status_code,
+        'error': excp.error_message,
+    }
+
+
+def deliver(message, deadline):
+    '''
+    Sends a message and returns its result, with the id its attempts are
+    logged under, reporting errors instead of raising them.
+    '''
+
+    try:
+        is_sent, backend = message.send(deadline=deadline)
+    except (ClientException, DeadlineExceeded, RateLimited), excp:
+        return dict(error_result(excp), id=message.id)
+
+    if not is_sent:
+        return {'message': 'error', 'status_code': 502, 'id': message.id}
+
+    result = {'message': 'success', 'id': message.id, 'backend': backend.name}
+
+    if message.rejected:
+        result['rejected'] = message.rejected
+
+    return result
+
+
+def recipient_results(indexes, message, result):
+    '''
+    Yields the (index, result) of every recipient of a batch, the indexes in
+    the order of its to addresses. Those the backend rejected get an error
+    instead of the result of the batch.
+    '''
+    rejected = set(message.rejected)
+
+    for index, address in zip(indexes, message.to):
+
+        if address in rejected:
+            yield index, dict(error_result(rejected_error()), id=message.id)
+        else:
+            yield index, result
+
+
+def chunk_results(chunks, results):
+    '''
+    Combines the results of the chunks of a message. Every chunk result tells
+    which to addresses it covers by their offset and count in the message.
+    '''
+    offset = 0
+
+    for chunk, result in zip(chunks, results):
+        result['offset'] = offset
+        result['count'] = len(chunk.to)
+        offset += len(chunk.to)
+
+    sent = [result for result in results if result['message'] == 'success']
+
+    if len(sent) == len(results):
+        message = 'success'
+    elif sent:
+        message = 'partial'
+    else:
+        message = 'error'
+
+    return {'message': message, 'chunks': results}
+
+
+@api.route('/api/v1/emails/batch', methods=['POST'])
+@authenticate
+@consumes('application/json')
+@produces('application/json')
+@rate_limit
+@json_validate(email_batch_api_schema, get_format_checker)
+@idempotent
+def send_email_batch():
+    '''
+    Sends many emails with as few provider calls as possible. Takes either a
+    list of messages or a template with a list of recipients, and returns a
+    result for every message or recipient, in the same order. Messages with
+    a send_at are queued until then.
+    '''
+    deadline = request_deadline()
+    request_payload = request.get_json()
+    batch_size = app.config['BATCH_SIZE']
+
+    if 'messages' in request_payload:
+        payloads = [
+            tenant_payload(payload) for payload in request_payload['messages']
+        ]
+        count = len(payloads)
+        results = [None] * count
+        scheduled = [
+            index for index, payload in enumerate(payloads)
+            if 'send_at' in payload
+        ]
+        immediate = [
+            index for index, payload in enumerate(payloads)
+            if 'send_at' not in payload
+        ]
+
+        if scheduled:
+            message_ids = app.outbox.put_many(
+                (payload, parse_timestamp(payload.pop('send_at')))
+                for payload in [payloads[index] for index in scheduled]
+            )
+
+            for index, message_id in zip(scheduled, message_ids):
+                results[index] = {'message': 'scheduled', 'id': message_id}
+
+        messages = [
+            ([immediate[index] for index in indexes], message)
+            for indexes, message in group_payloads(
+                [payloads[index] for index in immediate],
+            )
+        ]
+    else:
+        recipients = request_payload['recipients']
+        count = len(recipients)
+        results = [None] * count
+        allowed = []
+
+        for index, recipient in enumerate(recipients):
+
+            if app.suppression_list.is_suppressed(recipient['email']):
+                results[index] = error_result(suppressed_error())
+            else:
+                allowed.append(index)
+
+        messages = [(allowed, BatchEmailMessage(
+            [recipients[index] for index in allowed],
+            **tenant_payload(request_payload['template'])
+        ))]
+
+    limit = recipient_limit()
+    batch_size = min(batch_size, limit or batch_size)
+    jobs = []
+
+    for indexes, message in messages:
+
+        if isinstance(message, ClientException):
+
+            for index in indexes:
+                results[index] = error_result(message)
+        elif isinstance(message, BatchEmailMessage):
+            jobs.extend(
+                (indexes[start:start + batch_size], [chunk])
+                for start, chunk in zip(
+                    range(0, len(indexes), batch_size),
+                    message.split(batch_size),
+                )
+            )
+        else:
+
+            try:
+                jobs.append((indexes, message.split(limit)))
+            except ClientException, excp:
+
+                for index in indexes:
+                    results[index] = error_result(excp)
+
+    outcomes = iter(fan_out(
+        lambda chunk: deliver(chunk, deadline),
+        [chunk for _, chunks in jobs for chunk in chunks],
+        app.config['FANOUT_CONCURRENCY'],
+    ))
+
+    for indexes, chunks in jobs:
+        results_of_chunks = [next(outcomes) for _ in chunks]
+
+        if len(chunks) == 1:
+            result = results_of_chunks[0]
+        else:
+            result = chunk_results(chunks, results_of_chunks)
+
+        for index in indexes:
+            results[index] = result
+
+        if isinstance(chunks[0], BatchEmailMessage) and chunks[0].rejected:
+            del result['rejected']
+            results_of_recipients = recipient_results(
+                indexes, chunks[0], result,
+            )
+
+            for index, result_of_recipient in results_of_recipients:
+                results[index] = result_of_recipient
+
+    return jsonify({'results': results})
+
+
+def attempt_result(attempt):
+    '''Returns a logged attempt with the id of its email as id'''
+    result = dict(attempt)
+    result['id'] = result.pop('message_id')
+
+    return result
+
+
+@api.route('/api/v1/emails/<message_id>', methods=['GET'])
+@authenticate
+@produces('application/json')
+def get_email(message_id):
+    '''
+    Returns the status of an email of the tenant and every attempt made to
+    send it. The email is sent if any attempt was, otherwise its status is
+    the one of the last attempt.
+    '''
+    attempts = app.send_log.find(message_id, g.tenant)
+
+    if not attempts:
+        return jsonify({'message': 'error'}), 404
+
+    sent = [attempt for attempt in attempts if attempt['status'] == 'sent']
+    last = (sent or attempts)[-1]
+
+    return jsonify({
+        'id': message_id,
+        'status': last['status'],
+        'backend': last['backend'],
+        'attempts': [attempt_result(attempt) for attempt in attempts],
+    })
+
+
+def time_argument(name):
+    '''Returns the unix timestamp of an ISO 8601 query argument, if given'''
+    value = request.args.get(name)
+
+    if value is None:
+        return None
+
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise ValidationError(name, 'Expected an ISO 8601 date and time')
+
+
+def cursor_argument():
+    '''Returns the (time, id) of the cursor query argument, if given'''
+    value = request.args.get('cursor')
+
+    if value is None:
+        return None
+
+    try:
+        created_at, attempt_id = value.split(',')
+        return float(created_at), int(attempt_id)
+    except ValueError:
+        raise ValidationError('cursor', 'Expected the next cursor of a page')
+
+
+@api.route('/api/v1/emails', methods=['GET'])
+@authenticate
+@produces('application/json')
+def search_emails():
+    '''
+    Returns the attempts of the tenant to send emails, newest first,
+    optionally only those to a recipient and made between since and until.
+    Pages hold limit attempts, at most SEND_LOG_MAX_PAGE, and the next one is
+    fetched by passing back the next cursor.
+    '''
+    limit = request.args.get('limit', 100, type=int)
+
+    if not 0 < limit <= app.config['SEND_LOG_MAX_PAGE']:
+        raise ValidationError('limit', 'Expected between 1 and {0}'.format(
+            app.config['SEND_LOG_MAX_PAGE'],
+        ))
+
+    attempts, cursor = app.send_log.search(
+        recipient=request.args.get('recipient'),
+        since=time_argument('since'),
+        until=time_argument('until'),
+        limit=limit,
+        cursor=cursor_argument(),
+        tenant=g.tenant,
+    )
+
+    return jsonify({
+        'emails': [attempt_result(attempt) for attempt in attempts],
+        'next': None if cursor is None else '{0!r},{1}'.format(*cursor),
+    })
+
+
+@api.route('/api/v1/templates/<name>', methods=['PUT'])
+@authenticate
+@consumes('application/json')
+@produces('application/json')
+@json_validate(template_api_schema, get_format_checker)
+def save_template(name):
+    '''
+    Stores a new version of the named template of the tenant. The subject,
+    text and html are jinja2 templates rendered with the context of each
+    email.
+    '''
+    request_payload = request.get_json()
+    version = app.template_store.save(
+        name,
+        request_payload['subject'],
+        text=request_payload.get('text'),
+        html=request_payload.get('html'),
+        tenant=g.tenant,
+    )
+
+    return jsonify({'name': name, 'version': version}), 201
+
+
+@api.route('/api/v1/templates/<name>', methods=['GET'])
+@authenticate
+@produces('application/json')
+def get_template(name):
+    '''
+    Returns the latest, or the requested, version of a template of the
+    tenant.
+    '''
+    version = request.args.get('version', type=int)
+    template = app.template_store.get(name, version, g.tenant)
+
+    if template is None:
+        return jsonify({'message': 'error'}), 404
+
+    return jsonify(template)
+
+
+@api.route('/api/v1/suppressions', methods=['POST'])
+@authenticate
+@admin_required
+@consumes('application/json')
+@produces('application/json')
+@json_validate(suppression_api_schema, get_format_checker)
+def add_suppressions():
+    '''
+    Suppresses addresses, or whole domains given without an @, in bulk.
+    Every worker picks the changes up within SUPPRESSION_RELOAD_INTERVAL.
+    '''
+    request_payload = request.get_json()
+    added = app.suppression_list.add(
+        request_payload['entries'], request_payload.get('reason'),
+    )
+
+    return jsonify({'message': 'success', 'added': added})
+
+
+@api.route('/api/v1/suppressions/<entry>', methods=['GET'])
+@authenticate
+@admin_required
+@produces('application/json')
+def get_suppression(entry):
+    '''Returns a suppressed address or domain'''
+    suppression = app.suppression_list.get(entry)
+
+    if suppression is None:
+        return jsonify({'message': 'error'}), 404
+
+    return jsonify(suppression)
+
+
+@api.route('/api/v1/suppressions/<entry>', methods=['DELETE'])
+@authenticate
+@admin_required
+@produces('application/json')
+def remove_suppression(entry):
+    '''Lifts the suppression of an address or domain'''
+
+    if not app.suppression_list.remove(entry):
+        return jsonify({'message': 'error'}), 404
+
+    return jsonify({'message': 'success'})
+
+
+def buffer_events(provider, events):
+    '''
+    Buffers the normalised events of a webhook and acknowledges them, or
+    asks the provider to retry if the buffer is full
+    '''
+
+    if not app.event_buffer.add(events):
+        response = jsonify({'message': 'error'})
+        response.status_code = 503
+        retry_after = app.config['EVENT_FLUSH_INTERVAL'] or 1
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+    for event in events:
+        app.metrics.inc('email_service_webhook_events_total', (
+            ('provider', provider), ('event', event['event']),
+        ))
+
+    return jsonify({'message': 'success', 'count': len(events)})
+
+
+@api.route('/api/v1/webhooks/sendgrid', methods=['POST'])
+@consumes('application/json')
+def sendgrid_webhook():
+    '''
+    Receives the events of the sendgrid event webhook, a json list, posted
+    with the basic auth credentials SENDGRID_WEBHOOK_USER and
+    SENDGRID_WEBHOOK_PASSWORD.
+    '''
+    verify_sendgrid(
+        request.authorization, app.config['SENDGRID_WEBHOOK_USER'],
+        app.config['SENDGRID_WEBHOOK_PASSWORD'],
+    )
+    events = request.get_json()
+
+    if not (isinstance(events, list) and
+            all(isinstance(event, dict) for event in events)):
+        raise ValidationError('events', 'Expected a list of events')
+
+    return buffer_events(
+        'sendgrid', [normalize_sendgrid(event) for event in events],
+    )
+
+
+@api.route('/api/v1/webhooks/mailgun', methods=['POST'])
+@consumes(
+    'application/json', 'application/x-www-form-urlencoded',
+    'multipart/form-data',
+)
+def mailgun_webhook():
+    '''
+    Receives an event of a mailgun webhook, signed with
+    MAILGUN_WEBHOOK_KEY. Json webhooks have the signature and event-data
+    objects, form webhooks have the signature and event fields.
+    '''
+
+    if request.mimetype == 'application/json':
+        payload = request.get_json()
+
+        if not (isinstance(payload, dict) and
+                isinstance(payload.get('signature'), dict) and
+                isinstance(payload.get('event-data'), dict)):
+            raise ValidationError('event-data', 'Expected a signed event')
+
+        signature, event = payload['signature'], payload['event-data']
+    else:
+        signature = event = request.form.to_dict()
+
+    verify_mailgun(
+        signature, app.config['MAILGUN_WEBHOOK_KEY'],
+        app.config['WEBHOOK_MAX_AGE'],
+    )
+
+    return buffer_events('mailgun', [normalize_mailgun(event)])
+
+
+@api.app_errorhandler(ValidationError)
+def handle_validation_error(error):
+    '''
+    Returns a 400 response with error message when validation error is raised.
+    '''
+    status_code = 400
+    message = error.message
+    field = error.field
+
+    payload = {
+        'message': 'error',
+        'error': {
+            'field': field,
+            'message': message,
+        }
+    }
+
+    return jsonify(payload), status_code
+
+
+@api.app_errorhandler(ClientException)
+def handle_client_exception(error):
+    '''
+    Returns the appropriate status code and message if there is an error in the
+    data posted to the email providers.
+    '''
+    status_code = error.status_code
+    error_message = error.error_message
+
+    return jsonify(error_message), status_code
+
+
+@api.app_errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(error):
+    '''
+    Returns a 504 response when the email couldn't be sent in time.
+    '''
+    return jsonify(error.error_message), error.status_code
+
+
+@api.app_errorhandler(RateLimited)
+def handle_rate_limited(error):
+    '''
+    Returns a 429 response telling the client when to retry, when every
+    backend is over its rate limit, or a 503 when the email was shed because
+    too many were being sent.
+    '''
+    response = jsonify(error.error_message)
+    response.status_code = error.status_code
+    response.headers['Retry-After'] = str(int(math.ceil(error.retry_after)))
+
+    return response
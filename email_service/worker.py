@@ -0,0 +1,27 @@
+'''Sender workers draining the outbox filled by asynchronous api requests'''
+from app import app
+from mail.sender import SenderPool
+
+
+def main():
+    '''
+    Runs the sender pool, and the maintenance of the send log, until the
+    process is killed
+    '''
+    pool = SenderPool(
+        app, app.outbox,
+        concurrency=app.config['SENDER_CONCURRENCY'],
+        batch_size=app.config['SENDER_BATCH_SIZE'],
+        poll_interval=app.config['SENDER_POLL_INTERVAL'],
+        lease=app.config['OUTBOX_LEASE'],
+        rate=app.config['SENDER_RATE'],
+        lookahead=app.config['SCHEDULER_LOOKAHEAD'],
+    )
+    pool.start()
+    app.send_log.start()
+    app.send_log.start_maintenance(app.config['SEND_LOG_MAINTENANCE_INTERVAL'])
+    pool.join()
+
+
+if __name__ == '__main__':
+    main()
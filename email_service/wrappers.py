@@ -0,0 +1,64 @@
+'''Request class accepting emails with attachments as multipart forms'''
+import json
+import tempfile
+
+from flask import Request, current_app
+
+
+PAYLOAD_FIELD = 'payload'
+ATTACHMENTS_FIELD = 'attachments'
+
+
+class EmailRequest(Request):
+    '''
+    Reads the json payload of multipart/form-data requests from their
+    `payload` field, so they are validated and handled like application/json
+    ones. Uploaded files are kept in memory up to ATTACHMENT_SPOOL_THRESHOLD
+    bytes each and spooled to temporary files past it.
+    '''
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(
+            max_size=current_app.config['ATTACHMENT_SPOOL_THRESHOLD'],
+        )
+
+    @property
+    def is_multipart(self):
+        '''True if the request is a multipart form'''
+        return self.mimetype == 'multipart/form-data'
+
+    def get_json(self, force=False, silent=False, cache=True):
+        '''Parses the json payload of the request'''
+
+        if not self.is_multipart:
+            return super(EmailRequest, self).get_json(force, silent, cache)
+
+        if '_cached_json' in self.__dict__:
+            return self._cached_json
+
+        try:
+            rv = json.loads(self.form.get(PAYLOAD_FIELD, ''))
+        except ValueError, excp:
+
+            if not silent:
+                return self.on_json_loading_failed(excp)
+
+            rv = None
+
+        if cache:
+            self._cached_json = rv
+
+        return rv
+
+    @property
+    def attachments(self):
+        '''Files uploaded in the attachments field of a multipart request'''
+
+        if not self.is_multipart:
+            return []
+
+        return [
+            storage for storage in self.files.getlist(ATTACHMENTS_FIELD)
+            if storage.filename
+        ]
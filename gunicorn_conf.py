@@ -2,10 +2,80 @@ import os
 
 
 workers = os.environ.get('GUNICORN_NUM_WORKERS', 6)
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
 max_requests = os.environ.get('GUNICORN_MAX_REQUESTS', 0)
 worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+# Load the app in the master before forking, so the workers share its code
+# and compiled schemas and boot faster. Code changes then need a restart
+# rather than a HUP, set GUNICORN_PRELOAD=0 to load the app in each worker.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
 loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
 timeout = 20
 accesslog = '-'
 errorlog = '-'
 access_log_format = '%({X-Forwarded-For}i)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
+
+# The gevent workers patch the standard library when they start, too late for
+# the locks, thread locals and sockets a preloaded app creates in the master.
+if preload_app and worker_class == 'gevent':
+    from gevent import monkey
+    monkey.patch_all(subprocess=True)
+
+
+def on_starting(server):
+    '''Removes the metrics files left by workers of a previous run'''
+    metrics_dir = os.environ.get('METRICS_DIR', 'metrics')
+
+    if os.path.isdir(metrics_dir):
+
+        for filename in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, filename))
+
+
+def when_ready(server):
+    '''
+    Imports the http client and compiles the request schemas in the master,
+    so every worker inherits them instead of doing it again after the fork.
+    With preload_app the suppression list is loaded too, and its memory is
+    shared by the workers. Without it the views aren't loaded yet and only
+    the imports are shared.
+    '''
+    from email_service import decorators
+    from mail import backends
+
+    decorators.compile_validators()
+
+    if server.cfg.preload_app:
+        from app import app
+        app.suppression_list.load()
+
+
+def post_fork(server, worker):
+    '''
+    Makes sure a new worker never reuses http connections, backends or
+    breaker state of its parent
+    '''
+    from mail import breaker, registry, transport
+    transport.reset()
+    registry.reset()
+    breaker.reset()
+
+
+def post_worker_init(worker):
+    '''
+    Opens connections to the email providers before serving requests and
+    starts probing their health.
+    '''
+    from app import start_worker
+
+    start_worker(worker.app.wsgi())
+
+
+def worker_exit(server, worker):
+    '''
+    Writes the webhook events and send attempts still buffered by a stopping
+    worker
+    '''
+    flask_app = worker.app.wsgi()
+    flask_app.event_buffer.flush()
+    flask_app.send_log.flush()